@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import signal
+import socket
+import time
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+
+import jsonrpc
+
+from client import BetelbotClientConnection
+from config import JsonConfig, DictConfig
+from master import BetelbotConnection, BetelbotMethod, BetelbotServer
+from master import getServerOptions, notifySubscribers
+from topic import getTopics
+from util import signalHandler
+
+
+# Runs the master on several processes.
+#
+# - Worker processes accept client connections on the master port. The
+#   listening socket is bound before forking, so the kernel spreads new
+#   connections over the workers.
+# - Each worker is a normal master for its own clients, and is connected to
+#   a broker process over a Unix domain socket.
+# - The broker is a master that does not echo publishes. Workers subscribe
+#   to every topic on the broker and forward their publishes and service
+#   registrations to it, so subscribers on any worker receive every publish
+#   and services can be located from any worker. Workers do not keep
+#   service addresses, every locate is answered by the broker.
+#
+# Topic stats are kept per process, so the stats method of a worker only
+# reports its own clients.
+
+
+class BrokerLink(BetelbotClientConnection):
+    # Connection from a worker to the broker.
+
+    # Log messages
+    LOG_ATTACHED = 'Worker attached to broker'
+    LOG_LOOKUP_TIMEOUT = 'Locating service "{}" on broker timed out'
+
+    # Seconds to wait for the broker to answer a locate request
+    LOOKUP_TIMEOUT = 5.0
+
+    # Error messages
+    ERROR_CLOSED = 'Connection to broker closed. Stopping worker'
+
+    def attach(self, server):
+        # Makes the server forward to this connection and subscribes to
+        # every topic on the broker.
+
+        self.logInfo(BrokerLink.LOG_ATTACHED)
+        self.server = server
+        server.data.broker = self
+        self.subscribe('*', self.onBrokerPublish)
+
+    def onBrokerPublish(self, topic, params):
+        # Sends a publish from another worker to the subscribers of this worker.
+
+        if topic in self.server.data.topicSubscribers:
+            notifySubscribers(self.server.data, topic, params)
+
+    def lookup(self, callback, method):
+        # Locates a service on the broker. The callback receives the result
+        # of the locate response, or None if the service was not found or
+        # the broker did not answer in time.
+
+        id = self.idincrement.id()
+        ioloop = IOLoop.instance()
+
+        def onResponse(msg):
+            ioloop.remove_timeout(timeout)
+            callback(msg.get(jsonrpc.Key.RESULT, None))
+
+        def onTimeout():
+            if self.responseHandlers.pop(id, None):
+                self.logInfo(BrokerLink.LOG_LOOKUP_TIMEOUT.format(method))
+                callback(None)
+
+        timeout = ioloop.add_timeout(time.time() + BrokerLink.LOOKUP_TIMEOUT, onTimeout)
+        self.responseHandlers[id] = onResponse
+        self.write(self.encoder.request(id, BetelbotMethod.LOCATE, method))
+
+    def onClose(self):
+        # A worker without the broker would only reach its own clients.
+
+        logging.error(BrokerLink.ERROR_CLOSED)
+        IOLoop.instance().stop()
+
+
+class BrokerServer(BetelbotServer):
+    # Master that connects the workers. Does not echo publishes back to
+    # the worker that sent them.
+
+    def handle_stream(self, stream, address):
+        # Unix domain sockets have no peer address, so the socket path
+        # is used for logging instead.
+
+        self.connection(stream, (stream.socket.getsockname(), 0), data=self.data)
+
+
+def bindUnixSocket(path, backlog=128):
+    # Creates a listening Unix domain socket. A socket file left over
+    # from an earlier run is removed.
+
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+
+def connectUnix(path, connection, **kwargs):
+    # Creates and returns a connection to a Unix domain socket.
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stream = IOStream(sock)
+    stream.connect(path)
+    return connection(stream, (path, 0), DictConfig(kwargs))
+
+
+def startBroker(sock, **options):
+    server = BrokerServer(connection=BetelbotConnection, topics=getTopics(),
+        echo=False, **options)
+    server.add_sockets([sock])
+    IOLoop.instance().start()
+
+
+def startWorker(sockets, path, rpcOptions, **options):
+    server = BetelbotServer(connection=BetelbotConnection, topics=getTopics(), **options)
+    link = connectUnix(path, BrokerLink, **rpcOptions)
+    link.attach(server)
+    server.add_sockets(sockets)
+    IOLoop.instance().start()
+
+
+def serve(port, path, workers, rpcOptions, **options):
+    # Starts the broker and the workers. Zero workers means one per cpu.
+    #
+    # Sockets are bound before forking, so workers can connect to the
+    # broker before it is running.
+
+    sockets = bind_sockets(port)
+    brokerSocket = bindUnixSocket(path)
+
+    if os.fork() == 0:
+        for sock in sockets:
+            sock.close()
+        startBroker(brokerSocket, **options)
+        return
+
+    fork_processes(workers)
+    brokerSocket.close()
+    startWorker(sockets, path, rpcOptions, **options)
+
+
+def main():
+    signal.signal(signal.SIGINT, signalHandler)
+
+    cfg = JsonConfig()
+
+    logger = logging.getLogger('')
+    logger.setLevel(cfg.general.logLevel)
+
+    serve(cfg.server.port, cfg.broker.socket, cfg.broker.workers,
+        cfg.rpc.dict(), **getServerOptions(cfg))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,16 @@
 import json
+import logging
 import socket
+from fnmatch import fnmatchcase
 
 from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream
 
 import jsonrpc
 
-from jsonrpc import JsonRpcConnection, JsonRpcConnection
-from master import BetelbotMethod
+from codec import JsonCodec
+from jsonrpc import JsonRpcConnection, ServiceConnection
+from master import BetelbotMethod, isPattern
 from util import Client
 
 
@@ -20,6 +23,7 @@ class BetelbotClientConnection(JsonRpcConnection):
     # - Subscribe to topics
     # - Register a service on server
     # - Locate a registered service
+    # - Retrieve topic stats
     #
     # Once a service is located, those operations become supported and
     # can be invoked the same as built-in operations.
@@ -35,14 +39,19 @@ class BetelbotClientConnection(JsonRpcConnection):
     LOG_ADD_SERVICE = 'Adding service "{}"'
 
     def onInit(self, **kwargs):
-        # - subscription handlers manage subscriber callbacks
+        # - subscription handlers manage subscriber callbacks by topic or pattern
+        # - patterns are the glob patterns subscribed to
         # - method handlers currently only handle the NotifySub method
+        # - service pool keeps connections to located services open
 
         self.logInfo(BetelbotClientConnection.LOG_CLIENT_CONNECT)
         self.subscriptionHandlers = {}
+        self.patterns = set()
+        self.servicePool = ServicePool()
         self.methodHandlers = {
             BetelbotMethod.NOTIFYSUB: self.handleNotifySub
         }
+        self.negotiate(getattr(self.data, JsonRpcConnection.PARAM_CODEC, JsonCodec.NAME))
 
     def publish(self, topic, *params):
         # Sends a "publish" notification to the server.
@@ -52,17 +61,30 @@ class BetelbotClientConnection(JsonRpcConnection):
         self.logInfo(BetelbotClientConnection.LOG_PUBLISH.format(topic))
         self.write(self.encoder.notification(BetelbotMethod.PUBLISH, topic, *params))
 
-    def subscribe(self, topic, callback=None):
+    def subscribe(self, topics, callback=None):
         # Sends a "subscribe" notification to the server.
         #
-        # Anytime data gets published to the topic, client will be notified
-        # and the specified callback will be invoked.
+        # Topics can be a topic, a glob pattern such as "*", or a list of
+        # both. Names not subscribed to yet are sent in a single notification.
+        #
+        # Anytime data gets published to a matching topic, client will be
+        # notified and the specified callback will be invoked.
+
+        if isinstance(topics, basestring):
+            topics = [topics]
 
-        self.logInfo(BetelbotClientConnection.LOG_SUBSCRIBE.format(topic))
-        if topic not in self.subscriptionHandlers:
-            self.subscriptionHandlers[topic] = []
-            self.write(self.encoder.notification(BetelbotMethod.SUBSCRIBE, topic))
-        self.subscriptionHandlers[topic].append(callback)
+        names = []
+        for topic in topics:
+            self.logInfo(BetelbotClientConnection.LOG_SUBSCRIBE.format(topic))
+            if topic not in self.subscriptionHandlers:
+                self.subscriptionHandlers[topic] = []
+                names.append(topic)
+                if isPattern(topic):
+                    self.patterns.add(topic)
+            self.subscriptionHandlers[topic].append(callback)
+
+        if names:
+            self.write(self.encoder.notification(BetelbotMethod.SUBSCRIBE, *names))
 
     def handleNotifySub(self, msg):
         # Handles subscription notifcation.
@@ -83,17 +105,30 @@ class BetelbotClientConnection(JsonRpcConnection):
         if len(params) > 1:
             topic = params[0]
             data = params[1:]
+            names = [pattern for pattern in self.patterns if fnmatchcase(topic, pattern)]
             if topic in self.subscriptionHandlers:
+                names.append(topic)
+
+            if names:
                 self.logInfo(BetelbotClientConnection.LOG_SUBSCRIBE_NOTIFY.format(topic))
+
+            for name in names:
                 disconnected = []
-                for subscriber in self.subscriptionHandlers[topic]:
+                for subscriber in self.subscriptionHandlers[name]:
                     try:
                         subscriber(topic, data)
                     except AttributeError:
                         disconnected.append(subscriber)
 
                 for subscriber in disconnected:
-                    self.subscriptionHandlers[topic].remove(subscriber)
+                    self.subscriptionHandlers[name].remove(subscriber)
+
+    def stats(self, callback):
+        # Requests the fan-out stats of every topic from the server.
+
+        id = self.idincrement.id()
+        self.responseHandlers[id] = lambda msg: callback(msg.get(jsonrpc.Key.RESULT, [None])[0])
+        self.write(self.encoder.request(id, BetelbotMethod.STATS))
 
     def register(self, method, port, host=''):
         # Registers a service with the server. Information needed is method name,
@@ -123,6 +158,9 @@ class BetelbotClientConnection(JsonRpcConnection):
             callback(method, True)
 
     def batchLocate(self, callback, methods):
+        # Locates several services. The locate requests are sent to the
+        # server as one batch.
+
         methodsDict = {}
         def onBatchLocateResponse(methodName, found):
             if methodName in methodsDict:
@@ -133,15 +171,18 @@ class BetelbotClientConnection(JsonRpcConnection):
 
         for method in methods:
             methodsDict[method] = None
+
+        self.startBatch()
+        for method in methods:
             self.locate(onBatchLocateResponse, method)
+        self.flushBatch()
 
     def handleLocateResponse(self, callback, method, msg):
         # When the locate method receives a response, this callback will be
         # invoked so that we can add the service to the client.
         #
-        # Services are individual clients that create their own connections.
-        # These connections send a request and then close the connection once a
-        # response is received.
+        # Services are individual clients. Requests to a service share one
+        # persistent connection from the service pool.
         #
         # Service methods are dynamically added to BetelbotClientConnection
         # and can be called like a regular method.
@@ -151,7 +192,7 @@ class BetelbotClientConnection(JsonRpcConnection):
         result = msg.get(jsonrpc.Key.RESULT, None)
         if result and len(result) == 2:
             port, host = result
-            client = Client(host, port, jsonrpc.ClientConnection)
+            client = Client(host, port, ServiceConnection, **self.getServiceOptions())
             self.addService(method, client)
             callback(method, True)
         else:
@@ -162,20 +203,74 @@ class BetelbotClientConnection(JsonRpcConnection):
 
         return hasattr(self.__class__, method) and callable(getattr(self.__class__, method))
 
+    def getServiceOptions(self):
+        # Service connections use the timeout, in-flight limits and codec
+        # that were passed to this client, if any.
+
+        return dict((key, getattr(self.data, key))
+            for key in ServiceConnection.PARAMS if hasattr(self.data, key))
+
     def addService(self, method, client):
         # A service is dynamically added to BetelbotClientConnection, so
         # the method can be called as a normal method.
+        #
+        # An errback can be passed as keyword argument, see ServiceConnection.
+        #
+        # Example: conn.search(callback, [1,2], [2,3], errback=onError)
 
         self.logInfo(BetelbotClientConnection.LOG_ADD_SERVICE.format(method))
 
-        def request(self, callback, *params):
-            conn = client.connect()
-            conn.request(callback, method, *params)
+        def request(self, callback, *params, **kwargs):
+            conn = self.servicePool.connect(client)
+            conn.request(callback, method, *params, **kwargs)
 
         request.__name__ = method
         setattr(self.__class__, request.__name__, request)
 
 
+class ServicePool(object):
+    # Keeps one persistent connection per service host and port.
+    #
+    # Services registered on the same port, such as pathfinder_search and
+    # pathfinder_status, share a connection. If a connection closes, it is
+    # removed from the pool and the next request opens a new one.
+
+    # Log messages
+    LOG_CONNECT = 'Connecting to service at {}:{}'
+    LOG_DISCONNECT = 'Service connection to {}:{} closed'
+
+    def __init__(self):
+        self.connections = {}
+
+    def connect(self, client):
+        # Returns an open connection to the client's host and port.
+
+        key = (client.host, client.port)
+        conn = self.connections.get(key, None)
+        if conn is None or conn.closed():
+            logging.info(ServicePool.LOG_CONNECT.format(*key))
+            conn = client.connect()
+            conn.setCloseCallback(lambda: self.onClose(key, conn))
+            self.connections[key] = conn
+        return conn
+
+    def onClose(self, key, conn):
+        logging.info(ServicePool.LOG_DISCONNECT.format(*key))
+        if self.connections.get(key, None) is conn:
+            del self.connections[key]
+
+    def getStatus(self):
+        # Returns the request counters of each connection, keyed by host:port.
+
+        return dict(('{}:{}'.format(*key), conn.getStatus())
+            for key, conn in self.connections.iteritems())
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+
 def main():
     pass
 
@@ -0,0 +1,135 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import numpy as np
+
+
+# Wire codecs for JSON-RPC messages.
+#
+# JSON is the default and is what the web clients speak. Betelbot clients can
+# ask a server to switch their connection to a binary codec at connect time,
+# which is much smaller and faster for topics like particle that carry
+# thousands of numbers.
+#
+# Text codecs are framed by the terminator character. Binary codecs can
+# contain any byte, so their frames are prefixed with their length instead.
+#
+# Negotiation:
+#
+# - The client sends a "codec" request in JSON with the codecs it
+#   wants, in order of preference.
+# - The server responds in JSON with the first codec it supports, or json,
+#   and switches the connection after the response is sent.
+# - The client holds back other messages until the response arrives, and then
+#   switches as well. If no response arrives in time, the client sends them
+#   in json instead.
+
+
+# Method used to negotiate a codec. Handled by every JsonRpcConnection.
+#
+# - Type: Request
+# - Method: codec
+# - Params: codec names in order of preference
+# - Response: codec name
+NEGOTIATE = 'codec'
+
+
+class JsonCodec(object):
+    # Default codec.
+
+    NAME = 'json'
+    BINARY = False
+
+    def __init__(self, jsonEncoder=json.JSONEncoder):
+        self.jsonEncoder = jsonEncoder
+
+    def dumps(self, msg):
+        return json.dumps(msg, cls=self.jsonEncoder)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def batch(self, msgs):
+        # Combines encoded messages into an array.
+
+        return '[{}]'.format(','.join(msgs))
+
+
+class MsgpackCodec(object):
+    # MessagePack codec. Only available if the msgpack package is installed.
+    #
+    # Numpy arrays and numbers are packed as plain lists and numbers, so
+    # numeric data does not need to be converted before it is published.
+
+    NAME = 'msgpack'
+    BINARY = True
+
+    # Error messages
+    ERROR_TYPE = 'Cannot pack "{}"'
+
+    # Array headers, see the MessagePack spec
+    FIXARRAY = 0x90
+    FIXARRAY_MAX = 15
+    ARRAY16 = struct.Struct('>BH')
+    ARRAY16_MAX = 0xffff
+    ARRAY32 = struct.Struct('>BI')
+
+    def dumps(self, msg):
+        return msgpack.packb(msg, default=self.packDefault)
+
+    def loads(self, data):
+        return msgpack.unpackb(data)
+
+    def batch(self, msgs):
+        # An array header followed by the packed items is a packed array,
+        # so encoded messages can be combined without packing them again.
+
+        count = len(msgs)
+        if count <= MsgpackCodec.FIXARRAY_MAX:
+            header = chr(MsgpackCodec.FIXARRAY | count)
+        elif count <= MsgpackCodec.ARRAY16_MAX:
+            header = MsgpackCodec.ARRAY16.pack(0xdc, count)
+        else:
+            header = MsgpackCodec.ARRAY32.pack(0xdd, count)
+        return header + ''.join(msgs)
+
+    def packDefault(self, obj):
+        if isinstance(obj, (np.ndarray, np.generic)):
+            return obj.tolist()
+        raise TypeError, MsgpackCodec.ERROR_TYPE.format(type(obj).__name__)
+
+
+CODECS = {
+    JsonCodec.NAME: JsonCodec
+}
+
+if msgpack is not None:
+    CODECS[MsgpackCodec.NAME] = MsgpackCodec
+
+
+def getCodec(name):
+    # Returns a codec instance by name. Unknown names fall back to json.
+
+    return CODECS.get(name, JsonCodec)()
+
+
+def chooseCodec(names):
+    # Picks the first supported codec from a list of names.
+
+    for name in names:
+        if name in CODECS:
+            return name
+    return JsonCodec.NAME
+
+
+def main():
+    pass
+
+
+if __name__ == '__main__':
+    main()
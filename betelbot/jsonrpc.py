@@ -1,9 +1,17 @@
 import abc
 import json
+import logging
 import socket
+import time
 
+from collections import deque
+
+from tornado.ioloop import IOLoop
 from tornado.netutil import TCPServer
 
+import codec
+
+from codec import JsonCodec, getCodec, chooseCodec
 from config import DictConfig
 from util import Connection
 
@@ -15,8 +23,8 @@ from util import Connection
 #
 # The JSON-RPC 2.0 spec can be found here: http://www.jsonrpc.org/specification.
 #
-# Currently only a JSON-RPC encoder class is implemented. For now, messages can be
-# decoding using json.loads to turn json into python data types.
+# Messages are encoded as JSON by default. See the codec module for binary
+# codecs that a connection can switch to.
 
 
 class Key(object):
@@ -43,6 +51,11 @@ class Error(object):
     INVALID_PARAMS = {Key.CODE: -326002, Key.MESSAGE: 'Invalid params'}
     INTERNAL_ERROR = {Key.CODE: -326003, Key.MESSAGE: 'Internal error'}
 
+    # Errors raised by the client side of a service connection.
+    TIMEOUT = {Key.CODE: -32000, Key.MESSAGE: 'Request timed out'}
+    OVERLOADED = {Key.CODE: -32001, Key.MESSAGE: 'Too many requests in flight'}
+    CONNECTION_CLOSED = {Key.CODE: -32002, Key.MESSAGE: 'Connection closed'}
+
 
 class Encoder(object):
     # Implements a barebones JSON-RPC 2.0 interface for sending messages.
@@ -53,7 +66,7 @@ class Encoder(object):
     # For instance, it is the responsibility of the user to not pass in None
     # as a value for the id param.
     #
-    # Batch requests are not currently supported.
+    # Batches are built from already encoded messages with the batch method.
     #
     # By default the encoder cannot encode complex objects correctly. The json
     # module only supports basic python types unless the JSONEncoder class is
@@ -61,10 +74,13 @@ class Encoder(object):
 
     VERSION = "2.0"
 
-    def __init__(self, jsonEncoder=json.JSONEncoder):
+    def __init__(self, jsonEncoder=json.JSONEncoder, codec=None):
         # Pass in a custom JSONEncoder if complex objects need to be encoded.
+        #
+        # A codec from the codec module replaces JSON as the wire format.
 
         self.jsonEncoder = jsonEncoder
+        self.codec = codec or JsonCodec(jsonEncoder)
 
     def request(self, id, method, *params):
         # Encodes a JSON object to be sent as a request.
@@ -114,6 +130,19 @@ class Encoder(object):
             msg[Key.PARAMS] = params
         return self.encode(msg)
 
+    def batch(self, *msgs):
+        # Combines encoded messages into a JSON-RPC batch array.
+        #
+        # - Messages must already be encoded by this encoder.
+        # - Requests, notifications and responses can be mixed.
+
+        return self.codec.batch(msgs)
+
+    def decode(self, data):
+        # Decodes a message received in this encoder's codec.
+
+        return self.codec.loads(data)
+
     def encode(self, msg):
         # Helper that encodes dict into json and adds jsonrpc version param,
         # which is required by JSON-RPC 2.0.
@@ -122,7 +151,7 @@ class Encoder(object):
         # that a valid message is provided.
 
         msg[Key.JSONRPC] = self.VERSION
-        return json.dumps(msg, cls=self.jsonEncoder)
+        return self.codec.dumps(msg)
 
 
 class IdIncrement(object):
@@ -162,6 +191,20 @@ class JsonRpcConnection(Connection):
     # Main additions are jsonrpc encoder and an implementation
     # for onRead method that dispatches to various methodHandler
     # callbacks.
+    #
+    # Every connection answers codec negotiation requests. Client connections
+    # start one with negotiate, see the codec module.
+
+    # Accepted data params
+    PARAM_CODEC = 'codec'
+
+    # Log messages
+    LOG_CODEC = 'Switching to "{}" codec'
+    LOG_NEGOTIATE_TIMEOUT = 'Codec negotiation timed out, using json'
+    LOG_NEGOTIATE_LATE = 'Codec negotiation answered after timeout, closing connection'
+
+    # Seconds to wait for the response to a codec negotiation
+    NEGOTIATE_TIMEOUT = 5.0
 
     def __init__(self, stream, address, data, terminator='\0'):
         try:
@@ -176,6 +219,11 @@ class JsonRpcConnection(Connection):
 
         self.methodHandlers = {}
         self.responseHandlers = {}
+        self.batch = None
+        self.batchDepth = 0
+        self.pendingWrites = None
+        self.negotiateId = None
+        self.negotiateTimeout = None
 
         super(JsonRpcConnection, self).__init__(stream, address, data, terminator)
 
@@ -194,15 +242,161 @@ class JsonRpcConnection(Connection):
         # - methodHandlers handle notifications/requests
         # - responseHandlers handle responses
 
-        msg = json.loads(data.strip(self.terminator))
+        #
+        # A batch array is dispatched one message at a time. Anything written
+        # to this connection while the batch is handled is sent back as one
+        # batch in a single frame, even if there is only one message. Responses
+        # that are sent later, such as from a callback, go out on their own.
+
+        if not self.lengthPrefixed:
+            data = data.strip(self.terminator)
+        msg = self.encoder.decode(data)
+
+        if not isinstance(msg, list):
+            self.dispatch(msg)
+        elif not msg:
+            self.write(self.encoder.error(None, Error.INVALID_REQUEST))
+        else:
+            self.startBatch()
+            for item in msg:
+                if isinstance(item, dict):
+                    self.dispatch(item)
+                else:
+                    self.write(self.encoder.error(None, Error.INVALID_REQUEST))
+            self.flushBatch(True)
+
+    def dispatch(self, msg):
+        # Calls the method handler for a notification/request or the
+        # response handler for a response.
+
         id = msg.get(Key.ID, None)
         method = msg.get(Key.METHOD, None)
 
         if method in self.methodHandlers:
             self.methodHandlers[method](msg)
+        elif method == codec.NEGOTIATE:
+            self.handleNegotiate(msg)
+        elif id is not None and id == self.negotiateId:
+            self.handleNegotiateResponse(msg)
         elif id in self.responseHandlers:
-            self.responseHandlers[id](msg)
-            del self.responseHandlers[id]
+            self.responseHandlers.pop(id)(msg)
+
+    def negotiate(self, *names):
+        # Asks the server to switch this connection to the first codec
+        # it supports. Codecs that are not available here are skipped.
+        #
+        # Other messages are held back until the server responds, and are
+        # then sent in the agreed codec. If there is no response before the
+        # timeout, they are sent in json.
+        #
+        # The negotiation is not a response handler, so it does not count
+        # as a request in flight.
+
+        names = [name for name in names if chooseCodec([name]) == name]
+        if not names or names == [JsonCodec.NAME]:
+            return
+
+        self.negotiateId = self.idincrement.id()
+        self.negotiateTimeout = IOLoop.instance().add_timeout(
+            time.time() + JsonRpcConnection.NEGOTIATE_TIMEOUT, self.onNegotiateTimeout)
+        self.write(self.encoder.request(self.negotiateId, codec.NEGOTIATE, *names))
+        self.pendingWrites = []
+
+    def handleNegotiateResponse(self, msg):
+        # After a timeout, this connection has already sent json. A server
+        # that switched codecs cannot read it, so the connection is closed.
+
+        result = msg.get(Key.RESULT, None)
+        name = result[0] if result else JsonCodec.NAME
+        self.negotiateId = None
+
+        if self.negotiateTimeout is None:
+            if name != JsonCodec.NAME:
+                self.logInfo(JsonRpcConnection.LOG_NEGOTIATE_LATE)
+                self.close()
+            return
+
+        IOLoop.instance().remove_timeout(self.negotiateTimeout)
+        self.negotiateTimeout = None
+        self.setCodec(name)
+        self.flushPendingWrites()
+
+    def onNegotiateTimeout(self):
+        self.logInfo(JsonRpcConnection.LOG_NEGOTIATE_TIMEOUT)
+        self.negotiateTimeout = None
+        self.flushPendingWrites()
+
+    def flushPendingWrites(self):
+        # Sends the messages held back during negotiation in the current codec.
+
+        pendingWrites = self.pendingWrites
+        self.pendingWrites = None
+        if self.stream.closed():
+            return
+
+        for data in pendingWrites:
+            if self.encoder.codec.NAME != JsonCodec.NAME:
+                data = self.encoder.codec.dumps(json.loads(data))
+            self.write(data)
+
+    def handleNegotiate(self, msg):
+        # Responds with the chosen codec in the current codec, and then
+        # switches.
+        #
+        # Inside a batch, the rest of the batch and the batch response would
+        # be in a different codec than the request, so an invalid request
+        # error is sent instead.
+
+        id = msg.get(Key.ID, None)
+        params = msg.get(Key.PARAMS, None) or []
+        if id and self.batch is not None:
+            self.write(self.encoder.error(id, Error.INVALID_REQUEST))
+        elif id:
+            name = chooseCodec(params)
+            self.write(self.encoder.response(id, name))
+            self.setCodec(name)
+
+    def setCodec(self, name):
+        if name != self.encoder.codec.NAME:
+            self.logInfo(JsonRpcConnection.LOG_CODEC.format(name))
+            self.encoder = Encoder(codec=getCodec(name))
+            self.lengthPrefixed = self.encoder.codec.BINARY
+
+    def startBatch(self):
+        # Collects written messages until flushBatch is called, so they are
+        # sent as one JSON-RPC batch in a single write.
+        #
+        # Batches can be nested, for example a handler in an incoming batch
+        # may locate several services. Messages are collected until the
+        # outermost batch is flushed.
+
+        self.batchDepth += 1
+        if self.batch is None:
+            self.batch = []
+
+    def flushBatch(self, array=False):
+        # Sends the collected messages. A single message is sent as is,
+        # unless array is set.
+
+        if self.batchDepth > 0:
+            self.batchDepth -= 1
+        if self.batchDepth > 0 or self.batch is None:
+            return
+
+        batch = self.batch
+        self.batch = None
+        if len(batch) == 1 and not array:
+            self.write(batch[0])
+        elif batch:
+            self.write(self.encoder.batch(*batch))
+
+    def write(self, msg):
+        if self.pendingWrites is not None:
+            self.pendingWrites.append(msg)
+        elif self.batch is not None:
+            self.batch.append(msg)
+        else:
+            super(JsonRpcConnection, self).write(msg)
 
 
 class ClientConnection(JsonRpcConnection):
@@ -260,6 +454,181 @@ class ClientConnection(JsonRpcConnection):
         self.readHandler(data)
 
 
+class ServiceConnection(JsonRpcConnection):
+    # Persistent connection to a service that can have many requests in
+    # flight at the same time.
+    #
+    # Unlike ClientConnection, the connection stays open after a response.
+    # Responses are matched to their request by id, so they can arrive in
+    # any order.
+    #
+    # - Connections are best created by ServicePool in the client module.
+    # - Every request has a deadline. If no response arrives in time, the
+    #   errback is called with Error.TIMEOUT and a late response is ignored.
+    # - At most maxInFlight requests wait for a response. Further requests
+    #   are queued, and once maxQueued requests are queued, new requests are
+    #   rejected with Error.OVERLOADED.
+    # - If the connection closes, waiting and queued requests get
+    #   Error.CONNECTION_CLOSED. They are not sent again since a request may
+    #   not be safe to repeat.
+    #
+    # Errbacks are optional and receive the JSON-RPC error object. Error
+    # responses from the service are passed to the errback as well.
+
+    # Accepted data params
+    PARAM_TIMEOUT = 'timeout'
+    PARAM_MAX_IN_FLIGHT = 'maxInFlight'
+    PARAM_MAX_QUEUED = 'maxQueued'
+    PARAMS = [PARAM_TIMEOUT, PARAM_MAX_IN_FLIGHT, PARAM_MAX_QUEUED, JsonRpcConnection.PARAM_CODEC]
+
+    # Defaults, timeout is in seconds
+    DEFAULT_TIMEOUT = 5.0
+    DEFAULT_MAX_IN_FLIGHT = 16
+    DEFAULT_MAX_QUEUED = 64
+
+    # Counter keys
+    KEY_REQUESTS = 'requests'
+    KEY_RESPONSES = 'responses'
+    KEY_ERRORS = 'errors'
+    KEY_TIMEOUTS = 'timeouts'
+    KEY_REJECTED = 'rejected'
+    KEY_DROPPED = 'dropped'
+    KEY_IN_FLIGHT = 'inFlight'
+    KEY_QUEUE_DEPTH = 'queueDepth'
+    KEY_MAX_QUEUE_DEPTH = 'maxQueueDepth'
+
+    # Log message templates
+    LOG_REQUEST_SEND = 'Sending "{}" request'
+    LOG_REQUEST_QUEUED = 'Queued "{}" request, queue depth {}'
+    LOG_RESPONSE_RECEIVED = 'Received "{}" response'
+    LOG_REQUEST_FAILED = '"{}" request failed: {}'
+
+    def onInit(self):
+        defaults = {
+            ServiceConnection.PARAM_TIMEOUT: ServiceConnection.DEFAULT_TIMEOUT,
+            ServiceConnection.PARAM_MAX_IN_FLIGHT: ServiceConnection.DEFAULT_MAX_IN_FLIGHT,
+            ServiceConnection.PARAM_MAX_QUEUED: ServiceConnection.DEFAULT_MAX_QUEUED
+        }
+        for key, value in defaults.iteritems():
+            if not hasattr(self.data, key):
+                setattr(self.data, key, value)
+
+        self.ioloop = IOLoop.instance()
+        self.closeCallback = None
+        self.pending = {}
+        self.queue = deque()
+        self.counters = dict.fromkeys([
+            ServiceConnection.KEY_REQUESTS,
+            ServiceConnection.KEY_RESPONSES,
+            ServiceConnection.KEY_ERRORS,
+            ServiceConnection.KEY_TIMEOUTS,
+            ServiceConnection.KEY_REJECTED,
+            ServiceConnection.KEY_DROPPED,
+            ServiceConnection.KEY_MAX_QUEUE_DEPTH], 0)
+
+        self.negotiate(getattr(self.data, JsonRpcConnection.PARAM_CODEC, JsonCodec.NAME))
+
+    def request(self, callback, method, *params, **kwargs):
+        # Sends a request. This method is nonblocking, so a callback
+        # is necessary to handle the eventual response.
+        #
+        # An errback can be passed as keyword argument to handle timeouts,
+        # rejected requests and error responses.
+
+        errback = kwargs.get('errback', None)
+        self.counters[ServiceConnection.KEY_REQUESTS] += 1
+
+        if len(self.responseHandlers) < self.data.maxInFlight:
+            self.send(callback, errback, method, params)
+        elif len(self.queue) < self.data.maxQueued:
+            self.queue.append((callback, errback, method, params))
+            self.counters[ServiceConnection.KEY_MAX_QUEUE_DEPTH] = max(
+                self.counters[ServiceConnection.KEY_MAX_QUEUE_DEPTH], len(self.queue))
+            self.logInfo(ServiceConnection.LOG_REQUEST_QUEUED.format(method, len(self.queue)))
+        else:
+            self.counters[ServiceConnection.KEY_REJECTED] += 1
+            self.fail(errback, method, Error.OVERLOADED)
+
+    def send(self, callback, errback, method, params):
+        self.logInfo(ServiceConnection.LOG_REQUEST_SEND.format(method))
+        id = self.idincrement.id()
+        self.responseHandlers[id] = lambda msg: self.handleResponse(id, msg, method, callback, errback)
+        timeout = self.ioloop.add_timeout(time.time() + self.data.timeout, lambda: self.handleTimeout(id))
+        self.pending[id] = (timeout, method, errback)
+        self.write(self.encoder.request(id, method, *params))
+
+    def sendQueued(self):
+        # Sends queued requests while there is room for them.
+
+        while self.queue and len(self.responseHandlers) < self.data.maxInFlight:
+            self.send(*self.queue.popleft())
+
+    def handleResponse(self, id, msg, method, callback, errback):
+        self.ioloop.remove_timeout(self.pending.pop(id)[0])
+        self.logInfo(ServiceConnection.LOG_RESPONSE_RECEIVED.format(method))
+
+        error = msg.get(Key.ERROR, None)
+        result = msg.get(Key.RESULT, None)
+        if error is not None:
+            self.counters[ServiceConnection.KEY_ERRORS] += 1
+            self.fail(errback, method, error)
+        else:
+            self.counters[ServiceConnection.KEY_RESPONSES] += 1
+            if result is not None:
+                callback(result)
+
+        self.sendQueued()
+
+    def handleTimeout(self, id):
+        if id in self.pending:
+            del self.responseHandlers[id]
+            timeout, method, errback = self.pending.pop(id)
+            self.counters[ServiceConnection.KEY_TIMEOUTS] += 1
+            self.fail(errback, method, Error.TIMEOUT)
+            self.sendQueued()
+
+    def fail(self, errback, method, error):
+        logging.warning(ServiceConnection.LOG_REQUEST_FAILED.format(method, error.get(Key.MESSAGE, None)))
+        if errback:
+            errback(error)
+
+    def getStatus(self):
+        # Returns the request counters along with the number of requests
+        # waiting for a response and the current queue depth.
+
+        status = dict(self.counters)
+        status[ServiceConnection.KEY_IN_FLIGHT] = len(self.responseHandlers)
+        status[ServiceConnection.KEY_QUEUE_DEPTH] = len(self.queue)
+        return status
+
+    def setCloseCallback(self, callback):
+        self.closeCallback = callback
+
+    def closed(self):
+        return self.stream.closed()
+
+    def onClose(self):
+        # Fails every request that is waiting for a response or queued.
+
+        failed = []
+        for timeout, method, errback in self.pending.values():
+            self.ioloop.remove_timeout(timeout)
+            failed.append((errback, method))
+        for callback, errback, method, params in self.queue:
+            failed.append((errback, method))
+
+        self.responseHandlers.clear()
+        self.pending.clear()
+        self.queue.clear()
+
+        self.counters[ServiceConnection.KEY_DROPPED] += len(failed)
+        for errback, method in failed:
+            self.fail(errback, method, Error.CONNECTION_CLOSED)
+
+        if self.closeCallback:
+            self.closeCallback()
+
+
 class JsonRpcServer(TCPServer):
 
     # Extend Tornado TCPServer to act as JSON-RPC server.
@@ -7,7 +7,6 @@ from tornado.ioloop import IOLoop
 
 from client import BetelbotClientConnection
 from config import JsonConfig
-from topic import getTopics
 from util import Client, signalHandler
 
 
@@ -23,8 +22,9 @@ def onTopicPublished(topic, data=None):
 
 
 def main():
-    # Start up a Betelbot client and subscribe to all topics. When data is
-    # received, print to console.
+    # Start up a Betelbot client and subscribe to all topics, including
+    # topics added to the server later. When data is received, print to
+    # console.
     #
     # The main purpose of this script is for logging messages.
 
@@ -35,12 +35,10 @@ def main():
     logger = logging.getLogger('')
     logger.setLevel(cfg.general.logLevel)
 
-    client = Client('', cfg.server.port, BetelbotClientConnection)
+    client = Client('', cfg.server.port, BetelbotClientConnection, **cfg.rpc.dict())
     conn = client.connect()
 
-    topics = getTopics()
-    for topic in topics:
-        conn.subscribe(topic, onTopicPublished)
+    conn.subscribe('*', onTopicPublished)
 
     IOLoop.instance().start()
 
@@ -1,141 +1,315 @@
 #!/usr/bin/env python
 
 import json
+import logging
+import os
 
 import cv2
 import numpy as np
 
 from config import JsonConfig
 
+
+# Order of the directions in the last axis of the distance map
+DISTANCE_MAP_ORDER = ('left', 'down', 'up', 'right')
+
+# Incremental rebuild messages
+LOG_REBUILD = 'Patched {} changed pixels: {} distance map rows, {} columns, {} grid tiles'
+LOG_REBUILD_NO_CHANGES = 'Map unchanged, nothing to rebuild'
+
+
 def loadMap(imageLocation, gridSize):
     # Converts image file to numpy matrix
+    #
+    # The matrix is padded with walls to a multiple of gridSize.
 
     image = cv2.imread(imageLocation, cv2.CV_LOAD_IMAGE_GRAYSCALE)
     rows, cols = image.shape
-    mRows = rows + rows % gridSize
-    mCols = cols + cols % gridSize
+    mRows = rows + (-rows) % gridSize
+    mCols = cols + (-cols) % gridSize
     map = np.zeros([mRows, mCols], dtype=np.uint8)
     map[0:rows, 0:cols] = image
     return map
 
 
+def loadDistanceMap(filepath, mapShape=None, mmap=True):
+    # Loads the distance map lookup table as a (rows, cols, 4) array.
+    #
+    # With mmap the file is memory mapped read-only instead of read into memory.
+    # All services on a host then share the same page cache pages, and loading
+    # takes about the same time regardless of the size of the map.
+    #
+    # Older flat lookup tables are still supported, but need the map shape
+    # to be reshaped. The reshape is a view, so the table is still mapped.
+
+    dmap = np.load(filepath, mmap_mode='r' if mmap else None)
+    if dmap.ndim == 1:
+        rows, cols = mapShape
+        count = len(DISTANCE_MAP_ORDER)
+        dmap = dmap[:rows * cols * count].reshape(rows, cols, count)
+    return dmap
+
+
+def blockReduce(blocked, blockSize):
+    # Reduces a boolean array to blocks of blockSize x blockSize. A block is
+    # True if any value in it is True.
+    #
+    # If the size of the array is not divisible by blockSize, the last row and
+    # column of blocks only partially cover the array. Those blocks are padded
+    # with True, so a partial block is treated as blocked.
+
+    rows, cols = blocked.shape
+    bRows = -(-rows // blockSize)
+    bCols = -(-cols // blockSize)
+    if bRows * blockSize != rows or bCols * blockSize != cols:
+        padded = np.ones([bRows * blockSize, bCols * blockSize], dtype=bool)
+        padded[:rows, :cols] = blocked
+        blocked = padded
+    return blocked.reshape(bRows, blockSize, bCols, blockSize).any(axis=3).any(axis=1)
+
+
+def buildGrids(map, gridSizes, openByte, wallByte):
+    # Scales map matrix down to discrete blocks for each grid size in one pass.
+    # If area has all open bytes, then it will be marked as an open byte.
+    # If area has all at least one wall byte, then it will be marked as a wall byte.
+    #
+    # Grid sizes are processed from smallest to largest. A grid size that is a
+    # multiple of a smaller one is reduced from the smaller grid instead of the
+    # full map, ie. 10/20/40 px grids only scan the map once.
+    #
+    # Returns a dict with the grid size as key.
+
+    blocked = map != openByte
+    grids = {}
+    reduced = {}
+    for gridSize in sorted(set(gridSizes)):
+        source = blocked
+        factor = gridSize
+        for smaller in sorted(reduced, reverse=True):
+            if gridSize % smaller == 0:
+                source = reduced[smaller]
+                factor = gridSize / smaller
+                break
+        reduced[gridSize] = blockReduce(source, factor)
+        grids[gridSize] = np.where(reduced[gridSize], wallByte, openByte).astype(np.uint8)
+    return grids
+
+
 def buildGrid(map, gridSize, openByte, wallByte):
     # Scales map matrix down to discrete blocks specified by gridSize.
     # If area has all open bytes, then it will be marked as an open byte.
     # If area has all at least one wall byte, then it will be marked as a wall byte.
 
-    mRows, mCols = map.shape
-    gRows = mRows / gridSize
-    gCols = mCols / gridSize
-    lookupTable = [(i * gridSize, (i + 1) * gridSize - 1)
-        for i in xrange(gRows if gRows > gCols else gCols)]
-    grid = np.zeros([gRows, gCols], dtype=np.uint8)
-    for i in xrange(gRows):
-        iStart, iEnd = lookupTable[i]
-        for g in xrange(gCols):
-            gStart, gEnd = lookupTable[g]
-            grid[i, g] = wallByte if np.any(map[iStart:iEnd, gStart:gEnd] != openByte) else openByte
-    return grid
-
-
-def calcDistanceMap(map, dMap, wallByte):
-    # Calculates the distance from a pixel to a wall bytes for all pixels in map.
-
-    sIndex = 0
-    cIndex = None
-    ndMap = dMap.copy()
-    walls = np.where(map == wallByte)
-    for i in xrange(len(walls[0])):
-        yIndex = walls[0][i]
-        xIndex = walls[1][i]
-        if yIndex != cIndex:
-            cIndex = yIndex
-            sIndex = 0
-        if map[yIndex][xIndex] == wallByte:
-            stop = xIndex - sIndex
-            if stop == 0:
-                ndMap[cIndex, sIndex] = 0
-            else:
-                ndMap[cIndex, sIndex:xIndex] = np.arange(stop - 1, -1, -1)
-            sIndex = xIndex
-    return ndMap
+    return buildGrids(map, [gridSize], openByte, wallByte)[gridSize]
+
+
+def calcDistanceMap(map, wallByte):
+    # Calculates the distance from a pixel to the next wall byte to the right
+    # for all pixels in map. Rows without a wall to the right of a pixel use the
+    # distance to the edge of the map.
+    #
+    # All rows are processed at once. A reversed running minimum over the wall
+    # columns gives the closest wall at or after each pixel, which is shifted
+    # by one since a wall pixel measures the distance to the next wall.
+
+    rows, cols = map.shape
+    index = np.arange(cols)
+    walls = np.where(map == wallByte, index, cols)
+    nextWall = np.minimum.accumulate(walls[:, ::-1], axis=1)[:, ::-1]
+    afterWall = np.empty_like(nextWall)
+    afterWall[:, :-1] = nextWall[:, 1:]
+    afterWall[:, -1] = cols
+    dMap = (afterWall - 1 - index).astype(np.uint16)
+
+    # A wall in the first column that is the last wall of its row is 0.
+    dMap[(walls[:, 0] == 0) & (afterWall[:, 0] == cols), 0] = 0
+    return dMap
 
 
 def calcDistanceMapRight(map, wallByte):
     # Calculates distance to the right wall of map
 
-    rows, cols = map.shape
-    dMap = np.tile(np.arange(cols, dtype=np.uint16)[::-1], (rows, 1))
-    return calcDistanceMap(map, dMap, wallByte)
+    return calcDistanceMap(map, wallByte)
 
 
 def calcDistanceMapLeft(map, wallByte):
     # Calculates distance to the left wall of map
 
-    rows, cols = map.shape
-    dMap = np.tile(np.arange(cols, dtype=np.uint16), (rows, 1))
-    dMap = calcDistanceMap(np.fliplr(map), np.fliplr(dMap), wallByte)
-    return np.fliplr(dMap)
+    return np.fliplr(calcDistanceMap(np.fliplr(map), wallByte))
 
 
 def calcDistanceMapDown(map, wallByte):
     # Calculates distance to the south wall of map
 
-    rows, cols = map.shape
-    dMap = np.tile(np.arange(rows, dtype=np.uint16)[::-1] , (cols, 1))
-    return calcDistanceMap(map.transpose(), dMap, wallByte).transpose()
+    return calcDistanceMap(map.transpose(), wallByte).transpose()
 
 
 def calcDistanceMapUp(map, wallByte):
     # Calculates distance to the north wall of map
 
-    rows, cols = map.shape
-    dMap = np.tile(np.arange(rows, dtype=np.uint16) , (cols, 1))
-    dMap = calcDistanceMap(np.fliplr(map.transpose()), np.fliplr(dMap), wallByte)
-    return np.fliplr(dMap).transpose()
+    return np.fliplr(calcDistanceMap(np.fliplr(map.transpose()), wallByte)).transpose()
+
+
+def calcDistanceMaps(map, wallByte):
+    # Calculates the distance maps for all directions in DISTANCE_MAP_ORDER.
+
+    return [
+        calcDistanceMapLeft(map, wallByte),
+        calcDistanceMapDown(map, wallByte),
+        calcDistanceMapUp(map, wallByte),
+        calcDistanceMapRight(map, wallByte)
+    ]
 
 
 def mergeDistanceMaps(dmaps):
-    # Merges all distance maps into one large array (left, down, up, right)
+    # Merges all distance maps into one (rows, cols, 4) array (left, down, up, right)
 
-    mapY, mapX = dmaps[0].shape
-    count = len(dmaps)
-    size = dmaps[0].size * count * count
-    data = np.empty([size], np.uint16)
-    cols = 0
-    for y in xrange(mapY):
-        for x in xrange(mapX):
-            for m in dmaps:
-                data[cols] = m[y, x]
-                cols += 1
-    return data
+    return np.ascontiguousarray(np.dstack(dmaps), dtype=np.uint16)
+
+
+def patchGrid(grid, map, changed, gridSize, openByte, wallByte):
+    # Recomputes only the tiles of grid that contain a changed pixel.
+    #
+    # Returns the number of tiles that were recomputed.
+
+    tiles = np.argwhere(blockReduce(changed, gridSize))
+    rows, cols = map.shape
+    for tileY, tileX in tiles:
+        y = tileY * gridSize
+        x = tileX * gridSize
+        tile = map[y:y + gridSize, x:x + gridSize]
+        partial = tile.shape != (gridSize, gridSize)
+        grid[tileY, tileX] = wallByte if partial or np.any(tile != openByte) else openByte
+    return len(tiles)
+
+
+def patchDistanceMap(dmap, map, changed, wallByte):
+    # Recomputes the distance map only where a changed pixel can have an effect.
+    #
+    # Left and right distances only depend on the pixels in the same row, and
+    # down and up distances on the pixels in the same column. So only rows and
+    # columns with a changed pixel are recomputed and written into dmap.
+    #
+    # Returns the number of rows and columns that were recomputed.
+
+    left, down, up, right = [DISTANCE_MAP_ORDER.index(direction)
+        for direction in ('left', 'down', 'up', 'right')]
+
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows):
+        rowMap = map[rows]
+        dmap[rows, :, left] = calcDistanceMapLeft(rowMap, wallByte)
+        dmap[rows, :, right] = calcDistanceMapRight(rowMap, wallByte)
+
+    cols = np.flatnonzero(changed.any(axis=0))
+    if len(cols):
+        colMap = map[:, cols]
+        dmap[:, cols, down] = calcDistanceMapDown(colMap, wallByte)
+        dmap[:, cols, up] = calcDistanceMapUp(colMap, wallByte)
+
+    return len(rows), len(cols)
+
+
+def rebuild(map, mapFile, gridFiles, dmapFile, openByte, wallByte):
+    # Rebuilds the map data incrementally from the previous map.png.
+    #
+    # The new map is diffed against the previous one. Only grid tiles and
+    # distance map rows/columns that a changed pixel can affect are recomputed.
+    # The distance map is patched in place through a writable memory map.
+    #
+    # Grid files are a list of (gridSize, filepath) tuples.
+    #
+    # Returns False if the previous data cannot be patched, ie. it is missing,
+    # the map size changed or the distance map uses the old flat layout.
+
+    filepaths = [mapFile, dmapFile] + [gridFile for gridSize, gridFile in gridFiles]
+    if not all(os.path.exists(filepath) for filepath in filepaths):
+        return False
+
+    previousMap = cv2.imread(mapFile, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    if previousMap is None or previousMap.shape != map.shape:
+        return False
+
+    dmap = np.load(dmapFile, mmap_mode='r+')
+    if dmap.shape != map.shape + (len(DISTANCE_MAP_ORDER),):
+        return False
+
+    grids = []
+    rows, cols = map.shape
+    for gridSize, gridFile in gridFiles:
+        grid = cv2.imread(gridFile, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+        if grid is None or grid.shape != (-(-rows // gridSize), -(-cols // gridSize)):
+            return False
+        grids.append(grid)
+
+    changed = map != previousMap
+    if not changed.any():
+        logging.info(LOG_REBUILD_NO_CHANGES)
+        return True
+
+    tiles = 0
+    for (gridSize, gridFile), grid in zip(gridFiles, grids):
+        tiles += patchGrid(grid, map, changed, gridSize, openByte, wallByte)
+        cv2.imwrite(gridFile, grid)
+
+    patchedRows, patchedCols = patchDistanceMap(dmap, map, changed, wallByte)
+    dmap.flush()
+
+    cv2.imwrite(mapFile, map)
+    logging.info(LOG_REBUILD.format(np.count_nonzero(changed), patchedRows, patchedCols, tiles))
+    return True
+
+
+def gridFilepath(cfg, gridSize):
+    # Returns the grid file for a grid size. The grid of map.gridsize is
+    # mapData.grid, the other sizes of map.gridsizes follow mapData.gridPattern.
+
+    if gridSize == cfg.map.gridsize:
+        return cfg.mapData.grid
+    return cfg.mapData.gridPattern.format(gridSize)
+
+
+def build(map, mapFile, gridFiles, dmapFile, openByte, wallByte):
+    # Builds all map data from scratch.
+    #
+    # Grid files are a list of (gridSize, filepath) tuples.
+
+    cv2.imwrite(mapFile, map)
+
+    grids = buildGrids(map, [gridSize for gridSize, gridFile in gridFiles], openByte, wallByte)
+    for gridSize, gridFile in gridFiles:
+        cv2.imwrite(gridFile, grids[gridSize])
+
+    dmap = mergeDistanceMaps(calcDistanceMaps(map, wallByte))
+    np.save(dmapFile, dmap)
 
 
 def main():
     cfg = JsonConfig()
+
+    logger = logging.getLogger('')
+    logger.setLevel(cfg.general.logLevel)
+
     wallByte = cfg.map.wall
     openByte = cfg.map.open
     gridSize = cfg.map.gridsize
+    gridSizes = cfg.map.gridsizes
     mapImage = cfg.map.image
     mapFile = cfg.mapData.map
     gridFile= cfg.mapData.grid
+    gridPattern = cfg.mapData.gridPattern
     dmapFile = cfg.mapData.dmap
 
     map = loadMap(mapImage, gridSize)
-    cv2.imwrite(mapFile, map)
 
-    grid = buildGrid(map, gridSize, openByte, wallByte)
-    cv2.imwrite(gridFile, grid)
+    gridFiles = [(gridSize, gridFile)]
+    gridFiles += [(size, gridPattern.format(size)) for size in gridSizes]
 
-    dmaps = [
-        calcDistanceMapLeft(map, wallByte),
-        calcDistanceMapDown(map, wallByte),
-        calcDistanceMapUp(map, wallByte),
-        calcDistanceMapRight(map, wallByte)
-    ]
-    dmap = mergeDistanceMaps(dmaps)
-    np.save(dmapFile, dmap)
+    if cfg.map.incremental and rebuild(map, mapFile, gridFiles, dmapFile, openByte, wallByte):
+        return
+
+    build(map, mapFile, gridFiles, dmapFile, openByte, wallByte)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import sys
+import time
+
+import numpy as np
+
+import mapper
+
+from config import JsonConfig
+
+
+# Compares the vectorized distance map pipeline in the mapper module with the
+# original loop based implementation.
+#
+# The benchmark runs on the configured map image and on synthetic maps of
+# random rectangular rooms. Sizes of the synthetic maps can be passed as
+# command line args, ie. ./mapper_benchmark.py 500 1000 2000
+#
+# Both implementations must produce the same distance map. The loop based
+# implementation is slow, so large sizes take minutes.
+
+
+DEFAULT_SIZES = [500, 1000, 2000]
+
+# Result format
+RESULT_FORMAT = '{:<16} {:>12.3f}s {:>12.3f}s {:>10.1f}x {:>6}'
+HEADER_FORMAT = '{:<16} {:>13} {:>13} {:>11} {:>6}'
+
+
+def loopCalcDistanceMap(map, dMap, wallByte):
+    # Original implementation. Walks every wall pixel in a python loop.
+
+    sIndex = 0
+    cIndex = None
+    ndMap = dMap.copy()
+    walls = np.where(map == wallByte)
+    for i in xrange(len(walls[0])):
+        yIndex = walls[0][i]
+        xIndex = walls[1][i]
+        if yIndex != cIndex:
+            cIndex = yIndex
+            sIndex = 0
+        if map[yIndex][xIndex] == wallByte:
+            stop = xIndex - sIndex
+            if stop == 0:
+                ndMap[cIndex, sIndex] = 0
+            else:
+                ndMap[cIndex, sIndex:xIndex] = np.arange(stop - 1, -1, -1)
+            sIndex = xIndex
+    return ndMap
+
+
+def loopCalcDistanceMaps(map, wallByte):
+    # Original implementation of the left, down, up and right distance maps.
+
+    rows, cols = map.shape
+
+    dMap = np.tile(np.arange(cols, dtype=np.uint16), (rows, 1))
+    left = np.fliplr(loopCalcDistanceMap(np.fliplr(map), np.fliplr(dMap), wallByte))
+
+    dMap = np.tile(np.arange(rows, dtype=np.uint16)[::-1] , (cols, 1))
+    down = loopCalcDistanceMap(map.transpose(), dMap, wallByte).transpose()
+
+    dMap = np.tile(np.arange(rows, dtype=np.uint16) , (cols, 1))
+    dMap = loopCalcDistanceMap(np.fliplr(map.transpose()), np.fliplr(dMap), wallByte)
+    up = np.fliplr(dMap).transpose()
+
+    dMap = np.tile(np.arange(cols, dtype=np.uint16)[::-1], (rows, 1))
+    right = loopCalcDistanceMap(map, dMap, wallByte)
+
+    return [left, down, up, right]
+
+
+def loopMergeDistanceMaps(dmaps):
+    # Original implementation. Interleaves the maps one value at a time.
+
+    mapY, mapX = dmaps[0].shape
+    count = len(dmaps)
+    data = np.empty([mapY, mapX, count], np.uint16)
+    for y in xrange(mapY):
+        for x in xrange(mapX):
+            for i in xrange(count):
+                data[y, x, i] = dmaps[i][y, x]
+    return data
+
+
+def makeRoomsMap(size, openByte, wallByte, rooms=None, seed=0):
+    # Creates a square map with an outer wall and random rectangular rooms.
+
+    randomState = np.random.RandomState(seed)
+    rooms = rooms or size / 20
+    map = np.empty([size, size], dtype=np.uint8)
+    map.fill(openByte)
+    map[[0, -1], :] = wallByte
+    map[:, [0, -1]] = wallByte
+    for i in xrange(rooms):
+        y, x = randomState.randint(0, size - 10, 2)
+        height, width = randomState.randint(10, max(11, size / 5), 2)
+        map[y:y + height, [x, min(x + width, size - 1)]] = wallByte
+        map[[y, min(y + height, size - 1)], x:x + width] = wallByte
+    return map
+
+
+def timeIt(func):
+    # Returns the run time of func and its result.
+
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def benchmark(name, map, wallByte):
+    # Runs both implementations on a map and prints the timings.
+
+    loopTime, loopResult = timeIt(
+        lambda: loopMergeDistanceMaps(loopCalcDistanceMaps(map, wallByte)))
+    vectorTime, vectorResult = timeIt(
+        lambda: mapper.mergeDistanceMaps(mapper.calcDistanceMaps(map, wallByte)))
+    same = np.array_equal(loopResult, vectorResult)
+    print RESULT_FORMAT.format(name, loopTime, vectorTime, loopTime / max(vectorTime, 1e-9), str(same))
+    return same
+
+
+def main():
+    cfg = JsonConfig()
+    wallByte = cfg.map.wall
+    openByte = cfg.map.open
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+
+    print HEADER_FORMAT.format('map', 'loop', 'vectorized', 'speedup', 'same')
+
+    map = mapper.loadMap(cfg.map.image, cfg.map.gridsize)
+    benchmark('hallway', map, wallByte)
+
+    for size in sizes:
+        benchmark('rooms {0}x{0}'.format(size), makeRoomsMap(size, openByte, wallByte), wallByte)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@ import os
 import re
 import signal
 import sys
+import time
+from collections import deque
+from fnmatch import fnmatchcase
 from datetime import datetime
 
 from tornado.ioloop import IOLoop
@@ -30,7 +33,7 @@ class BetelbotMethod:
 
     # - Type: Notification
     # - Method: subscribe
-    # - Params: topic
+    # - Params: topics or glob patterns, ie. "*" or "robot_*"
     SUBSCRIBE = 'subscribe'
 
     # - Type: Notification
@@ -49,6 +52,133 @@ class BetelbotMethod:
     # - Response: host, port
     LOCATE = 'locate'
 
+    # - Type: Request
+    # - Method: stats
+    # - Params: None
+    # - Response: fan-out stats for each topic
+    STATS = 'stats'
+
+
+# Characters that make a subscribe param a glob pattern
+PATTERN_CHARS = '*?['
+
+
+def isPattern(name):
+    # Checks if a topic name passed to subscribe is a glob pattern.
+
+    return any(char in name for char in PATTERN_CHARS)
+
+
+def notifySubscribers(data, topic, params, publisher=None):
+    # Sends published params to the subscribers of a topic.
+    #
+    # Data is the shared data of a BetelbotServer. The notification is
+    # encoded once for each codec used by the subscribers. The publisher is
+    # skipped if the server does not echo.
+
+    start = time.time()
+    subscribers = data.topicSubscribers[topic]
+    encoded = {}
+    bytes = 0
+    count = 0
+    for subscriber in subscribers:
+        if subscriber is publisher and not data.echo:
+            continue
+        codec = subscriber.encoder.codec.NAME
+        if codec not in encoded:
+            encoded[codec] = subscriber.encoder.notification(
+                BetelbotMethod.NOTIFYSUB, topic, *params)
+        subscriber.notify(topic, encoded[codec])
+        bytes += len(encoded[codec])
+        count += 1
+    data.topicStats[topic].addPublish(count, bytes, time.time() - start)
+
+    if topic in data.retainTopics:
+        data.retained[topic] = RetainedMessage(topic, params, encoded)
+
+
+class SubscriberPolicy(object):
+    # What to do with a notification for a subscriber whose queue is full.
+    # Set per topic in the server section of the config.
+    #
+    # - DROP_OLDEST drops the oldest queued notification.
+    # - LATEST keeps only the latest queued notification of the topic. Older
+    #   ones are replaced, even if the queue is not full.
+    # - DISCONNECT closes the connection of the subscriber.
+
+    DROP_OLDEST = 'dropOldest'
+    LATEST = 'latest'
+    DISCONNECT = 'disconnect'
+
+    POLICIES = [DROP_OLDEST, LATEST, DISCONNECT]
+
+
+class RetainedMessage(object):
+    # Last data published to a retained topic.
+    #
+    # The notification is kept encoded for each codec, so it is encoded at
+    # most once per codec no matter how many clients subscribe later.
+
+    def __init__(self, topic, data, encoded=None):
+        self.topic = topic
+        self.data = data
+        self.encoded = encoded or {}
+
+    def get(self, encoder):
+        # Returns the notification encoded for the codec of the encoder.
+
+        codec = encoder.codec.NAME
+        if codec not in self.encoded:
+            self.encoded[codec] = encoder.notification(
+                BetelbotMethod.NOTIFYSUB, self.topic, *self.data)
+        return self.encoded[codec]
+
+
+class TopicStats(object):
+    # Fan-out metrics for a topic.
+    #
+    # Write time is the time the master spends encoding a published message
+    # and handing it to the streams of all subscribers. It does not include
+    # the time the kernel takes to send the data.
+
+    # Status keys
+    KEY_SUBSCRIBERS = 'subscribers'
+    KEY_PUBLISHES = 'publishes'
+    KEY_NOTIFICATIONS = 'notifications'
+    KEY_BYTES = 'bytes'
+    KEY_AVG_WRITE_MS = 'avgWriteMs'
+    KEY_MAX_WRITE_MS = 'maxWriteMs'
+    KEY_DROPPED = 'dropped'
+    KEY_DISCONNECTS = 'disconnects'
+
+    def __init__(self):
+        self.publishes = 0
+        self.notifications = 0
+        self.bytes = 0
+        self.writeTime = 0.0
+        self.maxWriteTime = 0.0
+        self.dropped = 0
+        self.disconnects = 0
+
+    def addPublish(self, notifications, bytes, seconds):
+        self.publishes += 1
+        self.notifications += notifications
+        self.bytes += bytes
+        self.writeTime += seconds
+        self.maxWriteTime = max(self.maxWriteTime, seconds)
+
+    def getStatus(self, subscribers):
+        return {
+            TopicStats.KEY_SUBSCRIBERS: subscribers,
+            TopicStats.KEY_PUBLISHES: self.publishes,
+            TopicStats.KEY_NOTIFICATIONS: self.notifications,
+            TopicStats.KEY_BYTES: self.bytes,
+            TopicStats.KEY_AVG_WRITE_MS: self.writeTime * 1000.0 / max(self.publishes, 1),
+            TopicStats.KEY_MAX_WRITE_MS: self.maxWriteTime * 1000.0,
+            TopicStats.KEY_DROPPED: self.dropped,
+            TopicStats.KEY_DISCONNECTS: self.disconnects
+        }
+
 
 class BetelbotServer(JsonRpcServer):
     # Master Betelbot server.
@@ -58,28 +188,90 @@ class BetelbotServer(JsonRpcServer):
     # - Manages publishers/subscribers
     # - Registers service methods
     # - Locates address of registered service methods for clients
+    # - Reports fan-out stats for each topic
+    #
+    # Subscribers of a topic are kept in a set. Each connection also keeps the
+    # set of topics it subscribed to, so a closed connection is removed
+    # without scanning every topic.
+    #
+    # Every subscriber has a queue of at most queueSize notifications, see
+    # SubscriberPolicy for what happens when it is full.
+    #
+    # The last message published to each topic in retainTopics is sent to
+    # new subscribers right away, so they do not wait for the next publish.
+    #
+    # Connections that subscribe with a glob pattern are kept by pattern, so
+    # topics added later with addTopic are matched as well.
+    #
+    # A master can be one of several workers that share a broker, see
+    # broker.py. Publishes and registrations are then forwarded to the broker
+    # connection, and services are located through it.
+    # The broker itself is a master that does not echo publishes back to
+    # the worker that sent them.
 
     # Accepted kwargs params
     PARAM_TOPICS = 'topics'
     PARAM_TOPIC_SUBSCRIBERS = 'topicSubscribers'
+    PARAM_TOPIC_STATS = 'topicStats'
+    PARAM_PATTERN_SUBSCRIBERS = 'patternSubscribers'
     PARAM_SERVICES = 'services'
+    PARAM_QUEUE_SIZE = 'queueSize'
+    PARAM_TOPIC_POLICIES = 'topicPolicies'
+    PARAM_DEFAULT_POLICY = 'defaultPolicy'
+    PARAM_RETAIN_TOPICS = 'retainTopics'
+    PARAM_RETAINED = 'retained'
+    PARAM_ECHO = 'echo'
+    PARAM_BROKER = 'broker'
 
     # Log messages
     LOG_SERVER_RUNNING = 'BetelBot Server is running'
 
+    # Error messages
+    ERROR_POLICY = 'Unknown subscriber policy "{}"'
+
     def onInit(self, **kwargs):
         logging.info(BetelbotServer.LOG_SERVER_RUNNING)
 
         topics = kwargs.get(BetelbotServer.PARAM_TOPICS, getTopics())
-        topicSubscribers = dict((key,[]) for key in topics.keys())
+        topicSubscribers = dict((key, set()) for key in topics.keys())
+        topicStats = dict((key, TopicStats()) for key in topics.keys())
         defaults = {
             BetelbotServer.PARAM_TOPICS: topics,
             BetelbotServer.PARAM_TOPIC_SUBSCRIBERS: topicSubscribers,
-            BetelbotServer.PARAM_SERVICES: {}
+            BetelbotServer.PARAM_TOPIC_STATS: topicStats,
+            BetelbotServer.PARAM_PATTERN_SUBSCRIBERS: {},
+            BetelbotServer.PARAM_SERVICES: {},
+            BetelbotServer.PARAM_QUEUE_SIZE: 100,
+            BetelbotServer.PARAM_TOPIC_POLICIES: {},
+            BetelbotServer.PARAM_DEFAULT_POLICY: SubscriberPolicy.DROP_OLDEST,
+            BetelbotServer.PARAM_RETAIN_TOPICS: [],
+            BetelbotServer.PARAM_RETAINED: {},
+            BetelbotServer.PARAM_ECHO: True,
+            BetelbotServer.PARAM_BROKER: None
         }
         self.data.update(defaults, True)
         self.data.update(kwargs, False)
 
+        for policy in self.data.topicPolicies.values() + [self.data.defaultPolicy]:
+            if policy not in SubscriberPolicy.POLICIES:
+                raise ValueError, BetelbotServer.ERROR_POLICY.format(policy)
+
+    def addTopic(self, topicObj):
+        # Adds a topic after the server started. Connections subscribed to
+        # a matching pattern are subscribed to the new topic.
+
+        topic = topicObj.id
+        if topic in self.data.topics:
+            return
+
+        self.data.topics[topic] = topicObj
+        self.data.topicSubscribers[topic] = set()
+        self.data.topicStats[topic] = TopicStats()
+        for pattern, subscribers in self.data.patternSubscribers.iteritems():
+            if fnmatchcase(topic, pattern):
+                for subscriber in subscribers:
+                    subscriber.addSubscription(topic)
+
 
 class BetelbotConnection(JsonRpcConnection):
     # BetelbotConnection is created when a client connects to the Betelbot server.
@@ -88,26 +280,44 @@ class BetelbotConnection(JsonRpcConnection):
     LOG_NEW_CONNECTION = 'Received a new connection'
     LOG_PUBLISH = 'Publishing to topic "{}"'
     LOG_SUBSCRIBE = 'Subscribing to topic "{}"'
+    LOG_SUBSCRIBE_PATTERN = 'Subscribing to topics matching "{}"'
     LOG_REGISTER = 'Registering service "{}"'
     LOG_LOCATE = 'Locating service "{}"'
     LOG_UNSUBSCRIBE = 'Unsubscribing client from topic "{}"'
+    LOG_STATS = 'Retrieving topic stats'
+    LOG_SLOW_SUBSCRIBER = 'Disconnecting slow subscriber of topic "{}"'
 
     def onInit(self):
         # Initializes BetelbotConnection with method handlers for
         # publish, subscribe, register, locate
         #
         # Adds dictionaries for registered topics and services.
+        #
+        # Subscriptions is the set of topics this connection subscribed to.
+        #
+        # Notifications are written directly while the stream has nothing
+        # left to send. Otherwise they wait in the queue, and are sent as one
+        # batch once the stream is done. Latest maps topics with the LATEST
+        # policy to their queued entry.
 
         self.logInfo(BetelbotConnection.LOG_NEW_CONNECTION)
         self.topics = self.data.topics
         self.topicSubscribers = self.data.topicSubscribers
+        self.topicStats = self.data.topicStats
+        self.patternSubscribers = self.data.patternSubscribers
+        self.retained = self.data.retained
         self.services = self.data.services
+        self.subscriptions = set()
+        self.patterns = set()
+        self.queue = deque()
+        self.latest = {}
 
         self.methodHandlers = {
             BetelbotMethod.PUBLISH: self.handlePublish,
             BetelbotMethod.SUBSCRIBE: self.handleSubscribe,
             BetelbotMethod.REGISTER: self.handleRegister,
-            BetelbotMethod.LOCATE: self.handleLocate
+            BetelbotMethod.LOCATE: self.handleLocate,
+            BetelbotMethod.STATS: self.handleStats
         }
         self.read()
 
@@ -116,6 +326,8 @@ class BetelbotConnection(JsonRpcConnection):
         #
         # Topics are validated for correct data types and then
         # data is sent to subscribers using notifySub operation.
+        #
+        # Publishes are forwarded to the broker if there is one.
 
         params = msg.get(jsonrpc.Key.PARAMS, None)
         if len(params) > 1:
@@ -124,23 +336,43 @@ class BetelbotConnection(JsonRpcConnection):
             topicObj = self.topics.get(topic, None)
             if topicObj and topicObj.isValid(*data):
                 self.logInfo(BetelbotConnection.LOG_PUBLISH.format(topic))
-                subscribers = self.topicSubscribers[topic]
-                msg = self.encoder.notification(BetelbotMethod.NOTIFYSUB, topic, *data)
-                for subscriber in subscribers:
-                    subscriber.write(msg)
+                notifySubscribers(self.data, topic, data, self)
+                if self.data.broker:
+                    self.data.broker.publish(topic, *data)
 
     def handleSubscribe(self, msg):
         # Handles "subscribe" operation.
         #
-        # Subscribers are added to topic list so they can
-        # be notified later.
+        # Params are any number of topics and glob patterns. Subscribers are
+        # added to the topic set so they can be notified later. Subscribing
+        # twice has no effect.
 
         params = msg.get(jsonrpc.Key.PARAMS, None)
-        if len(params) == 1:
-            topic = params[0]
-            if topic in self.topicSubscribers:
-                self.logInfo(BetelbotConnection.LOG_SUBSCRIBE.format(topic))
-                self.topicSubscribers[topic].append(self)
+        for name in params or []:
+            if not isinstance(name, basestring):
+                continue
+
+            if not isPattern(name):
+                self.addSubscription(name)
+            elif name not in self.patterns:
+                self.logInfo(BetelbotConnection.LOG_SUBSCRIBE_PATTERN.format(name))
+                self.patterns.add(name)
+                self.patternSubscribers.setdefault(name, set()).add(self)
+                for topic in self.topicSubscribers.keys():
+                    if fnmatchcase(topic, name):
+                        self.addSubscription(topic)
+
+    def addSubscription(self, topic):
+        # Subscribes this connection to a topic.
+        #
+        # If the topic has a retained message, it is sent immediately.
+
+        if topic in self.topicSubscribers and topic not in self.subscriptions:
+            self.logInfo(BetelbotConnection.LOG_SUBSCRIBE.format(topic))
+            self.topicSubscribers[topic].add(self)
+            self.subscriptions.add(topic)
+            if topic in self.retained:
+                self.notify(topic, self.retained[topic].get(self.encoder))
 
     def handleRegister(self, msg):
         # Handles "register" operation
@@ -149,17 +381,25 @@ class BetelbotConnection(JsonRpcConnection):
         # method, then the host and port will be overwritten.
         #
         # Currently services can't be unregistered, even if the service disconnects
+        #
+        # With a broker, services are only kept by the broker. Otherwise a
+        # worker would keep answering with an address that was registered
+        # again on another worker.
 
         params = msg.get(jsonrpc.Key.PARAMS, None)
         if len(params) == 3:
             method, port, host = params
             self.logInfo(BetelbotConnection.LOG_REGISTER.format(method))
-            self.services[method] = (port, host)
+            if self.data.broker:
+                self.data.broker.register(method, port, host)
+            else:
+                self.services[method] = (port, host)
 
     def handleLocate(self, msg):
         # Handles "locate" operation
         #
-        # The locate operation returns the address of service
+        # The locate operation returns the address of service, or a method
+        # not found error if the service is not registered.
 
         id = msg.get(jsonrpc.Key.ID, None)
         params = msg.get(jsonrpc.Key.PARAMS, None)
@@ -176,24 +416,119 @@ class BetelbotConnection(JsonRpcConnection):
             if method in self.services:
                 port, host = self.services[method]
                 self.write(self.encoder.response(id, port, host))
+            elif self.data.broker:
+                self.data.broker.lookup(lambda result: self.onBrokerLocate(id, result), method)
             else:
-                # Send invalid request
-                pass
+                self.write(self.encoder.error(id, jsonrpc.Error.METHOD_NOT_FOUND))
+
+    def onBrokerLocate(self, id, result):
+        # Responds to a locate request with the address found by the broker.
+        # The address is not kept, since the service can register again
+        # through another worker.
+
+        if self.stream.closed():
+            return
+
+        if result and len(result) == 2:
+            port, host = result
+            self.write(self.encoder.response(id, port, host))
+        else:
+            self.write(self.encoder.error(id, jsonrpc.Error.METHOD_NOT_FOUND))
+
+    def handleStats(self, msg):
+        # Handles "stats" operation
+        #
+        # Responds with the fan-out stats of every topic.
+
+        id = msg.get(jsonrpc.Key.ID, None)
+        if id:
+            self.logInfo(BetelbotConnection.LOG_STATS)
+            self.write(self.encoder.response(id, dict(
+                (topic, stats.getStatus(len(self.topicSubscribers[topic])))
+                for topic, stats in self.topicStats.iteritems())))
+
+    def notify(self, topic, msg):
+        # Sends an encoded notification to this subscriber, or queues it if
+        # the stream is still sending earlier data.
+
+        if self.stream.closed():
+            return
+
+        if not self.queue and not self.stream.writing():
+            self.write(msg)
+            return
+
+        policy = self.data.topicPolicies.get(topic, self.data.defaultPolicy)
+        stats = self.topicStats[topic]
+
+        if policy == SubscriberPolicy.LATEST and topic in self.latest:
+            self.latest[topic][1] = msg
+            stats.dropped += 1
+            return
+
+        if len(self.queue) >= self.data.queueSize:
+            if policy == SubscriberPolicy.DISCONNECT:
+                self.logInfo(BetelbotConnection.LOG_SLOW_SUBSCRIBER.format(topic))
+                stats.disconnects += 1
+                self.close()
+                return
+
+            oldest = self.queue.popleft()
+            if self.latest.get(oldest[0]) is oldest:
+                del self.latest[oldest[0]]
+            self.topicStats[oldest[0]].dropped += 1
+
+        entry = [topic, msg]
+        self.queue.append(entry)
+        if policy == SubscriberPolicy.LATEST:
+            self.latest[topic] = entry
+
+    def flushQueue(self):
+        # Sends the queued notifications as one batch.
+
+        msgs = [msg for topic, msg in self.queue]
+        self.queue.clear()
+        self.latest.clear()
+        self.write(msgs[0] if len(msgs) == 1 else self.encoder.batch(*msgs))
 
     def onWrite(self):
         # After writing completes, need to make sure we start reading again.
         # Calls the read method to make sure.
+        #
+        # Queued notifications are sent once the stream is done writing.
 
+        if self.queue and not self.stream.closed():
+            self.flushQueue()
         self.read()
 
     def onClose(self):
         # When a stream closes its connection, its subscriptions need
         # to be removed.
 
-        for topic in self.topicSubscribers:
-            if self in self.topicSubscribers[topic]:
-                self.logInfo(BetelbotConnection.LOG_UNSUBSCRIBE.format(topic))
-                self.topicSubscribers[topic].remove(self)
+        for topic in self.subscriptions:
+            self.logInfo(BetelbotConnection.LOG_UNSUBSCRIBE.format(topic))
+            self.topicSubscribers[topic].discard(self)
+        self.subscriptions.clear()
+
+        for pattern in self.patterns:
+            self.patternSubscribers[pattern].discard(self)
+            if not self.patternSubscribers[pattern]:
+                del self.patternSubscribers[pattern]
+        self.patterns.clear()
+
+        self.queue.clear()
+        self.latest.clear()
+
+
+def getServerOptions(cfg):
+    # Returns the BetelbotServer kwargs from the server section of the config.
+
+    return {
+        BetelbotServer.PARAM_QUEUE_SIZE: cfg.server.queueSize,
+        BetelbotServer.PARAM_TOPIC_POLICIES: cfg.server.topicPolicies,
+        BetelbotServer.PARAM_DEFAULT_POLICY: cfg.server.defaultPolicy,
+        BetelbotServer.PARAM_RETAIN_TOPICS: cfg.server.retainTopics
+    }
 
 
 def main():
@@ -204,7 +539,8 @@ def main():
     logger = logging.getLogger('')
     logger.setLevel(cfg.general.logLevel)
 
-    server = BetelbotServer(connection=BetelbotConnection, topics=getTopics())
+    server = BetelbotServer(connection=BetelbotConnection, topics=getTopics(),
+        **getServerOptions(cfg))
     server.listen(cfg.server.port)
 
     IOLoop.instance().start()
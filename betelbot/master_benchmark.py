@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from tornado.ioloop import IOLoop
+
+import broker
+
+from config import JsonConfig
+from master import BetelbotConnection, BetelbotMethod, BetelbotServer, getServerOptions
+from topic import getTopics
+
+
+# Measures how many messages per second the master delivers.
+#
+# Publisher processes publish to the location topic and subscriber processes
+# count the notifications they receive. Clients use plain blocking sockets
+# and pre-encoded JSON frames, so they cost less than the master they
+# measure.
+#
+# Publishers send a burst of publishes followed by a stats request, and wait
+# for the response before the next burst. The master handles the messages of
+# a connection in order, so the response means the burst was handled. This
+# keeps publishers from sending faster than the master handles them.
+#
+# Worker counts can be passed as command line args, ie. ./master_benchmark.py 0 2 4
+# Zero runs the single process master. Otherwise the master runs with the
+# broker from broker.py, and per core is per worker plus the broker.
+
+DEFAULT_WORKERS = [0, 2, 4]
+PORT = 18900
+SOCKET_PATH = '/tmp/betelbot_benchmark.sock'
+DURATION = 5.0
+PUBLISHERS = 4
+SUBSCRIBERS = 8
+TOPIC = 'location'
+BURST = 100
+
+# Time for the master to start and for subscriptions to arrive
+STARTUP_DELAY = 1.0
+
+# Result format
+RESULT_FORMAT = '{:<10} {:>12.0f} {:>12.0f} {:>12.0f} {:>10.1%}'
+HEADER_FORMAT = '{:<10} {:>12} {:>12} {:>12} {:>10}'
+
+TERMINATOR = '\0'
+
+
+def encode(method, *params, **kwargs):
+    msg = {'jsonrpc': '2.0', 'method': method, 'params': params}
+    msg.update(kwargs)
+    return json.dumps(msg) + TERMINATOR
+
+
+def runMaster(workers, options):
+    # Starts the master in a new process group and returns its pid.
+
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        logging.getLogger('').setLevel(logging.ERROR)
+        if workers:
+            broker.serve(PORT, SOCKET_PATH, workers, {}, **options)
+        else:
+            server = BetelbotServer(connection=BetelbotConnection, topics=getTopics(), **options)
+            server.listen(PORT)
+            IOLoop.instance().start()
+        os._exit(0)
+    return pid
+
+
+def publish(results):
+    # Publishes until the duration is over and reports the publish count.
+
+    sock = socket.create_connection(('127.0.0.1', PORT))
+    burst = (encode(BetelbotMethod.PUBLISH, TOPIC, 1, 2) * BURST +
+        encode(BetelbotMethod.STATS, id='stats'))
+    count = 0
+    end = time.time() + DURATION
+    while time.time() < end:
+        sock.sendall(burst)
+        data = ''
+        while TERMINATOR not in data:
+            data += sock.recv(1 << 16)
+        count += BURST
+    sock.close()
+    results.put(('publish', count))
+
+
+def countMessages(frame):
+    # Slow subscribers are sent their queued notifications as one batch
+    # frame, so a frame can hold several notifications.
+
+    msg = json.loads(frame)
+    return len(msg) if isinstance(msg, list) else 1
+
+
+def subscribe(results):
+    # Counts notifications until the duration is over.
+
+    sock = socket.create_connection(('127.0.0.1', PORT))
+    sock.sendall(encode(BetelbotMethod.SUBSCRIBE, TOPIC))
+    sock.settimeout(0.1)
+    count = 0
+    data = ''
+    end = time.time() + STARTUP_DELAY + DURATION
+    while time.time() < end:
+        try:
+            data += sock.recv(1 << 16)
+        except socket.timeout:
+            continue
+        frames = data.split(TERMINATOR)
+        data = frames.pop()
+        count += sum(countMessages(frame) for frame in frames)
+    sock.close()
+    results.put(('subscribe', count))
+
+
+def benchmark(workers, options):
+    # Runs the clients against a master and prints messages per second.
+
+    pid = runMaster(workers, options)
+    time.sleep(STARTUP_DELAY)
+
+    results = multiprocessing.Queue()
+    subscribers = [multiprocessing.Process(target=subscribe, args=(results,))
+        for i in xrange(SUBSCRIBERS)]
+    publishers = [multiprocessing.Process(target=publish, args=(results,))
+        for i in xrange(PUBLISHERS)]
+    for process in subscribers:
+        process.start()
+    time.sleep(STARTUP_DELAY)
+    for process in publishers:
+        process.start()
+
+    counts = {'publish': 0, 'subscribe': 0}
+    for i in xrange(SUBSCRIBERS + PUBLISHERS):
+        key, count = results.get()
+        counts[key] += count
+    for process in subscribers + publishers:
+        process.join()
+    os.killpg(pid, signal.SIGTERM)
+
+    published = counts['publish'] / DURATION
+    delivered = counts['subscribe'] / DURATION
+    cores = workers + 1 if workers else 1
+    ratio = delivered / max(published * SUBSCRIBERS, 1)
+    name = '{} workers'.format(workers) if workers else 'single'
+    print RESULT_FORMAT.format(name, published, delivered, delivered / cores, ratio)
+
+
+def main():
+    cfg = JsonConfig()
+    options = getServerOptions(cfg)
+
+    workers = [int(arg) for arg in sys.argv[1:]] or DEFAULT_WORKERS
+
+    print HEADER_FORMAT.format('master', 'published/s', 'delivered/s', 'per core', 'delivered')
+    for count in workers:
+        benchmark(count, options)
+
+
+if __name__ == '__main__':
+    main()
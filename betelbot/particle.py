@@ -2,8 +2,11 @@
 
 import json
 import logging
+import multiprocessing
 import random
 import signal
+import threading
+import time
 
 from math import atan2, cos, exp, pi, cos, sin, sqrt, tan
 
@@ -18,6 +21,8 @@ import jsonrpc
 from client import BetelbotClientConnection
 from config import JsonConfig
 from jsonrpc import JsonRpcServer, JsonRpcConnection
+from mapper import loadDistanceMap
+from resample import KldSampler, Resampler, ResampleStrategy, expNormalize, wheelResample
 from topic.default import ParticleTopic
 from util import Client, signalHandler
 
@@ -69,6 +74,23 @@ def convertToMotion(cmdTopic, start, dest, gridsize):
     return [rotation, gridsize]
 
 
+def gaussianNoise(sigma, N):
+    # Draws N gaussian noise values. Older numpy versions do not accept a
+    # sigma of 0, which turns the noise off.
+
+    if sigma > 0:
+        return np.random.normal(0.0, sigma, N)
+    return np.zeros(N)
+
+
+def addLogWeights(weight, logProb):
+    # Multiplies weights by probabilities given as logs and returns
+    # normalized weights. Particles that already have zero weight stay at zero.
+
+    with np.errstate(divide='ignore'):
+        return expNormalize(np.log(weight) + logProb)
+
+
 class Particle:
     # Represents a single particle in the particle filter.
     # A particle represents the location and orientation of
@@ -184,13 +206,11 @@ class Particle:
         if (self.y >= 0 and self.y < self.grid.shape[0] and
             self.x >= 0 and self.x < self.grid.shape[1] and
             self.grid[self.y][self.x] > 0):
-            count = len(self.delta)
-            index = self.y * self.grid.shape[1] * count + self.x * count
-            for i in xrange(count):
-                value = self.lookupTable[index]
+            distances = self.lookupTable[int(self.y), int(self.x)]
+            for i in xrange(len(self.delta)):
+                value = distances[i]
                 dy = value * self.delta[i][0]
                 dx = value * self.delta[i][1]
-                index += 1
                 dist = dy or dx
                 if hasNoise:
                     dist += random.gauss(0.0, self.senseNoise)
@@ -223,6 +243,57 @@ class Particle:
         return Particle.REPR_STRING % (str(self.y), str(self.x), str(self.orientation))
 
 
+class LikelihoodField(object):
+    # Precomputed measurement model for the particle filter.
+    #
+    # Instead of computing a gaussian for every particle and beam on every
+    # update, two tables are built once:
+    #
+    # - expected: the distance to the wall for every cell and direction.
+    #   This is the (rows, cols, 4) distance map lookup table itself, so a
+    #   memory mapped table stays shared between processes.
+    # - logTable: the log of the gaussian for every integer difference between
+    #   expected and measured distance.
+    #
+    # Weighting a particle becomes a sum of table lookups. Working with log
+    # probabilities also keeps long runs from underflowing to zero. Errors larger
+    # than the table are clipped to the last entry, so a valid cell always gets
+    # a finite log probability. Cells off the map or inside walls get -inf.
+
+    def __init__(self, grid, lookupTable, senseNoise, beams=4):
+        rows, cols = grid.shape
+        self.shape = grid.shape
+        self.beams = beams
+        self.expected = lookupTable
+        self.open = grid > 0
+
+        sigma2 = float(senseNoise) ** 2
+        error = np.arange(max(rows, cols) + 1, dtype=np.float64)
+        self.logTable = -(error ** 2) / sigma2 / 2.0 - 0.5 * np.log(Particle.ANGLE_2PI_RAD * sigma2)
+        self.maxError = len(self.logTable) - 1
+
+    def logProb(self, y, x, measurements):
+        # Log probability of the measurements for particles at y, x.
+        #
+        # Beams without a measurement (None) are ignored.
+
+        rows, cols = self.shape
+        y = np.asarray(y).astype(np.intp)
+        x = np.asarray(x).astype(np.intp)
+        logProb = np.empty(len(y))
+        logProb.fill(-inf)
+
+        valid = (y >= 0) & (y < rows) & (x >= 0) & (x < cols)
+        valid[valid] = self.open[y[valid], x[valid]]
+
+        beams = [i for i in xrange(self.beams) if measurements[i] is not None]
+        Z = np.array([measurements[i] for i in beams], dtype=np.float64)
+        expected = self.expected[y[valid], x[valid]][:, beams].astype(np.int64)
+        error = np.minimum(np.rint(np.abs(expected - Z)), self.maxError).astype(np.intp)
+        logProb[valid] = self.logTable[error].sum(axis=1)
+        return logProb
+
+
 class ParticleFilter:
     # Particle filter creates N random particles.
     #
@@ -233,7 +304,8 @@ class ParticleFilter:
     # The probabilities are weighted and then resampled N times. The particles
     # with a higher weight are more likely to be chosen and survive.
 
-    def __init__(self, length, grid, lookupTable, forwardNoise=0.05, turnNoise=0.05, senseNoise=5, N=500):
+    def __init__(self, length, grid, lookupTable, forwardNoise=0.05, turnNoise=0.05, senseNoise=5, N=500,
+            resampler=None, kldSampler=None, likelihoodField=None):
         self.N = N
         self.length = length
         self.grid = grid
@@ -241,10 +313,18 @@ class ParticleFilter:
         self.forwardNoise = forwardNoise
         self.turnNoise = turnNoise
         self.senseNoise = senseNoise
+        self.resampler = resampler or Resampler(ResampleStrategy.WHEEL, 1.0)
+        self.kldSampler = kldSampler
+        self.likelihoodField = likelihoodField
 
     def makeParticles(self, N=None):
         # Creates N particles with random location and noise values.
+        #
+        # With adaptive sampling the robot is globally lost at this point,
+        # so the max number of particles is used.
 
+        if N is None and self.kldSampler:
+            N = self.kldSampler.maxN
         self.N = self.N if N is None else N
         self.particles = []
         for i in xrange(self.N):
@@ -252,6 +332,7 @@ class ParticleFilter:
             p.randomizePosition()
             p.setNoise(self.forwardNoise, self.turnNoise, self.senseNoise)
             self.particles.append(p)
+        self.weight = np.ones(self.N) / self.N
 
     def getData(self):
         # Returns a list of y,x values for particles.
@@ -261,16 +342,46 @@ class ParticleFilter:
     def update(self, motion, measurements):
         # Updates the particles based on motion and measurement values
         #
-        # Particles are weighted and resambled.
+        # Particles are weighted and resambled. If the resampler skips
+        # resampling, the weights are carried over to the next update.
 
         updatedParticles = []
         for i in xrange(self.N):
             updatedParticles.append(self.particles[i].move(motion))
         self.particles = updatedParticles
-        weight = []
-        for i in range(self.N):
-            weight.append(self.particles[i].measurementProb(measurements))
-        self.particles = self.resample(self.particles, weight, self.N)
+        if self.likelihoodField:
+            y = [p.y for p in self.particles]
+            x = [p.x for p in self.particles]
+            weight = addLogWeights(self.weight, self.likelihoodField.logProb(y, x, measurements))
+        else:
+            weight = []
+            for i in range(self.N):
+                weight.append(self.particles[i].measurementProb(measurements))
+            weight = self.weight * weight
+        index, self.weight = self.resampler.resample(weight, self.sampleSize)
+        if index is not None:
+            self.particles = [self.particles[i] for i in index]
+            self.N = len(self.particles)
+
+    def updateAsync(self, motion, measurements, callback):
+        # Same as update, but the callback is invoked once the update is done.
+        # This filter updates in place, so the callback is invoked right away.
+
+        self.update(motion, measurements)
+        callback()
+
+    def sampleSize(self, weight):
+        # Number of particles to keep after this update. Only changes
+        # if adaptive sampling is enabled. Called by the resampler only
+        # when it resamples.
+
+        total = np.sum(weight)
+        if self.kldSampler is None or not total > 0:
+            return self.N
+        y = np.array([p.y for p in self.particles])
+        x = np.array([p.x for p in self.particles])
+        orientation = np.array([p.orientation for p in self.particles])
+        return self.kldSampler.sampleSize(y, x, orientation, weight / total)
 
     def resample(self, particles, weight, N):
         # Resamples particles. Particles with higher weight have higher probability
@@ -278,17 +389,7 @@ class ParticleFilter:
         #
         # Uses roulette wheel algorithm for resambling.
 
-        sampledParticles = []
-        index = int(random.random() * N)
-        beta = 0.0
-        maxWeight = max(weight)
-        for i in xrange(N):
-            beta += random.random() * 2.0 * maxWeight
-            while beta > weight[index]:
-                beta -= weight[index]
-                index = (index + 1) % N
-            sampledParticles.append(particles[index])
-        return sampledParticles
+        return [particles[i] for i in wheelResample(weight, N)]
 
     def getPosition(self, p):
         # Basically gets the average position (y, x) and orientation of
@@ -305,6 +406,343 @@ class ParticleFilter:
         return [y / len(p), x / len(p), orientation / len(p)]
 
 
+class VectorParticleFilter(object):
+    # Particle filter that stores particles as a struct of arrays.
+    #
+    # Instead of N Particle objects, the y, x and orientation values of all
+    # particles are kept in three contiguous numpy arrays. Motion, sensing,
+    # weighting and resampling are then done as batched array operations.
+    #
+    # The filter follows the same model as ParticleFilter, so the two
+    # can be swapped without changing the RPC contract of the server.
+
+    # Some constants
+    ANGLE_2PI_RAD = Particle.ANGLE_2PI_RAD
+    DIGITS_ROUND = Particle.DIGITS_ROUND
+
+    def __init__(self, length, grid, lookupTable, forwardNoise=0.05, turnNoise=0.05, senseNoise=5, N=500,
+            resampler=None, kldSampler=None, likelihoodField=None):
+        self.N = N
+        self.length = length
+        self.grid = grid
+        self.lookupTable = lookupTable
+        self.forwardNoise = float(forwardNoise)
+        self.turnNoise = float(turnNoise)
+        self.senseNoise = float(senseNoise)
+        self.resampler = resampler or Resampler()
+        self.kldSampler = kldSampler
+        self.likelihoodField = likelihoodField
+        self.beams = len(Particle.DELTA)
+
+        # Flat indexes of open cells. Used to place random particles
+        # without having to retry until an open cell is picked.
+        self.openCells = np.flatnonzero(grid > 0)
+
+        self.y = np.zeros(0)
+        self.x = np.zeros(0)
+        self.orientation = np.zeros(0)
+        self.weight = np.zeros(0)
+
+    def makeParticles(self, N=None):
+        # Creates N particles with random location and orientation.
+        #
+        # With adaptive sampling the max number of particles is used.
+
+        if N is None and self.kldSampler:
+            N = self.kldSampler.maxN
+        self.N = self.N if N is None else N
+        cells = self.openCells[np.random.randint(0, len(self.openCells), self.N)]
+        y, x = np.unravel_index(cells, self.grid.shape)
+        self.y = y.astype(np.float64)
+        self.x = x.astype(np.float64)
+        self.orientation = np.random.random(self.N) * VectorParticleFilter.ANGLE_2PI_RAD
+        self.weight = np.ones(self.N) / self.N
+
+    def getData(self):
+        # Returns a list of y,x values for particles.
+
+        return np.column_stack((self.y, self.x)).tolist()
+
+    def update(self, motion, measurements):
+        # Updates the particles based on motion and measurement values
+        #
+        # Particles are weighted and resambled. If the resampler skips
+        # resampling, the weights are carried over to the next update.
+
+        self.move(motion)
+        weight = addLogWeights(self.weight, self.logMeasurementProb(measurements))
+        self.resample(weight)
+
+    def updateAsync(self, motion, measurements, callback):
+        # Same as update, but the callback is invoked once the update is done.
+        # This filter updates in place, so the callback is invoked right away.
+
+        self.update(motion, measurements)
+        callback()
+
+    def move(self, motion):
+        # Moves all particles at once.
+        #
+        # Same model as Particle.move. Resulting y,x values are rounded
+        # half away from zero to match python's round function.
+
+        turn, forward = motion
+
+        if forward < 0:
+            raise ValueError, Particle.ERROR_MOVE_BACKWARD
+
+        orientation = self.orientation + float(turn) + gaussianNoise(self.turnNoise, self.N)
+        orientation %= VectorParticleFilter.ANGLE_2PI_RAD
+
+        dist = float(forward) + gaussianNoise(self.forwardNoise, self.N)
+        x = self.x + np.round(np.cos(orientation), VectorParticleFilter.DIGITS_ROUND) * dist
+        y = self.y + np.round(np.sin(orientation), VectorParticleFilter.DIGITS_ROUND) * dist
+        y %= self.grid.shape[0]
+        x %= self.grid.shape[1]
+
+        self.y = np.floor(y + 0.5)
+        self.x = np.floor(x + 0.5)
+        self.orientation = orientation
+
+    def sense(self):
+        # Looks up the distances to the 4 walls for every particle.
+        #
+        # Returns an N x 4 array. Particles that are off the map or
+        # inside a wall get infinity for all distances.
+
+        rows, cols = self.grid.shape
+        Z = np.empty((self.N, self.beams))
+        Z.fill(inf)
+
+        y = self.y.astype(np.intp)
+        x = self.x.astype(np.intp)
+        valid = (y >= 0) & (y < rows) & (x >= 0) & (x < cols)
+        valid[valid] = self.grid[y[valid], x[valid]] > 0
+
+        Z[valid] = self.lookupTable[y[valid], x[valid]]
+        return Z
+
+    def measurementProb(self, measurements):
+        # Measures the probability of each particle given the sensor values.
+        #
+        # Beams without a measurement (None) are ignored.
+
+        Z = self.sense()
+        beams = [i for i in xrange(self.beams) if measurements[i] is not None]
+        if not beams:
+            return np.ones(self.N)
+
+        mu = Z[:, beams]
+        x = np.array([measurements[i] for i in beams], dtype=np.float64)
+        sigma2 = self.senseNoise ** 2
+        prob = np.exp(-((mu - x) ** 2) / sigma2 / 2.0) / sqrt(VectorParticleFilter.ANGLE_2PI_RAD * sigma2)
+        return prob.prod(axis=1)
+
+    def logMeasurementProb(self, measurements):
+        # Log probability of each particle given the sensor values. Uses the
+        # likelihood field if there is one.
+
+        if self.likelihoodField:
+            return self.likelihoodField.logProb(self.y, self.x, measurements)
+        with np.errstate(divide='ignore'):
+            return np.log(self.measurementProb(measurements))
+
+    def resample(self, weight):
+        # Resamples particles with probability proportional to their weight.
+        #
+        # With adaptive sampling, the number of particles drawn can differ
+        # from the current N.
+
+        index, self.weight = self.resampler.resample(weight, self.sampleSize)
+        if index is not None:
+            self.y = self.y[index]
+            self.x = self.x[index]
+            self.orientation = self.orientation[index]
+            self.N = len(index)
+
+    def sampleSize(self, weight):
+        # Number of particles to keep after this update. Only changes
+        # if adaptive sampling is enabled. Called by the resampler only
+        # when it resamples.
+
+        total = weight.sum()
+        if self.kldSampler is None or not total > 0:
+            return self.N
+        return self.kldSampler.sampleSize(self.y, self.x, self.orientation, weight / total)
+
+    def getPosition(self):
+        # Basically gets the average position (y, x) and orientation of
+        # all particles.
+
+        orientation = (((self.orientation - self.orientation[0] + pi) % (2.0 * pi))
+            + self.orientation[0] - pi)
+        return [self.y.mean(), self.x.mean(), orientation.mean()]
+
+
+# Filter used by a shard worker process. Set once by initShard when
+# the worker starts.
+shardFilter = None
+
+
+def initShard(particleFilter):
+    # Initializes a shard worker.
+    #
+    # Worker processes are forked, so the map and lookup table referenced by
+    # the filter are shared with the parent process instead of being copied.
+    #
+    # Forked workers start with the same random state, so each one is reseeded.
+
+    global shardFilter
+    shardFilter = particleFilter
+    np.random.seed()
+    random.seed()
+
+
+def updateShard(args):
+    # Moves and weights one shard of particles.
+    #
+    # Returns the moved particles and their log probabilities. Normalizing
+    # and resampling are done by the parent since they need all particles.
+
+    motion, measurements, y, x, orientation = args
+    shardFilter.N = len(y)
+    shardFilter.y = y
+    shardFilter.x = x
+    shardFilter.orientation = orientation
+    shardFilter.move(motion)
+    logProb = shardFilter.logMeasurementProb(measurements)
+    return shardFilter.y, shardFilter.x, shardFilter.orientation, logProb
+
+
+class ShardedParticleFilter(VectorParticleFilter):
+    # Particle filter that splits the particles across a pool of worker processes.
+    #
+    # Each shard moves, senses and weights its particles locally. Only the
+    # normalization and resampling are done globally in this process.
+    #
+    # Updates are asynchronous. The pool runs in the background and the result
+    # is handed back to the IOLoop, so other requests are not blocked while the
+    # shards work. Updates that arrive while one is running are queued.
+
+    # Log messages
+    LOG_SHARD_ERROR = 'Particle filter shard failed: {}'
+
+    def __init__(self, length, grid, lookupTable, forwardNoise=0.05, turnNoise=0.05, senseNoise=5, N=500,
+            resampler=None, kldSampler=None, likelihoodField=None, shards=None, ioloop=None):
+        super(ShardedParticleFilter, self).__init__(length, grid, lookupTable,
+            forwardNoise, turnNoise, senseNoise, N, resampler, kldSampler, likelihoodField)
+
+        self.shards = shards or multiprocessing.cpu_count()
+        self.ioloop = ioloop or IOLoop.instance()
+        self.pending = []
+        self.busy = False
+        self.generation = 0
+
+        worker = VectorParticleFilter(length, grid, lookupTable,
+            forwardNoise, turnNoise, senseNoise, likelihoodField=likelihoodField)
+        self.pool = multiprocessing.Pool(self.shards, initShard, (worker,))
+
+    def makeParticles(self, N=None):
+        # Creates new particles. Updates that are still running or queued
+        # belong to the old particles, so their results are thrown away and
+        # queued updates are dropped. Their callbacks are still invoked, so
+        # every update gets a response.
+
+        self.generation += 1
+        pending = self.pending
+        self.pending = []
+        for motion, measurements, callback in pending:
+            self.ioloop.add_callback(callback)
+        super(ShardedParticleFilter, self).makeParticles(N)
+
+    def update(self, motion, measurements):
+        # Blocking update. Mainly useful for testing.
+
+        args = self.splitShards(motion, measurements)
+        self.mergeShards(self.pool.map(updateShard, args))
+
+    def updateAsync(self, motion, measurements, callback):
+        # Queues an update. The callback is invoked on the IOLoop once
+        # the update is done.
+
+        self.pending.append((motion, measurements, callback))
+        if not self.busy:
+            self.nextUpdate()
+
+    def nextUpdate(self):
+        # Sends the next queued update to the shards.
+
+        if not self.pending:
+            self.busy = False
+            return
+
+        self.busy = True
+        motion, measurements, callback = self.pending.pop(0)
+        generation = self.generation
+        args = self.splitShards(motion, measurements)
+        result = self.pool.map_async(updateShard, args)
+
+        def onShardsDone():
+            # The next update runs even if the callback fails, otherwise
+            # the filter would stay busy and stop handling updates.
+
+            try:
+                shards = result.get()
+                if generation == self.generation:
+                    self.mergeShards(shards)
+            except Exception as e:
+                logging.error(ShardedParticleFilter.LOG_SHARD_ERROR.format(e))
+            try:
+                callback()
+            finally:
+                self.nextUpdate()
+
+        def waitShards():
+            result.wait()
+            self.ioloop.add_callback(onShardsDone)
+
+        # The pool's result callback runs in a helper thread and is not called
+        # at all if a shard fails, so a thread waits for the result instead.
+        thread = threading.Thread(target=waitShards)
+        thread.daemon = True
+        thread.start()
+
+    def splitShards(self, motion, measurements):
+        # Splits the particles into one chunk per shard.
+
+        y = np.array_split(self.y, self.shards)
+        x = np.array_split(self.x, self.shards)
+        orientation = np.array_split(self.orientation, self.shards)
+        return [(motion, measurements, y[i], x[i], orientation[i])
+            for i in xrange(self.shards)]
+
+    def mergeShards(self, shards):
+        # Joins the shards back together, then normalizes and resamples.
+
+        self.y = np.concatenate([shard[0] for shard in shards])
+        self.x = np.concatenate([shard[1] for shard in shards])
+        self.orientation = np.concatenate([shard[2] for shard in shards])
+        logProb = np.concatenate([shard[3] for shard in shards])
+        self.resample(addLogWeights(self.weight, logProb))
+
+    def close(self):
+        # Stops the worker processes.
+
+        self.pool.terminate()
+
+
+class ParticleFilterEngine(object):
+    # Supported particle filter implementations.
+    #
+    # - python: one Particle object per particle.
+    # - numpy: particles stored in arrays and updated in batches.
+    # - sharded: numpy filter split across worker processes.
+
+    PYTHON = 'python'
+    NUMPY = 'numpy'
+    SHARDED = 'sharded'
+
+
 class ParticleFilterMethod(object):
     # Supported Particle filter methods.
 
@@ -312,6 +750,38 @@ class ParticleFilterMethod(object):
     STATUS = 'particles_status'
 
 
+class ParticleFilterStats(object):
+    # Keeps track of the number of particles and update times.
+    #
+    # Returned as part of the particles_status response, so the cost
+    # of the filter can be checked while it runs.
+
+    # Status keys
+    KEY_N = 'N'
+    KEY_UPDATES = 'updates'
+    KEY_LAST_UPDATE_MS = 'lastUpdateMs'
+    KEY_AVG_UPDATE_MS = 'avgUpdateMs'
+
+    def __init__(self):
+        self.updates = 0
+        self.lastUpdateTime = 0.0
+        self.totalUpdateTime = 0.0
+
+    def addUpdate(self, seconds):
+        self.updates += 1
+        self.lastUpdateTime = seconds
+        self.totalUpdateTime += seconds
+
+    def getStatus(self, particleFilter):
+        average = self.totalUpdateTime / self.updates if self.updates else 0.0
+        return {
+            ParticleFilterStats.KEY_N: particleFilter.N,
+            ParticleFilterStats.KEY_UPDATES: self.updates,
+            ParticleFilterStats.KEY_LAST_UPDATE_MS: self.lastUpdateTime * 1000.0,
+            ParticleFilterStats.KEY_AVG_UPDATE_MS: average * 1000.0
+        }
+
+
 class ParticleFilterServer(JsonRpcServer):
 
     # Log messages
@@ -320,13 +790,15 @@ class ParticleFilterServer(JsonRpcServer):
     # Shared connection params
     PARAM_MASTER_CONN= 'masterConn'
     PARAM_PARTICLE= 'particleFilter'
+    PARAM_STATS = 'stats'
 
     def onInit(self, **kwargs):
         logging.info(ParticleFilterServer.LOG_SERVER_RUNNING)
 
         defaults = {
             ParticleFilterServer.PARAM_MASTER_CONN: None,
-            ParticleFilterServer.PARAM_PARTICLE: None
+            ParticleFilterServer.PARAM_PARTICLE: None,
+            ParticleFilterServer.PARAM_STATS: ParticleFilterStats()
         }
         self.data.update(defaults, True)
         self.data.update(kwargs, False)
@@ -352,6 +824,7 @@ class ParticleFilterConnection(JsonRpcConnection):
 
         self.masterConn = self.data.masterConn
         self.particleFilter = self.data.particleFilter
+        self.stats = self.data.stats
         self.particleTopic = ParticleTopic()
 
         self.methodHandlers = {
@@ -377,19 +850,35 @@ class ParticleFilterConnection(JsonRpcConnection):
                 self.logInfo(ParticleFilterConnection.LOG_RESET)
                 self.particleFilter.makeParticles()
             self.logInfo(ParticleFilterConnection.LOG_UPDATE)
-            self.particleFilter.update(motion, measurements)
-            self.sendParticleResponse(id)
+            start = time.time()
+            self.particleFilter.updateAsync(motion, measurements,
+                lambda: self.onUpdateDone(id, start))
+
+    def onUpdateDone(self, id, start):
+        # Invoked once the particle filter has finished updating.
+
+        self.stats.addUpdate(time.time() - start)
+        self.sendParticleResponse(id)
 
     def handleStatus(self, msg):
+        # Handles status requests.
+        #
+        # Besides the particles, the response includes the current number
+        # of particles and update timings.
+
         id = msg.get(jsonrpc.Key.ID, None)
         if id:
             self.logInfo(ParticleFilterConnection.LOG_STATUS)
-            self.sendParticleResponse(id)
+            self.sendParticleResponse(id, self.stats.getStatus(self.particleFilter))
+
+    def sendParticleResponse(self, id, *status):
+        # Particles are still published if the client disconnected while
+        # the update was running.
 
-    def sendParticleResponse(self, id):
         particles = self.particleFilter.getData()
         self.masterConn.publish(self.particleTopic.id, particles)
-        self.write(self.encoder.response(id, particles))
+        if not self.stream.closed():
+            self.write(self.encoder.response(id, particles, *status))
 
 
 def main():
@@ -401,7 +890,7 @@ def main():
     logger.setLevel(cfg.general.logLevel)
 
     map = cv2.imread(cfg.mapData.map, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-    lookupTable = np.load(cfg.mapData.dmap)
+    lookupTable = loadDistanceMap(cfg.mapData.dmap, map.shape, cfg.mapData.mmap)
 
     length = cfg.robot.length
 
@@ -411,12 +900,32 @@ def main():
 
     particleTopic = ParticleTopic()
 
-    particleFilter = ParticleFilter(length, map, lookupTable,
-        forwardNoise, turnNoise, senseNoise)
+    resampler = Resampler(cfg.particle.resampler, cfg.particle.resampleThreshold)
+
+    kldSampler = None
+    if cfg.particle.adaptive:
+        kldSampler = KldSampler(cfg.particle.minN, cfg.particle.maxN,
+            cfg.map.gridsize, error=cfg.particle.kldError, delta=cfg.particle.kldDelta)
+
+    likelihoodField = None
+    if cfg.particle.likelihoodField:
+        likelihoodField = LikelihoodField(map, lookupTable, senseNoise)
+
+    filterArgs = dict(resampler=resampler, kldSampler=kldSampler, likelihoodField=likelihoodField)
+
+    if cfg.particle.engine == ParticleFilterEngine.SHARDED:
+        particleFilter = ShardedParticleFilter(length, map, lookupTable,
+            forwardNoise, turnNoise, senseNoise, shards=cfg.particle.shards, **filterArgs)
+    elif cfg.particle.engine == ParticleFilterEngine.NUMPY:
+        particleFilter = VectorParticleFilter(length, map, lookupTable,
+            forwardNoise, turnNoise, senseNoise, **filterArgs)
+    else:
+        particleFilter = ParticleFilter(length, map, lookupTable,
+            forwardNoise, turnNoise, senseNoise, **filterArgs)
 
     serverPort = cfg.particle.port
 
-    client = Client('', cfg.server.port, BetelbotClientConnection)
+    client = Client('', cfg.server.port, BetelbotClientConnection, **cfg.rpc.dict())
     conn = client.connect()
 
     server = ParticleFilterServer(connection=ParticleFilterConnection,
@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 
+import cPickle
+import hashlib
+import heapq
 import json
 import logging
+import os
 import random
 import signal
 
+from collections import OrderedDict, deque
+
 import cv2
 import numpy as np
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.iostream import IOStream
 from tornado.netutil import TCPServer
 
@@ -17,6 +23,7 @@ import jsonrpc
 from client import BetelbotClientConnection
 from config import JsonConfig
 from jsonrpc import JsonRpcServer, JsonRpcConnection
+from mapper import gridFilepath
 from topic.default import PathTopic, DirectionsTopic, CmdTopic
 from util import Client, signalHandler
 
@@ -44,12 +51,24 @@ def euclideanDistance(x, y, goalX, goalY):
     #
     # Calculates euclidean distance to measure
     # distance from goal.
+    #
+    # The distance is squared, so it can overestimate the remaining cost.
+    # Paths found with it are not guaranteed to be the shortest.
 
     xDist = (x - goalX)
     yDist = (y - goalY)
     return xDist * xDist + yDist * yDist
 
 
+def manhattanDistance(x, y, goalX, goalY):
+    # Heuristic function for A*.
+    #
+    # Never overestimates the remaining cost when moving left,
+    # down, up, right with unit cost, so A* finds the shortest path.
+
+    return abs(x - goalX) + abs(y - goalY)
+
+
 class Pathfinder:
     # Searches for the shortest path given a discrete map.
     #
@@ -63,7 +82,8 @@ class Pathfinder:
     # The result of the search method will return an array of x,y coordinates that
     # lead to the goal.
     #
-    # For now, the cost parameter has no effect and will always be set to 1.
+    # Cells are stored by flat index (y * cols + x) internally, which keeps
+    # the search loop on plain python lists instead of numpy indexing.
 
     # Delta constant represents grid (y,x) movements. Map to left, down, up, right.
     DELTA = [[0, -1],[1, 0],[-1, 0],[0, 1]]
@@ -79,11 +99,48 @@ class Pathfinder:
         # discrete cells. For instance, each 20x20 block in the regular map
         # would be equal to a 1x1 pixel in the grid.
 
-        self.grid = grid
         self.openCell = openCell
         self.heuristic = heuristic or self.noHeuristic
         self.delta = Pathfinder.DELTA
         self.cost = cost
+        self.expanded = 0
+        self.setGrid(grid)
+
+    def setGrid(self, grid):
+        # Sets the grid to search. Open cells are cached as a flat list.
+        #
+        # The version is a hash of the grid contents. It changes whenever a
+        # grid with different contents is set, and is used to invalidate
+        # anything computed from the previous grid.
+
+        self.grid = grid
+        self.passable = (grid == self.openCell).ravel().tolist()
+        self.version = hashlib.md5(np.ascontiguousarray(grid).tostring()).hexdigest()
+
+    def inBounds(self, cell):
+        y, x = cell
+        rows, cols = self.grid.shape
+        return 0 <= y < rows and 0 <= x < cols
+
+    def isOpen(self, cell):
+        # Checks that a y,x cell is on the grid and is not a wall.
+
+        return self.inBounds(cell) and self.passable[cell[0] * self.grid.shape[1] + cell[1]]
+
+    def neighbors(self, index):
+        # Returns flat indexes of the open cells next to a cell, in delta order.
+
+        gridX = self.grid.shape[1]
+        y, x = divmod(index, gridX)
+        neighbors = []
+        for dy, dx in self.delta:
+            y2 = y + dy
+            x2 = x + dx
+            if 0 <= x2 < gridX and 0 <= y2 < self.grid.shape[0]:
+                index2 = y2 * gridX + x2
+                if self.passable[index2]:
+                    neighbors.append(index2)
+        return neighbors
 
     def search(self, start, goal):
         # Search for a path from start to goal.
@@ -93,66 +150,88 @@ class Pathfinder:
         #
         # If no path is found, this method will return False. If one is found,
         # then array of x,y coordinates will be returned.
+        #
+        # Uses a binary heap for the open list. A cell is closed when it is
+        # expanded, and a cheaper path to a cell that is still open replaces
+        # the previous one. Ties in f are broken in insertion order.
 
-        gridY, gridX = self.grid.shape
-        closed = np.zeros(self.grid.shape, bool)
-        expand = np.empty(self.grid.shape)
-        expand.fill(-1)
-
+        gridX = self.grid.shape[1]
         y, x = start
         goalY, goalX = goal
-        g = 0
-        f = g + self.heuristic(x, y, goalY, goalX)
-        open = [[g, y, x, f]]
-        closed[y][x] = True
+        startIndex = y * gridX + x
+        goalIndex = goalY * gridX + goalX
 
-        found = False
-        resign = False
-        count = 0
+        size = len(self.passable)
+        closed = bytearray(size)
+        gScore = [-1] * size
+        parent = [-1] * size
 
-        while not found and not resign:
-            if len(open) == 0:
-                resign = True
-                return False
-            else:
-                open = sorted(open, key=lambda visit: visit[3], reverse=True)
-                next = open.pop()
-                g, y, x, f = next
-                expand[y][x] = count
-                count += 1
-
-                if y == goalY and x == goalX:
-                    found = True
-                else:
-                    for pos in self.delta:
-                        x2 = x + pos[1]
-                        y2 = y + pos[0]
-                        if (x2 >= 0 and x2 < gridX and y2 >= 0 and y2 < gridY and
-                                closed[y2][x2] == False and self.grid[y2][x2] == self.openCell):
-                            g2 = g + self.cost
-                            f = g2 + self.heuristic(x2, y2, goal[1], goal[0])
-                            open.append([g2, y2, x2, f])
-                            closed[y2][x2] = True
-
-        py, px = goal
-        path = [[py, px]]
-        pathFinished = False
-
-        while pathFinished == False:
-            count = expand[py][px]
-            if count == 0:
-                pathFinished = True
-            else:
-                for pos in self.delta:
-                    dx = px + pos[1]
-                    dy = py + pos[0]
-                    if (dx >= 0 and dx < gridX and
-                            dy >= 0 and dy < gridY and
-                            expand[dy][dx] >= 0 and expand[dy][dx] < count):
-                        path.append([dy, dx])
-                        px = dx
-                        py = dy
-                        break
+        gScore[startIndex] = 0
+        count = 0
+        open = [(self.heuristic(x, y, goalX, goalY), count, startIndex)]
+        self.expanded = 0
+
+        while open:
+            f, _, index = heapq.heappop(open)
+            if closed[index]:
+                continue
+            closed[index] = 1
+            self.expanded += 1
+
+            if index == goalIndex:
+                return self.buildPath(parent, index)
+
+            g2 = gScore[index] + self.cost
+            for index2 in self.neighbors(index):
+                if not closed[index2] and (gScore[index2] < 0 or g2 < gScore[index2]):
+                    gScore[index2] = g2
+                    parent[index2] = index
+                    y2, x2 = divmod(index2, gridX)
+                    count += 1
+                    heapq.heappush(open, (g2 + self.heuristic(x2, y2, goalX, goalY), count, index2))
+        return False
+
+    def searchTree(self, start, goals):
+        # Finds the shortest paths from start to several goals with a single
+        # Dijkstra search. Every move has the same cost, so the search is a
+        # breadth-first search that stops once all goals are reached.
+        #
+        # Returns a list with a path for each goal, or False if the goal
+        # cannot be reached.
+
+        gridX = self.grid.shape[1]
+        startIndex = start[0] * gridX + start[1]
+        goalIndexes = [goalY * gridX + goalX for goalY, goalX in goals]
+        remaining = set(goalIndexes)
+
+        parent = [-1] * len(self.passable)
+        visited = bytearray(len(self.passable))
+        visited[startIndex] = 1
+        queue = deque([startIndex])
+        self.expanded = 0
+
+        while queue and remaining:
+            index = queue.popleft()
+            self.expanded += 1
+            remaining.discard(index)
+            for index2 in self.neighbors(index):
+                if not visited[index2]:
+                    visited[index2] = 1
+                    parent[index2] = index
+                    queue.append(index2)
+
+        return [self.buildPath(parent, index) if visited[index] else False
+            for index in goalIndexes]
+
+    def buildPath(self, parent, index):
+        # Follows the parent links from a cell back to the start and
+        # returns the path as a list of [y, x] coordinates.
+
+        gridX = self.grid.shape[1]
+        path = []
+        while index >= 0:
+            path.append(list(divmod(index, gridX)))
+            index = parent[index]
         path.reverse()
         return path
 
@@ -163,6 +242,986 @@ class Pathfinder:
         return 0
 
 
+class JumpPointPathfinder(Pathfinder):
+    # Jump Point Search for 4-connected grids with uniform cost.
+    #
+    # Instead of adding every neighbor to the open list, the search jumps in a
+    # straight line until it reaches a cell where the path could turn: the
+    # goal, or a cell with a forced neighbor next to a wall. Only those jump
+    # points are added to the open list, so open rooms and long hallways are
+    # crossed without expanding the cells in between.
+    #
+    # A vertical jump also stops where a horizontal jump from the cell would
+    # find a jump point. Paths are still the shortest, and the jump points are
+    # filled in so the result has the same format as Pathfinder.search.
+    #
+    # The cost between two jump points is their manhattan distance times the
+    # cost, so a heuristic that never overestimates is needed for the
+    # shortest path.
+    #
+    # The search works on a copy of the grid padded with walls, which removes
+    # the bounds checks from the jump loops. Whether a horizontal jump from a
+    # cell finds a jump point does not depend on the goal, so it is computed
+    # once per grid.
+
+    def setGrid(self, grid):
+        # Sets the grid to search and builds the padded grid and the
+        # horizontal jump tables.
+
+        Pathfinder.setGrid(self, grid)
+
+        rows, cols = grid.shape
+        padded = np.zeros([rows + 2, cols + 2], dtype=np.bool_)
+        padded[1:-1, 1:-1] = grid == self.openCell
+        self.paddedX = cols + 2
+        self.padded = padded.ravel().tolist()
+
+        # Cells in the same horizontal run of open cells share a run id.
+        # A horizontal jump from a cell reaches every cell in its run.
+        self.run = [-1] * len(self.padded)
+
+        # True if a horizontal jump from the cell finds a jump point.
+        self.horizontalJump = [False] * len(self.padded)
+
+        passable = self.padded
+        gridX = self.paddedX
+        for y in xrange(1, rows + 1):
+            rowStart = y * gridX
+            for step in [1, -1]:
+                cells = range(rowStart + 1, rowStart + cols + 1)
+                if step == 1:
+                    cells.reverse()
+                found = False
+                for index in cells:
+                    if not passable[index]:
+                        found = False
+                        continue
+                    if found:
+                        self.horizontalJump[index] = True
+                    if self.isForced(index, step, gridX):
+                        found = True
+            run = -1
+            for index in xrange(rowStart + 1, rowStart + cols + 1):
+                if passable[index]:
+                    if run < 0:
+                        run = index
+                    self.run[index] = run
+                else:
+                    run = -1
+
+    def search(self, start, goal):
+        # Search for a path from start to goal with jump points.
+        #
+        # Returns False if no path is found, else an array of y,x coordinates
+        # that includes every cell along the path.
+
+        gridX = self.paddedX
+        y, x = start
+        goalY, goalX = goal
+        startIndex = (y + 1) * gridX + x + 1
+        goalIndex = (goalY + 1) * gridX + goalX + 1
+
+        size = len(self.padded)
+        closed = bytearray(size)
+        gScore = [-1] * size
+        parent = [-1] * size
+
+        gScore[startIndex] = 0
+        count = 0
+        open = [(self.heuristic(x, y, goalX, goalY), count, startIndex)]
+        self.expanded = 0
+
+        while open:
+            f, _, index = heapq.heappop(open)
+            if closed[index]:
+                continue
+            closed[index] = 1
+            self.expanded += 1
+
+            if index == goalIndex:
+                return self.buildJumpPath(parent, index)
+
+            y, x = divmod(index, gridX)
+            for step in self.directions(index, parent[index]):
+                index2 = self.jump(index, step, goalIndex)
+                if index2 < 0 or closed[index2]:
+                    continue
+                y2, x2 = divmod(index2, gridX)
+                g2 = gScore[index] + (abs(y2 - y) + abs(x2 - x)) * self.cost
+                if gScore[index2] < 0 or g2 < gScore[index2]:
+                    gScore[index2] = g2
+                    parent[index2] = index
+                    count += 1
+                    heapq.heappush(open, (g2 + self.heuristic(x2 - 1, y2 - 1, goalX, goalY), count, index2))
+        return False
+
+    def directions(self, index, parentIndex):
+        # Returns the steps to jump with from a cell, as flat index offsets.
+        #
+        # The start cell jumps in every direction. Other cells continue in the
+        # direction they were reached from, or turn to either side. Turning
+        # back is never needed.
+
+        gridX = self.paddedX
+        if parentIndex < 0:
+            return [-1, gridX, -gridX, 1]
+        if parentIndex // gridX == index // gridX:
+            return [-gridX, gridX, cmp(index, parentIndex)]
+        return [-1, 1, cmp(index, parentIndex) * gridX]
+
+    def isForced(self, index, step, side):
+        # True if a cell reached with step has an open cell to one side that
+        # is blocked when reached from the previous cell.
+
+        passable = self.padded
+        return ((passable[index - side] and not passable[index - side - step]) or
+            (passable[index + side] and not passable[index + side - step]))
+
+    def jump(self, index, step, goalIndex):
+        # Moves from a cell in a straight line until a jump point is found.
+        #
+        # Returns the flat index of the jump point, or -1 if a wall is
+        # reached first.
+
+        passable = self.padded
+        gridX = self.paddedX
+        horizontal = step == 1 or step == -1
+        side = gridX if horizontal else 1
+        goalRun = self.run[goalIndex]
+        while True:
+            index += step
+            if not passable[index]:
+                return -1
+            if index == goalIndex:
+                return index
+            if ((passable[index - side] and not passable[index - side - step]) or
+                    (passable[index + side] and not passable[index + side - step])):
+                return index
+            if not horizontal and (self.horizontalJump[index] or self.run[index] == goalRun):
+                return index
+
+    def buildJumpPath(self, parent, index):
+        # Follows the parent links from the goal back to the start and adds
+        # the cells between consecutive jump points. Jump points are always on
+        # the same row or column.
+
+        gridX = self.paddedX
+        path = []
+        while parent[index] >= 0:
+            parentIndex = parent[index]
+            step = cmp(parentIndex, index)
+            if abs(parentIndex - index) >= gridX:
+                step *= gridX
+            while index != parentIndex:
+                path.append(index)
+                index += step
+        path.append(index)
+        path.reverse()
+        return [[y - 1, x - 1] for y, x in (divmod(index, gridX) for index in path)]
+
+
+class HierarchicalPathfinder(Pathfinder):
+    # Hierarchical pathfinding (HPA*) for large grids.
+    #
+    # The grid is split into square clusters. Where two neighboring clusters
+    # have open cells across their border, an entrance is added with one or
+    # two transition cells on each side. The transition cells are the nodes
+    # of an abstract graph. Nodes in the same cluster are connected by their
+    # distance inside the cluster, and the two sides of a transition are
+    # connected with a single step.
+    #
+    # A search connects start and goal to the nodes of their clusters, runs
+    # A* on the small abstract graph, and then refines each abstract edge with
+    # a search inside one cluster.
+    #
+    # Paths are close to the shortest, but not guaranteed to be the shortest.
+    #
+    # Building the abstract graph takes a search per node, so the graph is
+    # saved to a file keyed by grid version and cluster size, and loaded
+    # again on restart.
+
+    # Keys in the saved file
+    KEY_VERSION = 'version'
+    KEY_CLUSTER_SIZE = 'clusterSize'
+    KEY_GRAPH = 'graph'
+    KEY_CLUSTER_NODES = 'clusterNodes'
+
+    # Entrances at least this wide get a transition at each end,
+    # narrower ones get one in the middle.
+    WIDE_ENTRANCE = 6
+
+    # Log messages
+    LOG_BUILD = 'Building abstract graph with cluster size {}'
+    LOG_LOAD = 'Loaded abstract graph from "{}"'
+    LOG_SAVE = 'Saving abstract graph to "{}"'
+
+    def __init__(self, grid, openCell, heuristic=None, cost=1, clusterSize=10, filepath=None):
+        self.clusterSize = clusterSize
+        self.filepath = filepath
+        Pathfinder.__init__(self, grid, openCell, heuristic, cost)
+
+    def setGrid(self, grid):
+        # Sets the grid to search. The abstract graph is loaded from file if
+        # it matches the grid, else it is built and saved.
+
+        Pathfinder.setGrid(self, grid)
+        if not self.loadGraph():
+            self.buildGraph()
+            self.saveGraph()
+
+    def getCluster(self, index):
+        # Returns the (row, col) of the cluster that contains a cell.
+
+        y, x = divmod(index, self.grid.shape[1])
+        return (y // self.clusterSize, x // self.clusterSize)
+
+    def buildGraph(self):
+        # Finds the entrances between clusters and the distances between
+        # the nodes of each cluster.
+
+        logging.info(HierarchicalPathfinder.LOG_BUILD.format(self.clusterSize))
+
+        rows, cols = self.grid.shape
+        size = self.clusterSize
+        self.graph = {}
+        self.clusterNodes = {}
+
+        for y in xrange(size, rows, size):
+            self.addEntrances([(y - 1) * cols + x for x in xrange(cols)], cols)
+        for x in xrange(size, cols, size):
+            self.addEntrances([y * cols + x - 1 for y in xrange(rows)], 1)
+
+        for cluster, nodes in self.clusterNodes.iteritems():
+            for node in nodes:
+                distance = self.clusterSearch(node)[0]
+                for node2 in nodes:
+                    if node2 != node and node2 in distance:
+                        self.graph[node][node2] = distance[node2] * self.cost
+
+    def addEntrances(self, border, step):
+        # Adds the entrances along one border line between clusters.
+        #
+        # The border is a list of cells on the near side of the line, and step
+        # is the offset to the matching cell on the far side. A run of open
+        # pairs is split where it crosses into the next cluster.
+
+        passable = self.passable
+        run = []
+        for index in border + [None]:
+            if (index is not None and passable[index] and passable[index + step] and
+                    (not run or self.getCluster(index) == self.getCluster(run[0]))):
+                run.append(index)
+                continue
+
+            if len(run) >= HierarchicalPathfinder.WIDE_ENTRANCE:
+                transitions = [run[0], run[-1]]
+            elif run:
+                transitions = [run[len(run) // 2]]
+            else:
+                transitions = []
+            for transition in transitions:
+                self.addNode(transition)
+                self.addNode(transition + step)
+                self.graph[transition][transition + step] = self.cost
+                self.graph[transition + step][transition] = self.cost
+
+            run = [index] if index is not None and passable[index] and passable[index + step] else []
+
+    def addNode(self, index):
+        if index not in self.graph:
+            self.graph[index] = {}
+            self.clusterNodes.setdefault(self.getCluster(index), []).append(index)
+
+    def clusterSearch(self, startIndex, goalIndex=None):
+        # Breadth-first search that stays inside the cluster of the start
+        # cell. Stops early once the goal is reached.
+        #
+        # Returns the distance and parent of every cell that was reached.
+
+        cluster = self.getCluster(startIndex)
+        distance = {startIndex: 0}
+        parent = {startIndex: -1}
+        queue = deque([startIndex])
+        while queue:
+            index = queue.popleft()
+            self.expanded += 1
+            if index == goalIndex:
+                break
+            for index2 in self.neighbors(index):
+                if index2 not in distance and self.getCluster(index2) == cluster:
+                    distance[index2] = distance[index] + 1
+                    parent[index2] = index
+                    queue.append(index2)
+        return distance, parent
+
+    def clusterPath(self, startIndex, goalIndex):
+        # Returns the flat indexes of the path inside a cluster, or None if
+        # the goal cannot be reached without leaving the cluster.
+
+        parent = self.clusterSearch(startIndex, goalIndex)[1]
+        if goalIndex not in parent:
+            return None
+        path = []
+        index = goalIndex
+        while index >= 0:
+            path.append(index)
+            index = parent[index]
+        path.reverse()
+        return path
+
+    def search(self, start, goal):
+        # Search for a path from start to goal on the abstract graph.
+        #
+        # Returns False if no path is found, else an array of y,x coordinates
+        # that includes every cell along the path.
+
+        gridX = self.grid.shape[1]
+        startIndex = start[0] * gridX + start[1]
+        goalIndex = goal[0] * gridX + goal[1]
+        self.expanded = 0
+
+        if not self.passable[startIndex] or not self.passable[goalIndex]:
+            return False
+
+        if self.getCluster(startIndex) == self.getCluster(goalIndex):
+            path = self.clusterPath(startIndex, goalIndex)
+            if path:
+                return [list(divmod(index, gridX)) for index in path]
+
+        abstractPath = self.abstractSearch(startIndex, goalIndex)
+        if not abstractPath:
+            return False
+
+        path = [startIndex]
+        for index in abstractPath[1:]:
+            if self.getCluster(index) == self.getCluster(path[-1]):
+                path.extend(self.clusterPath(path[-1], index)[1:])
+            else:
+                path.append(index)
+        return [list(divmod(index, gridX)) for index in path]
+
+    def abstractSearch(self, startIndex, goalIndex):
+        # A* over the abstract graph with start and goal connected to the
+        # nodes of their clusters. Returns a list of node indexes.
+
+        gridX = self.grid.shape[1]
+        goalY, goalX = divmod(goalIndex, gridX)
+
+        startEdges = self.clusterEdges(startIndex)
+        goalEdges = self.clusterEdges(goalIndex)
+
+        gScore = {startIndex: 0}
+        parent = {startIndex: -1}
+        closed = set()
+        count = 0
+        y, x = divmod(startIndex, gridX)
+        open = [(self.heuristic(x, y, goalX, goalY), count, startIndex)]
+
+        while open:
+            f, _, index = heapq.heappop(open)
+            if index in closed:
+                continue
+            closed.add(index)
+
+            if index == goalIndex:
+                path = []
+                while index >= 0:
+                    path.append(index)
+                    index = parent[index]
+                path.reverse()
+                return path
+
+            edges = self.graph.get(index, {}).items()
+            if index == startIndex:
+                edges += startEdges.items()
+            if index in goalEdges:
+                edges.append((goalIndex, goalEdges[index]))
+
+            for index2, cost in edges:
+                g2 = gScore[index] + cost
+                if index2 not in closed and (index2 not in gScore or g2 < gScore[index2]):
+                    gScore[index2] = g2
+                    parent[index2] = index
+                    y2, x2 = divmod(index2, gridX)
+                    count += 1
+                    heapq.heappush(open, (g2 + self.heuristic(x2, y2, goalX, goalY), count, index2))
+        return None
+
+    def clusterEdges(self, index):
+        # Returns the cost from a cell to each node it can reach in its cluster.
+
+        distance = self.clusterSearch(index)[0]
+        nodes = self.clusterNodes.get(self.getCluster(index), [])
+        return dict((node, distance[node] * self.cost) for node in nodes if node in distance)
+
+    def saveGraph(self):
+        if not self.filepath:
+            return
+        logging.info(HierarchicalPathfinder.LOG_SAVE.format(self.filepath))
+        with open(self.filepath, 'wb') as f:
+            cPickle.dump({
+                HierarchicalPathfinder.KEY_VERSION: self.version,
+                HierarchicalPathfinder.KEY_CLUSTER_SIZE: self.clusterSize,
+                HierarchicalPathfinder.KEY_GRAPH: self.graph,
+                HierarchicalPathfinder.KEY_CLUSTER_NODES: self.clusterNodes
+            }, f, cPickle.HIGHEST_PROTOCOL)
+
+    def loadGraph(self):
+        # Loads the saved graph. Returns False if there is no saved graph for
+        # the current grid and cluster size.
+
+        if not self.filepath or not os.path.exists(self.filepath):
+            return False
+        with open(self.filepath, 'rb') as f:
+            data = cPickle.load(f)
+        if (data[HierarchicalPathfinder.KEY_VERSION] != self.version or
+                data[HierarchicalPathfinder.KEY_CLUSTER_SIZE] != self.clusterSize):
+            return False
+        self.graph = data[HierarchicalPathfinder.KEY_GRAPH]
+        self.clusterNodes = data[HierarchicalPathfinder.KEY_CLUSTER_NODES]
+        logging.info(HierarchicalPathfinder.LOG_LOAD.format(self.filepath))
+        return True
+
+
+def hierarchyFilepath(gridFile):
+    # The abstract graph is saved next to the grid it was built from.
+
+    return os.path.splitext(gridFile)[0] + '_hpa.pickle'
+
+
+class PathfinderStrategy(object):
+    # Search strategies for the pathfinder server. Set in the pathfinder
+    # section of the config.
+
+    ASTAR = 'astar'
+    JUMP_POINT = 'jps'
+    HIERARCHICAL = 'hpa'
+
+    PATHFINDERS = {
+        ASTAR: Pathfinder,
+        JUMP_POINT: JumpPointPathfinder,
+        HIERARCHICAL: HierarchicalPathfinder
+    }
+
+    # Error messages
+    ERROR_STRATEGY = 'Unknown pathfinder strategy "{}"'
+
+    @staticmethod
+    def create(strategy, grid, openCell, heuristic=None, cost=1, **options):
+        # Returns a pathfinder that searches with the given strategy.
+        #
+        # Options are passed on to pathfinders that take extra settings.
+
+        if strategy not in PathfinderStrategy.PATHFINDERS:
+            raise ValueError, PathfinderStrategy.ERROR_STRATEGY.format(strategy)
+        return PathfinderStrategy.PATHFINDERS[strategy](grid, openCell, heuristic, cost, **options)
+
+
+class DistanceFieldStore(object):
+    # Precomputed distance fields for frequently used goals.
+    #
+    # A distance field holds the number of moves from every cell to a goal.
+    # It is computed once with a breadth-first search from the goal. A path
+    # from any start cell is then found by moving to a neighbor that is one
+    # step closer until the goal is reached, which is O(path length).
+    #
+    # Fields are saved to a file next to the grid, so they only need to be
+    # computed again when the grid changes. Fields for an old grid version are
+    # dropped and recomputed the next time their goal is used, or right away
+    # with refresh when the grid is reloaded. Goals that are no longer open
+    # cells are unregistered.
+
+    # Unreachable cells
+    UNREACHABLE = -1
+
+    # Keys in the saved file
+    KEY_VERSION = 'version'
+    KEY_GOALS = 'goals'
+    KEY_FIELDS = 'fields'
+
+    # Log messages
+    LOG_COMPUTE = 'Computing distance field for goal ({0},{1})'
+    LOG_GOAL_CLOSED = 'Goal ({0},{1}) is no longer an open cell, unregistering'
+    LOG_SAVE = 'Saving distance fields to "{}"'
+    LOG_LOAD = 'Loaded {} distance fields from "{}"'
+
+    def __init__(self, pathfinder, filepath=None):
+        self.pathfinder = pathfinder
+        self.filepath = filepath
+        self.goals = []
+        self.fields = {}
+        self.version = pathfinder.version
+
+    def register(self, goal, save=True):
+        # Registers a goal and computes its distance field.
+        #
+        # Returns False if the goal is not an open cell.
+
+        goal = tuple(goal)
+        if not self.isOpen(goal):
+            return False
+        if goal not in self.goals:
+            self.goals.append(goal)
+        self.getField(goal)
+        if save:
+            self.save()
+        return True
+
+    def warmUp(self, goals):
+        # Loads saved fields and computes the fields that are missing.
+
+        self.load()
+        for goal in goals:
+            self.register(goal, False)
+        self.save()
+
+    def refresh(self):
+        # Recomputes and saves the fields for the current grid. Called when
+        # the grid is reloaded.
+
+        self.checkVersion()
+        for goal in self.goals:
+            self.getField(goal)
+        self.save()
+
+    def checkVersion(self):
+        # Drops all fields if the grid changed, along with the goals that
+        # are not open anymore.
+
+        if self.version == self.pathfinder.version:
+            return
+
+        self.fields.clear()
+        self.version = self.pathfinder.version
+        for goal in self.goals:
+            if not self.isOpen(goal):
+                logging.info(DistanceFieldStore.LOG_GOAL_CLOSED.format(*goal))
+        self.goals = [goal for goal in self.goals if self.isOpen(goal)]
+
+    def isOpen(self, cell):
+        return self.pathfinder.isOpen(cell)
+
+    def hasGoal(self, goal):
+        self.checkVersion()
+        return tuple(goal) in self.goals
+
+    def getField(self, goal):
+        # Returns the distance field of a registered goal. The field is
+        # recomputed if the grid changed.
+
+        self.checkVersion()
+        if goal not in self.fields:
+            logging.info(DistanceFieldStore.LOG_COMPUTE.format(*goal))
+            self.fields[goal] = self.compute(goal)
+        return self.fields[goal]
+
+    def compute(self, goal):
+        # Breadth-first search from the goal over open cells.
+
+        cols = self.pathfinder.grid.shape[1]
+        goalIndex = goal[0] * cols + goal[1]
+        distance = [DistanceFieldStore.UNREACHABLE] * len(self.pathfinder.passable)
+        distance[goalIndex] = 0
+        queue = deque([goalIndex])
+        while queue:
+            index = queue.popleft()
+            d = distance[index] + 1
+            for index2 in self.pathfinder.neighbors(index):
+                if distance[index2] < 0:
+                    distance[index2] = d
+                    queue.append(index2)
+        return distance
+
+    def path(self, start, goal):
+        # Follows the distance field from start down to the goal.
+        #
+        # Returns a list of [y, x] coordinates, or False if the goal cannot be
+        # reached from start. The goal must be registered.
+
+        goal = tuple(goal)
+        distance = self.getField(goal)
+        cols = self.pathfinder.grid.shape[1]
+        index = start[0] * cols + start[1]
+        if not self.isOpen(start) or distance[index] < 0:
+            return False
+
+        path = [list(divmod(index, cols))]
+        while distance[index] > 0:
+            for index2 in self.pathfinder.neighbors(index):
+                if distance[index2] == distance[index] - 1:
+                    index = index2
+                    break
+            path.append(list(divmod(index, cols)))
+        return path
+
+    def save(self):
+        # Saves the fields of the current grid version.
+
+        if not self.filepath:
+            return
+        goals = [goal for goal in self.goals if goal in self.fields]
+        logging.info(DistanceFieldStore.LOG_SAVE.format(self.filepath))
+        np.savez(self.filepath, **{
+            DistanceFieldStore.KEY_VERSION: np.array(self.version),
+            DistanceFieldStore.KEY_GOALS: np.array(goals, dtype=np.int32).reshape(-1, 2),
+            DistanceFieldStore.KEY_FIELDS: np.array([self.fields[goal] for goal in goals],
+                dtype=np.int32).reshape(len(goals), -1)
+        })
+
+    def load(self):
+        # Loads saved fields if they were computed for the current grid.
+
+        if not self.filepath or not os.path.exists(self.filepath):
+            return
+        data = np.load(self.filepath)
+        if str(data[DistanceFieldStore.KEY_VERSION]) != self.pathfinder.version:
+            return
+        self.version = self.pathfinder.version
+        fields = data[DistanceFieldStore.KEY_FIELDS]
+        for i, goal in enumerate(data[DistanceFieldStore.KEY_GOALS].tolist()):
+            goal = tuple(goal)
+            if goal not in self.goals:
+                self.goals.append(goal)
+            self.fields[goal] = fields[i].tolist()
+        logging.info(DistanceFieldStore.LOG_LOAD.format(len(self.fields), self.filepath))
+
+
+class DStarLite(object):
+    # Incremental planner (D* Lite, Koenig and Likhachev, 2002) for one goal.
+    #
+    # The search runs backwards from the goal, so the costs it finds stay
+    # valid when the start moves. The search state is kept between calls to
+    # plan. After the robot moves or a few cells are blocked, only the cells
+    # whose cost changed are expanded again, instead of searching the whole
+    # grid.
+    #
+    # Cells blocked with plan are only blocked for this planner. The grid of
+    # the pathfinder is not changed. Each plan gives the full set of blocked
+    # cells, so cells left out are open again. Planners are shared by all
+    # callers, and an obstacle seen by one robot does not stay in the paths
+    # of another.
+    #
+    # The manhattan distance is used as heuristic since D* Lite needs one that
+    # never overestimates.
+
+    INFINITY = float('inf')
+
+    def __init__(self, pathfinder, goal):
+        self.pathfinder = pathfinder
+        self.version = pathfinder.version
+        self.rows, self.cols = pathfinder.grid.shape
+        self.passable = list(pathfinder.passable)
+        self.blocked = set()
+        self.goalIndex = goal[0] * self.cols + goal[1]
+
+        size = len(self.passable)
+        self.g = [DStarLite.INFINITY] * size
+        self.rhs = [DStarLite.INFINITY] * size
+        self.rhs[self.goalIndex] = 0
+
+        # The open list is a heap with lazy deletion. A heap entry is only
+        # valid if its key matches the key of the cell in queued.
+        self.open = []
+        self.queued = {}
+        self.km = 0
+        self.startIndex = None
+        self.expanded = 0
+        self.push(self.goalIndex, (self.heuristic(self.goalIndex, self.goalIndex), 0))
+
+    def heuristic(self, index, index2):
+        y, x = divmod(index, self.cols)
+        y2, x2 = divmod(index2, self.cols)
+        return abs(y - y2) + abs(x - x2)
+
+    def neighbors(self, index):
+        # Returns the flat indexes of all cells next to a cell, open or not.
+
+        y, x = divmod(index, self.cols)
+        neighbors = []
+        for dy, dx in Pathfinder.DELTA:
+            y2 = y + dy
+            x2 = x + dx
+            if 0 <= x2 < self.cols and 0 <= y2 < self.rows:
+                neighbors.append(y2 * self.cols + x2)
+        return neighbors
+
+    def calculateKey(self, index):
+        cost = min(self.g[index], self.rhs[index])
+        return (cost + self.heuristic(self.startIndex, index) + self.km, cost)
+
+    def push(self, index, key):
+        self.queued[index] = key
+        heapq.heappush(self.open, (key, index))
+
+    def top(self):
+        # Returns the first valid heap entry, dropping stale ones.
+
+        while self.open:
+            key, index = self.open[0]
+            if self.queued.get(index) == key:
+                return key, index
+            heapq.heappop(self.open)
+        return None, None
+
+    def updateVertex(self, index):
+        if index != self.goalIndex:
+            rhs = DStarLite.INFINITY
+            if self.passable[index]:
+                for index2 in self.neighbors(index):
+                    if self.passable[index2] and self.g[index2] + 1 < rhs:
+                        rhs = self.g[index2] + 1
+            self.rhs[index] = rhs
+
+        self.queued.pop(index, None)
+        if self.g[index] != self.rhs[index]:
+            self.push(index, self.calculateKey(index))
+
+    def computeShortestPath(self):
+        startIndex = self.startIndex
+        while True:
+            key, index = self.top()
+            if index is None or (key >= self.calculateKey(startIndex) and
+                    self.rhs[startIndex] == self.g[startIndex]):
+                return
+
+            newKey = self.calculateKey(index)
+            if key < newKey:
+                self.push(index, newKey)
+                continue
+
+            heapq.heappop(self.open)
+            del self.queued[index]
+            self.expanded += 1
+
+            if self.g[index] > self.rhs[index]:
+                self.g[index] = self.rhs[index]
+                for index2 in self.neighbors(index):
+                    self.updateVertex(index2)
+            else:
+                self.g[index] = DStarLite.INFINITY
+                self.updateVertex(index)
+                for index2 in self.neighbors(index):
+                    self.updateVertex(index2)
+
+    def plan(self, start, blocked=None):
+        # Plans a path from start to the goal with the given cells blocked.
+        # Cells blocked by an earlier plan and not given again are opened.
+        #
+        # Returns an array of y,x coordinates, or False if the goal cannot
+        # be reached.
+
+        startIndex = start[0] * self.cols + start[1]
+        if self.startIndex is not None:
+            self.km += self.heuristic(self.startIndex, startIndex)
+        self.startIndex = startIndex
+        self.expanded = 0
+
+        self.setBlocked(blocked or [])
+        self.computeShortestPath()
+
+        if self.g[startIndex] == DStarLite.INFINITY:
+            return False
+
+        index = startIndex
+        path = [list(divmod(index, self.cols))]
+        while index != self.goalIndex:
+            index = min((index2 for index2 in self.neighbors(index) if self.passable[index2]),
+                key=lambda index2: self.g[index2])
+            path.append(list(divmod(index, self.cols)))
+        return path
+
+
+    def setBlocked(self, blocked):
+        # Blocks the given y,x cells and opens the cells that were blocked
+        # before but are not given. Walls of the grid are never opened.
+
+        gridPassable = self.pathfinder.passable
+        blocked = set(y * self.cols + x for y, x in blocked)
+        blocked = set(index for index in blocked if gridPassable[index])
+
+        changed = blocked.symmetric_difference(self.blocked)
+        for index in changed:
+            self.passable[index] = index not in blocked
+        for index in changed:
+            self.updateVertex(index)
+            for index2 in self.neighbors(index):
+                self.updateVertex(index2)
+        self.blocked = blocked
+
+
+class PlannerStore(object):
+    # Keeps a D* Lite planner for each goal, so replanning to the same goal
+    # reuses the previous search. All planners are dropped when the grid
+    # changes.
+    #
+    # Each planner holds state for the whole grid, so only the size most
+    # recently used planners are kept.
+
+    def __init__(self, pathfinder, size=8):
+        self.pathfinder = pathfinder
+        self.version = pathfinder.version
+        self.size = size
+        self.planners = OrderedDict()
+
+    def get(self, goal):
+        if self.version != self.pathfinder.version:
+            self.planners.clear()
+            self.version = self.pathfinder.version
+
+        goal = tuple(goal)
+        if goal in self.planners:
+            planner = self.planners.pop(goal)
+        else:
+            planner = DStarLite(self.pathfinder, goal)
+        self.planners[goal] = planner
+
+        while len(self.planners) > self.size:
+            self.planners.popitem(last=False)
+        return planner
+
+
+def distanceFieldFilepath(gridFile):
+    # Distance fields are saved next to the grid they were computed from.
+
+    return os.path.splitext(gridFile)[0] + '_fields.npz'
+
+
+class PathCache(object):
+    # LRU cache of paths keyed on (start, goal, grid version).
+    #
+    # Paths are cached along with their directions, so neither the search nor
+    # the conversion to directions needs to be redone on a hit.
+    #
+    # If there is no exact match, but the start lies on a cached path to the
+    # same goal, the rest of that path is returned. Any part of a shortest path
+    # is also a shortest path.
+    #
+    # Since the grid version is part of the key, paths on an old grid are never
+    # returned. They are cleared once the version changes.
+
+    # Status keys
+    KEY_SIZE = 'size'
+    KEY_ENTRIES = 'entries'
+    KEY_HITS = 'hits'
+    KEY_SUBPATH_HITS = 'subpathHits'
+    KEY_MISSES = 'misses'
+
+    def __init__(self, size=128):
+        self.size = size
+        self.entries = OrderedDict()
+        self.routes = {}
+        self.version = None
+        self.hits = 0
+        self.subpathHits = 0
+        self.misses = 0
+
+    def get(self, start, goal, version):
+        # Returns a tuple of (path, directions) or None if not cached.
+
+        self.checkVersion(version)
+        start = tuple(start)
+        goal = tuple(goal)
+        key = (start, goal, version)
+
+        if key in self.entries:
+            self.hits += 1
+            path, directions, cells = self.entries.pop(key)
+            self.entries[key] = (path, directions, cells)
+            return path, directions
+
+        for routeKey in self.routes.get(goal, []):
+            path, directions, cells = self.entries[routeKey]
+            if start in cells:
+                self.subpathHits += 1
+                self.entries[routeKey] = self.entries.pop(routeKey)
+                index = cells[start]
+                return path[index:], directions[index:]
+
+        self.misses += 1
+        return None
+
+    def put(self, start, goal, version, path, directions):
+        # Adds a path to the cache. Evicts the least recently used path
+        # if the cache is full.
+
+        self.checkVersion(version)
+        start = tuple(start)
+        goal = tuple(goal)
+        key = (start, goal, version)
+
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.size:
+            oldKey, _ = self.entries.popitem(last=False)
+            self.routes[oldKey[1]].discard(oldKey)
+
+        cells = dict((tuple(cell), i) for i, cell in enumerate(path))
+        self.entries[key] = (path, directions, cells)
+        self.routes.setdefault(goal, set()).add(key)
+
+    def checkVersion(self, version):
+        # Drops all paths if the grid version changed.
+
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        self.entries.clear()
+        self.routes.clear()
+
+    def getStatus(self):
+        return {
+            PathCache.KEY_SIZE: self.size,
+            PathCache.KEY_ENTRIES: len(self.entries),
+            PathCache.KEY_HITS: self.hits,
+            PathCache.KEY_SUBPATH_HITS: self.subpathHits,
+            PathCache.KEY_MISSES: self.misses
+        }
+
+
+class GridWatcher(object):
+    # Reloads the grid when the grid file changes on disk.
+    #
+    # The file's modification time is polled on the IOLoop. When it changes,
+    # the grid is read again and set on the pathfinder, which updates the grid
+    # version and so invalidates cached paths. The optional onReload callback
+    # is called after the new grid is set.
+
+    # Log messages
+    LOG_GRID_RELOAD = 'Grid file changed. Reloading "{}"'
+
+    def __init__(self, filepath, pathfinder, interval=2000, ioloop=None, onReload=None):
+        self.filepath = filepath
+        self.pathfinder = pathfinder
+        self.onReload = onReload
+        self.mtime = self.getMtime()
+        self.callback = PeriodicCallback(self.check, interval, ioloop or IOLoop.instance())
+
+    def start(self):
+        self.callback.start()
+
+    def stop(self):
+        self.callback.stop()
+
+    def getMtime(self):
+        try:
+            return os.path.getmtime(self.filepath)
+        except OSError:
+            return None
+
+    def check(self):
+        mtime = self.getMtime()
+        if mtime is not None and mtime != self.mtime:
+            grid = cv2.imread(self.filepath, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+            if grid is not None:
+                logging.info(GridWatcher.LOG_GRID_RELOAD.format(self.filepath))
+                self.mtime = mtime
+                self.pathfinder.setGrid(grid)
+                if self.onReload:
+                    self.onReload()
+
+
 class PathfinderSearchType:
     PATH = 1
     DIRECTIONS = 2
@@ -177,12 +1236,40 @@ class PathfinderMethod:
     # - Response: Depends on type
     SEARCH = 'pathfinder_search'
 
+    # - Type: Request
+    # - Method: status
+    # - Params: None
+    # - Response: grid version, path cache stats
+    STATUS = 'pathfinder_status'
+
+    # - Type: Request
+    # - Method: register_goal
+    # - Params: goal[y,x]
+    # - Response: True if the goal was registered
+    REGISTER_GOAL = 'pathfinder_register_goal'
+
+    # - Type: Request
+    # - Method: search_batch
+    # - Params: list of [start[y,x], goal[y,x]] pairs, PathfinderSearchType
+    # - Response: one result per pair, same as search
+    SEARCH_BATCH = 'pathfinder_search_batch'
+
+    # - Type: Request
+    # - Method: replan
+    # - Params: start[y,x], goal[y,x], list of blocked [y,x], PathfinderSearchType
+    # - Blocked cells are the obstacles currently known to the caller. Cells
+    #   from an earlier replan that are left out are open again.
+    # - Response: Depends on type
+    REPLAN = 'pathfinder_replan'
+
 
 class PathfinderServer(JsonRpcServer):
     # Pathfinder server is a service that finds a path from two points.
     #
     # Currently a specific map cannot be chosen, only what is loaded by the
-    # server on start up.
+    # server on start up. Main loads the grid of pathfinder.gridsize, one of
+    # the grids built by the mapper. Start and goal cells are cells of that
+    # grid.
     #
     # Supported operations:
     #
@@ -194,19 +1281,45 @@ class PathfinderServer(JsonRpcServer):
     # Accepted kwargs params
     PARAM_MASTER_CONN= 'masterConn'
     PARAM_PATHFINDER = 'pathfinder'
+    PARAM_PATH_CACHE = 'pathCache'
+    PARAM_GRID_WATCHER = 'gridWatcher'
+    PARAM_DISTANCE_FIELDS = 'distanceFields'
+    PARAM_GOALS = 'goals'
+    PARAM_PLANNERS = 'planners'
 
     def onInit(self, **kwargs):
         logging.info(PathfinderServer.LOG_SERVER_RUNNING)
 
         defaults = {
             PathfinderServer.PARAM_MASTER_CONN: None,
-            PathfinderServer.PARAM_PATHFINDER: None
+            PathfinderServer.PARAM_PATHFINDER: None,
+            PathfinderServer.PARAM_PATH_CACHE: PathCache(),
+            PathfinderServer.PARAM_GRID_WATCHER: None,
+            PathfinderServer.PARAM_DISTANCE_FIELDS: None,
+            PathfinderServer.PARAM_GOALS: [],
+            PathfinderServer.PARAM_PLANNERS: None
         }
         self.data.update(defaults, True)
         self.data.update(kwargs, False)
 
+        if self.data.distanceFields is None:
+            self.data.distanceFields = DistanceFieldStore(self.data.pathfinder)
+
+        if self.data.planners is None:
+            self.data.planners = PlannerStore(self.data.pathfinder)
+
     def onListen(self, port):
+        # Distance fields for the configured goals are loaded or computed
+        # before the service is registered.
+
+        self.data.distanceFields.warmUp(self.data.goals)
+        if self.data.gridWatcher:
+            self.data.gridWatcher.start()
         self.data.masterConn.register(PathfinderMethod.SEARCH, port)
+        self.data.masterConn.register(PathfinderMethod.STATUS, port)
+        self.data.masterConn.register(PathfinderMethod.REGISTER_GOAL, port)
+        self.data.masterConn.register(PathfinderMethod.SEARCH_BATCH, port)
+        self.data.masterConn.register(PathfinderMethod.REPLAN, port)
 
 
 class PathfinderConnection(JsonRpcConnection):
@@ -214,6 +1327,18 @@ class PathfinderConnection(JsonRpcConnection):
     # Log messages
     LOG_NEW_CONNECTION = 'Received a new connection'
     LOG_SEARCH = 'Searching for path from ({0},{1}) to ({2},{3})...'
+    LOG_CACHE_HIT = 'Found cached path from ({0},{1}) to ({2},{3})'
+    LOG_STATUS = 'Retrieving pathfinder status'
+    LOG_FIELD_PATH = 'Following distance field from ({0},{1}) to ({2},{3})'
+    LOG_REGISTER_GOAL = 'Registering goal ({0},{1})'
+    LOG_SEARCH_BATCH = 'Searching for {} paths'
+    LOG_SEARCH_TREE = 'Searching for {2} paths from ({0},{1})...'
+    LOG_REPLAN = 'Replanning path from ({0},{1}) to ({2},{3}), expanded {4} cells'
+    LOG_REPLAN_INVALID = 'Cannot replan from ({0},{1}) to ({2},{3}), not an open cell'
+
+    # Status keys
+    KEY_GRID_VERSION = 'gridVersion'
+    KEY_PATH_CACHE = 'pathCache'
 
     def onInit(self):
         # Initializes pathfinder connection
@@ -225,12 +1350,19 @@ class PathfinderConnection(JsonRpcConnection):
 
         self.masterConn = self.data.masterConn
         self.pathfinder = self.data.pathfinder
+        self.pathCache = self.data.pathCache
+        self.distanceFields = self.data.distanceFields
+        self.planners = self.data.planners
         self.cmdTopic = CmdTopic()
         self.pathTopic = PathTopic()
         self.directionsTopic = DirectionsTopic()
 
         self.methodHandlers = {
             PathfinderMethod.SEARCH: self.handleSearch,
+            PathfinderMethod.STATUS: self.handleStatus,
+            PathfinderMethod.REGISTER_GOAL: self.handleRegisterGoal,
+            PathfinderMethod.SEARCH_BATCH: self.handleSearchBatch,
+            PathfinderMethod.REPLAN: self.handleReplan
         }
         self.read()
 
@@ -248,23 +1380,179 @@ class PathfinderConnection(JsonRpcConnection):
             start, goal, type = params
             placeholders = start + goal
 
-            self.logInfo(PathfinderConnection.LOG_SEARCH.format(*placeholders))
-
-            path = self.pathfinder.search(start, goal)
-            directions = convertPathToDirections(path, self.cmdTopic, self.pathfinder.delta)
+            path, directions = self.findPath(start, goal)
 
             self.masterConn.publish(self.pathTopic.id, path)
             self.masterConn.publish(self.directionsTopic.id, directions)
 
-            result = []
+            self.write(self.encoder.response(id, *self.buildResult(path, directions, type)))
+
+    def handleSearchBatch(self, msg):
+        # Handles "search_batch" operation.
+        #
+        # Finds the paths for a list of start and goal pairs and sends them
+        # back in a single response. Pairs with the same start share one
+        # search. Unlike search, the paths are not published.
+
+        id = msg.get(jsonrpc.Key.ID, None)
+        params = msg.get(jsonrpc.Key.PARAMS, None)
+
+        if id and len(params) == 2:
+            pairs, type = params
+            self.logInfo(PathfinderConnection.LOG_SEARCH_BATCH.format(len(pairs)))
+
+            results = []
+            for path, directions in self.findPaths(pairs):
+                results.append(self.buildResult(path, directions, type))
+
+            self.write(self.encoder.response(id, *results))
+
+    def handleReplan(self, msg):
+        # Handles "replan" operation.
+        #
+        # Plans from a new start with the D* Lite planner of the goal, with
+        # the given cells blocked. The blocked cells are the obstacles the
+        # caller currently knows of and only apply to this replan, so a cell
+        # is opened again by leaving it out. Replanned paths are published
+        # like search, but not cached.
+        #
+        # Responds with no path if the start or goal is not an open cell, or
+        # if the goal cannot be reached. Blocked cells off the grid are ignored.
+
+        id = msg.get(jsonrpc.Key.ID, None)
+        params = msg.get(jsonrpc.Key.PARAMS, None)
+
+        if id and len(params) == 4:
+            start, goal, blocked, type = params
+
+            if not self.pathfinder.isOpen(start) or not self.pathfinder.isOpen(goal):
+                self.logInfo(PathfinderConnection.LOG_REPLAN_INVALID.format(*(start + goal)))
+                self.write(self.encoder.response(id, *self.buildResult(False, [], type)))
+                return
+
+            blocked = [cell for cell in blocked if self.pathfinder.inBounds(cell)]
+            planner = self.planners.get(goal)
+            path = planner.plan(start, blocked)
+            self.logInfo(PathfinderConnection.LOG_REPLAN.format(*(start + goal + [planner.expanded])))
+
+            directions = []
+            if path:
+                directions = convertPathToDirections(path, self.cmdTopic, self.pathfinder.delta)
+                self.masterConn.publish(self.pathTopic.id, path)
+                self.masterConn.publish(self.directionsTopic.id, directions)
+
+            self.write(self.encoder.response(id, *self.buildResult(path, directions, type)))
+
+    def buildResult(self, path, directions, type):
+        # Returns the path and/or directions depending on the search type.
+
+        result = []
+
+        if type != PathfinderSearchType.DIRECTIONS:
+            result.append(path)
+
+        if type != PathfinderSearchType.PATH:
+            result.append(directions)
 
-            if type != PathfinderSearchType.DIRECTIONS:
-                result.append(path)
+        return result
 
-            if type != PathfinderSearchType.PATH:
-                result.append(directions)
+    def handleStatus(self, msg):
+        # Handles "status" operation.
+        #
+        # Responds with the current grid version and path cache counters.
+
+        id = msg.get(jsonrpc.Key.ID, None)
+        if id:
+            self.logInfo(PathfinderConnection.LOG_STATUS)
+            self.write(self.encoder.response(id, {
+                PathfinderConnection.KEY_GRID_VERSION: self.pathfinder.version,
+                PathfinderConnection.KEY_PATH_CACHE: self.pathCache.getStatus()
+            }))
+
+    def handleRegisterGoal(self, msg):
+        # Handles "register_goal" operation.
+        #
+        # Computes and saves the distance field for the goal. Responds with
+        # False if the goal is not an open cell.
 
-            self.write(self.encoder.response(id, *result))
+        id = msg.get(jsonrpc.Key.ID, None)
+        params = msg.get(jsonrpc.Key.PARAMS, None)
+
+        if id and len(params) == 1:
+            goal = params[0]
+            self.logInfo(PathfinderConnection.LOG_REGISTER_GOAL.format(*goal))
+            self.write(self.encoder.response(id, self.distanceFields.register(goal)))
+
+    def findPath(self, start, goal):
+        # Returns the path and directions from start to goal. Checks the path
+        # cache first, then the distance fields of registered goals, and
+        # falls back to a search. New paths are added to the cache.
+
+        placeholders = start + goal
+        version = self.pathfinder.version
+
+        cached = self.pathCache.get(start, goal, version)
+        if cached:
+            self.logInfo(PathfinderConnection.LOG_CACHE_HIT.format(*placeholders))
+            return cached
+
+        if self.distanceFields.hasGoal(goal):
+            self.logInfo(PathfinderConnection.LOG_FIELD_PATH.format(*placeholders))
+            path = self.distanceFields.path(start, goal)
+        else:
+            self.logInfo(PathfinderConnection.LOG_SEARCH.format(*placeholders))
+            path = self.pathfinder.search(start, goal)
+
+        return self.addPath(start, goal, path)
+
+    def findPaths(self, pairs):
+        # Returns the path and directions for each start and goal pair.
+        #
+        # Pairs are looked up in the path cache and the distance fields like
+        # findPath. The remaining pairs are grouped by start, and each start
+        # with more than one goal gets a single search tree.
+
+        version = self.pathfinder.version
+        results = [None] * len(pairs)
+        starts = OrderedDict()
+
+        for i, (start, goal) in enumerate(pairs):
+            cached = self.pathCache.get(start, goal, version)
+            if cached:
+                results[i] = cached
+            elif self.distanceFields.hasGoal(goal):
+                results[i] = self.addPath(start, goal, self.distanceFields.path(start, goal))
+            else:
+                starts.setdefault(tuple(start), []).append(i)
+
+        for start, indexes in starts.iteritems():
+            start = list(start)
+            if len(indexes) == 1:
+                goal = pairs[indexes[0]][1]
+                self.logInfo(PathfinderConnection.LOG_SEARCH.format(*(start + goal)))
+                results[indexes[0]] = self.addPath(start, goal, self.pathfinder.search(start, goal))
+                continue
+
+            goals = [pairs[i][1] for i in indexes]
+            self.logInfo(PathfinderConnection.LOG_SEARCH_TREE.format(start[0], start[1], len(goals)))
+            paths = self.pathfinder.searchTree(start, goals)
+            for i, goal, path in zip(indexes, goals, paths):
+                results[i] = self.addPath(start, goal, path)
+
+        return results
+
+    def addPath(self, start, goal, path):
+        # Converts a path to directions and adds it to the path cache.
+        #
+        # If there is no path, returns False with no directions. These
+        # results are not cached.
+
+        if not path:
+            return False, []
+
+        directions = convertPathToDirections(path, self.cmdTopic, self.pathfinder.delta)
+        self.pathCache.put(start, goal, self.pathfinder.version, path, directions)
+        return path, directions
 
 
 def main():
@@ -274,20 +1562,34 @@ def main():
     cfg = JsonConfig()
 
     openByte = cfg.map.open
-    grid = cv2.imread(cfg.mapData.grid, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    gridFile = gridFilepath(cfg, cfg.pathfinder.gridsize)
+    grid = cv2.imread(gridFile, cv2.CV_LOAD_IMAGE_GRAYSCALE)
 
     logger = logging.getLogger('')
     logger.setLevel(cfg.general.logLevel)
 
-    pathfinder = Pathfinder(grid, openByte, euclideanDistance)
+    options = {}
+    if cfg.pathfinder.strategy == PathfinderStrategy.HIERARCHICAL:
+        options = {
+            'clusterSize': cfg.pathfinder.clusterSize,
+            'filepath': hierarchyFilepath(gridFile)
+        }
+    pathfinder = PathfinderStrategy.create(cfg.pathfinder.strategy, grid, openByte,
+        manhattanDistance, **options)
+    pathCache = PathCache(cfg.pathfinder.cacheSize)
+    distanceFields = DistanceFieldStore(pathfinder, distanceFieldFilepath(gridFile))
+    gridWatcher = GridWatcher(gridFile, pathfinder, cfg.pathfinder.gridCheckInterval,
+        onReload=distanceFields.refresh)
+    planners = PlannerStore(pathfinder, cfg.pathfinder.plannerCacheSize)
 
     serverPort = cfg.pathfinder.port
 
-    client = Client('', cfg.server.port, BetelbotClientConnection)
+    client = Client('', cfg.server.port, BetelbotClientConnection, **cfg.rpc.dict())
     conn = client.connect()
 
     server = PathfinderServer(connection=PathfinderConnection,
-        masterConn=conn, pathfinder=pathfinder)
+        masterConn=conn, pathfinder=pathfinder, pathCache=pathCache, gridWatcher=gridWatcher,
+        distanceFields=distanceFields, goals=cfg.pathfinder.goals, planners=planners)
     server.listen(serverPort)
 
     IOLoop.instance().start()
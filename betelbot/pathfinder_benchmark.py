@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config import JsonConfig
+from mapper import gridFilepath
+from pathfinder import PathfinderStrategy, manhattanDistance
+
+
+# Compares the search strategies of the pathfinder on the configured grid and
+# on generated room mazes.
+#
+# Each strategy searches the same random start and goal pairs. The total
+# number of expanded cells, the total path length and the wall time are
+# printed for each strategy, along with whether the paths have the same
+# length as the first strategy. Setup is the time to create the pathfinder,
+# which includes building the abstract graph for hierarchical search.
+#
+# Sizes of the room mazes (rooms per side) can be passed as command line
+# args, ie. ./pathfinder_benchmark.py 5 10 20
+
+
+DEFAULT_SIZES = [5, 10, 20]
+ROOM_SIZE = 8
+SEARCHES = 50
+
+# Result format
+RESULT_FORMAT = '{:<16} {:<8} {:>10.3f}s {:>10} {:>8} {:>10.3f}s {:>6}'
+HEADER_FORMAT = '{:<16} {:<8} {:>11} {:>10} {:>8} {:>11} {:>6}'
+
+
+def makeRoomMaze(rooms, roomSize, openByte, wallByte, seed=0):
+    # Creates a grid of rooms x rooms square rooms.
+    #
+    # The rooms are connected by doors placed along a random spanning tree, so
+    # every room can be reached. A few extra doors add loops.
+
+    randomState = random.Random(seed)
+    size = rooms * (roomSize + 1) + 1
+    grid = np.empty([size, size], dtype=np.uint8)
+    grid.fill(openByte)
+    grid[::roomSize + 1, :] = wallByte
+    grid[:, ::roomSize + 1] = wallByte
+
+    def addDoor(room, room2):
+        y, x = min(room, room2)
+        offset = randomState.randint(1, roomSize)
+        if room[0] != room2[0]:
+            grid[(y + 1) * (roomSize + 1), x * (roomSize + 1) + offset] = openByte
+        else:
+            grid[y * (roomSize + 1) + offset, (x + 1) * (roomSize + 1)] = openByte
+
+    visited = set([(0, 0)])
+    stack = [(0, 0)]
+    while stack:
+        y, x = stack[-1]
+        nextRooms = [(y + dy, x + dx) for dy, dx in [(0, -1), (1, 0), (-1, 0), (0, 1)]
+            if 0 <= y + dy < rooms and 0 <= x + dx < rooms and (y + dy, x + dx) not in visited]
+        if nextRooms:
+            room = randomState.choice(nextRooms)
+            addDoor((y, x), room)
+            visited.add(room)
+            stack.append(room)
+        else:
+            stack.pop()
+
+    for i in xrange(rooms):
+        y, x = randomState.randint(0, rooms - 1), randomState.randint(0, rooms - 2)
+        addDoor((y, x), (y, x + 1))
+    return grid
+
+
+def makeSearches(grid, openByte, count, seed=0):
+    # Picks random start and goal pairs from the open cells.
+
+    randomState = random.Random(seed)
+    openCells = np.argwhere(grid == openByte).tolist()
+    return [(randomState.choice(openCells), randomState.choice(openCells)) for i in xrange(count)]
+
+
+def benchmark(name, grid, openByte, strategies):
+    # Runs every strategy on the same searches and prints the results.
+
+    searches = makeSearches(grid, openByte, SEARCHES)
+    lengths = {}
+    for strategy in strategies:
+        start = time.time()
+        pathfinder = PathfinderStrategy.create(strategy, grid, openByte, manhattanDistance)
+        setup = time.time() - start
+        expanded = 0
+        lengths[strategy] = []
+        start = time.time()
+        for startCell, goalCell in searches:
+            path = pathfinder.search(startCell, goalCell)
+            expanded += pathfinder.expanded
+            lengths[strategy].append(len(path) if path else 0)
+        elapsed = time.time() - start
+        same = lengths[strategy] == lengths[strategies[0]]
+        print RESULT_FORMAT.format(name, strategy, setup, expanded, sum(lengths[strategy]),
+            elapsed, str(same))
+
+
+def main():
+    cfg = JsonConfig()
+    openByte = cfg.map.open
+    wallByte = cfg.map.wall
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    strategies = [PathfinderStrategy.ASTAR, PathfinderStrategy.JUMP_POINT,
+        PathfinderStrategy.HIERARCHICAL]
+
+    print HEADER_FORMAT.format('grid', 'strategy', 'setup', 'expanded', 'length', 'time', 'same')
+
+    grid = cv2.imread(gridFilepath(cfg, cfg.pathfinder.gridsize), cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    benchmark('hallway', grid, openByte, strategies)
+
+    for size in sizes:
+        maze = makeRoomMaze(size, ROOM_SIZE, openByte, wallByte)
+        benchmark('rooms {0}x{0}'.format(size), maze, openByte, strategies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import random
+
+from math import log, sqrt
+
+import numpy as np
+
+
+# Resampling strategies for the particle filter.
+#
+# Every strategy takes a list/array of normalized weights and the number
+# of particles to draw. The result is an array of indexes into the current
+# particles. Particles with a higher weight are more likely to be picked,
+# possibly more than once.
+#
+# Except for the roulette wheel, the strategies are O(N) and built on a
+# cumulative sum and searchsorted, so they do not degrade when the weights
+# are very skewed.
+
+
+class ResampleStrategy(object):
+    # Supported resampling strategies. Set in the particle section
+    # of the config.
+
+    WHEEL = 'wheel'
+    MULTINOMIAL = 'multinomial'
+    SYSTEMATIC = 'systematic'
+    STRATIFIED = 'stratified'
+    RESIDUAL = 'residual'
+
+
+def effectiveSampleSize(weight):
+    # Estimates how many particles effectively contribute to the
+    # distribution. Weights must be normalized.
+    #
+    # Equal weights give N, a single particle with all the weight gives 1.
+
+    return 1.0 / np.sum(np.square(weight))
+
+
+def searchCumulative(weight, positions):
+    # Maps positions in [0, 1) to the indexes of the particles that
+    # own that slice of the cumulative weight.
+
+    cumulative = np.cumsum(weight)
+    cumulative[-1] = 1.0
+    index = np.searchsorted(cumulative, positions, side='right')
+    return np.minimum(index, len(weight) - 1)
+
+
+def expNormalize(logWeight):
+    # Converts log weights to normalized weights without underflow by
+    # shifting the largest log weight to 0 before exponentiating.
+    #
+    # If every log weight is -inf, all weights are zero.
+
+    logWeight = np.asarray(logWeight, dtype=np.float64)
+    maxLogWeight = logWeight.max()
+    if not np.isfinite(maxLogWeight):
+        return np.zeros(len(logWeight))
+    weight = np.exp(logWeight - maxLogWeight)
+    return weight / weight.sum()
+
+
+def wheelResample(weight, N):
+    # Roulette wheel algorithm. Kept for comparison with the original
+    # implementation of the particle filter.
+
+    sampled = np.empty(N, dtype=np.intp)
+    count = len(weight)
+    index = int(random.random() * count)
+    beta = 0.0
+    maxWeight = max(weight)
+    for i in xrange(N):
+        beta += random.random() * 2.0 * maxWeight
+        while beta > weight[index]:
+            beta -= weight[index]
+            index = (index + 1) % count
+        sampled[i] = index
+    return sampled
+
+
+def multinomialResample(weight, N):
+    # Draws N independent positions.
+
+    return searchCumulative(weight, np.random.random(N))
+
+
+def systematicResample(weight, N):
+    # Draws a single random offset and then takes N evenly spaced
+    # positions. Lowest variance of the strategies here.
+
+    positions = (np.arange(N) + random.random()) / N
+    return searchCumulative(weight, positions)
+
+
+def stratifiedResample(weight, N):
+    # Splits [0, 1) into N strata and draws one position in each.
+
+    positions = (np.arange(N) + np.random.random(N)) / N
+    return searchCumulative(weight, positions)
+
+
+def residualResample(weight, N):
+    # Copies each particle floor(N * weight) times and then draws
+    # the remaining particles from the leftover weights.
+
+    weight = np.asarray(weight, dtype=np.float64)
+    counts = np.floor(N * weight).astype(np.intp)
+    index = np.repeat(np.arange(len(weight)), counts)
+    remaining = N - len(index)
+    if remaining > 0:
+        residual = N * weight - counts
+        residual /= residual.sum()
+        index = np.concatenate((index, systematicResample(residual, remaining)))
+    return index
+
+
+class Resampler(object):
+    # Picks a strategy and decides when resampling is needed.
+    #
+    # Resampling is skipped while the effective sample size stays above
+    # threshold * N. This saves CPU and keeps particle diversity since
+    # resampling duplicates the heavy particles and drops the light ones.
+    #
+    # A threshold of 1.0 resamples on every update.
+
+    # Error messages
+    ERROR_STRATEGY = 'Unknown resample strategy "{}"'
+
+    STRATEGIES = {
+        ResampleStrategy.WHEEL: wheelResample,
+        ResampleStrategy.MULTINOMIAL: multinomialResample,
+        ResampleStrategy.SYSTEMATIC: systematicResample,
+        ResampleStrategy.STRATIFIED: stratifiedResample,
+        ResampleStrategy.RESIDUAL: residualResample
+    }
+
+    def __init__(self, strategy=ResampleStrategy.SYSTEMATIC, threshold=0.5):
+        if strategy not in Resampler.STRATEGIES:
+            raise ValueError, Resampler.ERROR_STRATEGY.format(strategy)
+        self.strategy = strategy
+        self.sample = Resampler.STRATEGIES[strategy]
+        self.threshold = threshold
+
+    def resample(self, weight, sampleSize=None):
+        # Returns a tuple of indexes and the new weights.
+        #
+        # - The indexes are None if resampling was skipped.
+        # - Skipped resampling returns the normalized weights, which need
+        #   to be carried over to the next update.
+        # - If all weights are zero, nothing can be learned from the update
+        #   so the weights are reset to uniform.
+        # - sampleSize is called with the normalized weights to get the
+        #   number of particles to draw, only if resampling is triggered.
+        #   Defaults to the current count.
+
+        weight = np.asarray(weight, dtype=np.float64)
+        count = len(weight)
+
+        total = weight.sum()
+        if not total > 0:
+            return None, np.ones(count) / count
+
+        weight = weight / total
+        if effectiveSampleSize(weight) > self.threshold * count:
+            return None, weight
+
+        N = count if sampleSize is None else sampleSize(weight)
+        return self.sample(weight, N), np.ones(N) / N
+
+
+def normalQuantile(p):
+    # Approximates the quantile function of the standard normal
+    # distribution. Abramowitz and Stegun 26.2.23, error < 4.5e-4.
+
+    q = p if p < 0.5 else 1.0 - p
+    t = sqrt(-2.0 * log(q))
+    z = t - ((0.010328 * t + 0.802853) * t + 2.515517) / (((0.001308 * t + 0.189269) * t + 1.432788) * t + 1.0)
+    return -z if p < 0.5 else z
+
+
+class KldSampler(object):
+    # Picks the number of particles with KLD-sampling (Fox, 2003).
+    #
+    # The particles are put into bins by grid cell and orientation. The more
+    # bins are occupied, the more spread out the particles are and the more
+    # particles are needed to approximate the distribution. Once the filter
+    # has converged, only a few bins are occupied and N shrinks.
+    #
+    # - error is the max KL divergence between the sampled and true distribution.
+    # - delta is the probability that the error is exceeded.
+    # - The result is always clamped to [minN, maxN].
+
+    def __init__(self, minN, maxN, binSize, angleBins=4, error=0.05, delta=0.01):
+        self.minN = minN
+        self.maxN = maxN
+        self.binSize = binSize
+        self.angleBins = angleBins
+        self.error = error
+        self.z = normalQuantile(1.0 - delta)
+
+    def occupiedBins(self, y, x, orientation, weight=None):
+        # Counts the number of distinct bins that contain a particle.
+        #
+        # If weights are given, a bin only counts if it holds enough weight
+        # to expect at least one particle when maxN particles are drawn.
+        # This keeps particles that the measurement ruled out from growing N.
+
+        yBin = np.floor_divide(y, self.binSize).astype(np.int64)
+        xBin = np.floor_divide(x, self.binSize).astype(np.int64)
+        oBin = np.floor(orientation / (2.0 * np.pi) * self.angleBins).astype(np.int64)
+        cols = xBin.max() + 1 if len(xBin) else 1
+        bins = (yBin * cols + xBin) * self.angleBins + oBin % self.angleBins
+        bins, inverse = np.unique(bins, return_inverse=True)
+        if weight is None:
+            return len(bins)
+        mass = np.bincount(inverse, weights=weight)
+        return int(np.count_nonzero(mass * self.maxN >= 1.0))
+
+    def sampleSize(self, y, x, orientation, weight=None):
+        # Number of particles needed for the spread of the given particles.
+
+        k = self.occupiedBins(y, x, orientation, weight)
+        if k < 2:
+            return self.minN
+        a = 2.0 / (9.0 * (k - 1))
+        n = (k - 1) / (2.0 * self.error) * (1.0 - a + sqrt(a) * self.z) ** 3
+        return int(min(max(n, self.minN), self.maxN))
+
+
+def main():
+    pass
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ from tornado.ioloop import IOLoop
 
 from client import BetelbotClientConnection
 from config import JsonConfig
+from mapper import loadDistanceMap
 from particle import Particle, convertToMotion
 from robot import RobotDriver, RobotConnection, RobotMethod, RobotServer
 from topic import getTopicFactory
@@ -91,20 +92,18 @@ class BetelbotSimDriver(RobotDriver):
         delta = self.delta
         directions = self.topics.cmd.keys
         Z = []
-        count = len(delta)
         midpoint = self.gridsize/2
         y = y * self.gridsize + midpoint
         x = x * self.gridsize + midpoint
-        index = y * self.grid.shape[1] * count + x * count
-        for i in xrange(count):
+        distances = self.lookupTable[y, x]
+        for i in xrange(len(delta)):
             if direction != directions[i]:
-                value = self.lookupTable[index]
+                value = distances[i]
                 dy = value * delta[i][0]
                 dx = value * delta[i][1]
                 Z.append(int(dy or dx))
             else:
                 Z.append(None)
-            index += 1
         return Z
 
 
@@ -117,14 +116,14 @@ def main():
     logger.setLevel(cfg.general.logLevel)
 
     grid = cv2.imread(cfg.mapData.map, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-    lookupTable = np.load(cfg.mapData.dmap)
+    lookupTable = loadDistanceMap(cfg.mapData.dmap, grid.shape, cfg.mapData.mmap)
     gridsize = cfg.map.gridsize
     start =  cfg.robosim.start
     delay = cfg.robosim.delay
 
     serverPort = cfg.robosim.port
 
-    client = Client('', cfg.server.port, BetelbotClientConnection)
+    client = Client('', cfg.server.port, BetelbotClientConnection, **cfg.rpc.dict())
     conn = client.connect()
 
     driver = BetelbotSimDriver(start, grid, gridsize, lookupTable, delay)
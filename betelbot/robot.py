@@ -36,6 +36,8 @@ class RobotServer(JsonRpcServer):
 
     # Log messages
     LOG_SERVER_RUNNING = 'RoboSim Server is running'
+    LOG_SEARCH_ERROR = 'Pathfinder search failed: {}'
+    LOG_UPDATE_PARTICLES_ERROR = 'Particle update failed, continuing without it: {}'
 
     # Accepted kwargs params
     PARAM_MASTER_CONN= 'masterConn'
@@ -89,21 +91,32 @@ class RobotServer(JsonRpcServer):
     def onWaypointPublished(self, topic, data):
         if self.driver.on() and self.driver.autonomous() and self.topics.waypoint.isValid(*data):
             self.masterConn.pathfinder_search(self.onSearchResponse,
-                data[0], data[1], PathfinderSearchType.BOTH)
+                data[0], data[1], PathfinderSearchType.BOTH, errback=self.onSearchError)
 
     def onSearchResponse(self, result):
         self.driver.setPath(*result)
         self.driver.moveAuto(self.processRobotData)
 
+    def onSearchError(self, error):
+        logging.warning(RobotServer.LOG_SEARCH_ERROR.format(error.get(jsonrpc.Key.MESSAGE, None)))
+
     def onUpdateParticlesResponse(self, result):
         if self.driver.on() and self.driver.autonomous():
             self.driver.moveAuto(self.processRobotData)
 
+    def onUpdateParticlesError(self, error):
+        # A slow or stalled particle filter should not stop the robot. The
+        # update for this move is skipped and the robot keeps following its path.
+
+        logging.warning(RobotServer.LOG_UPDATE_PARTICLES_ERROR.format(error.get(jsonrpc.Key.MESSAGE, None)))
+        self.onUpdateParticlesResponse(None)
+
     def processRobotData(self, motion, measurements, reset):
         if motion is not None and measurements is not None and reset is not None:
             print measurements
             self.masterConn.publish(self.topics.sense.id, measurements)
-            self.masterConn.particles_update(self.onUpdateParticlesResponse, motion, measurements, reset)
+            self.masterConn.particles_update(self.onUpdateParticlesResponse, motion, measurements, reset,
+                errback=self.onUpdateParticlesError)
 
 
 class RobotConnection(JsonRpcConnection):
@@ -391,7 +404,7 @@ def main():
     logger = logging.getLogger('')
     logger.setLevel(cfg.general.logLevel)
 
-    client = Client('', cfg.server.port, BetelbotClientConnection)
+    client = Client('', cfg.server.port, BetelbotClientConnection, **cfg.rpc.dict())
     conn = client.connect()
 
     driverServer = BetelbotDriverServer()
@@ -132,7 +132,7 @@ def main():
     cfg = JsonConfig()
     topics = getTopicFactory()
 
-    client = Client('', cfg.server.port, BetelbotClientConnection)
+    client = Client('', cfg.server.port, BetelbotClientConnection, **cfg.rpc.dict())
     conn = client.connect()
 
     thread = threading.Thread(target=threadedLoop)
@@ -0,0 +1,269 @@
+import json
+import unittest
+
+import numpy as np
+
+import codec
+
+from codec import JsonCodec, MsgpackCodec
+from config import DictConfig
+from jsonrpc import Encoder, Error, JsonRpcConnection, Key
+from util import Connection
+
+
+class FakeStream(object):
+    # Stands in for an IOStream. Keeps the frames written to it and the
+    # read that is waiting for data.
+
+    def __init__(self):
+        self.frames = []
+        self.readRequest = None
+        self.isClosed = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write(self, data, callback=None):
+        self.frames.append(data)
+
+    def read_bytes(self, size, callback):
+        assert self.readRequest is None, 'Already reading'
+        self.readRequest = (size, callback)
+
+    def read_until(self, terminator, callback):
+        assert self.readRequest is None, 'Already reading'
+        self.readRequest = (terminator, callback)
+
+    def receive(self):
+        # Hands the read callback back like IOStream does, which clears the
+        # read before the callback runs.
+
+        size, callback = self.readRequest
+        self.readRequest = None
+        return callback
+
+    def reading(self):
+        return self.readRequest is not None
+
+    def closed(self):
+        return self.isClosed
+
+    def close(self):
+        self.isClosed = True
+
+
+def createConnection():
+    return JsonRpcConnection(FakeStream(), ('test', 0), DictConfig({}))
+
+
+def readFrames(conn):
+    # Decodes the json frames written to the connection.
+
+    return [json.loads(frame.strip('\0')) for frame in conn.stream.frames]
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = Encoder()
+        self.conn = createConnection()
+        self.conn.methodHandlers['echo'] = lambda msg: self.conn.write(
+            self.encoder.response(msg[Key.ID], *msg[Key.PARAMS]))
+
+    def receive(self, *msgs):
+        self.conn.readHandler(json.dumps(list(msgs)) + '\0')
+
+    def request(self, id, *params):
+        return {Key.JSONRPC: '2.0', Key.ID: id, Key.METHOD: 'echo', Key.PARAMS: params}
+
+    def testResponsesSentAsOneBatch(self):
+        self.receive(self.request('1', 'a'), self.request('2', 'b'))
+
+        frames = readFrames(self.conn)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual([msg[Key.RESULT] for msg in frames[0]], [['a'], ['b']])
+
+    def testSingleRequestBatchGetsArray(self):
+        self.receive(self.request('1', 'a'))
+
+        frames = readFrames(self.conn)
+        self.assertEqual(len(frames), 1)
+        self.assertTrue(isinstance(frames[0], list))
+        self.assertEqual(frames[0][0][Key.RESULT], ['a'])
+
+    def testNotificationsOnlyBatchSendsNothing(self):
+        self.receive({Key.JSONRPC: '2.0', Key.METHOD: 'unknown'})
+
+        self.assertEqual(self.conn.stream.frames, [])
+
+    def testInvalidItems(self):
+        self.receive(1, self.request('1', 'a'))
+
+        frames = readFrames(self.conn)
+        self.assertEqual(frames[0][0][Key.ERROR], Error.INVALID_REQUEST)
+        self.assertEqual(frames[0][1][Key.RESULT], ['a'])
+
+    def testEmptyBatch(self):
+        self.conn.readHandler('[]\0')
+
+        frames = readFrames(self.conn)
+        self.assertEqual(frames[0][Key.ERROR], Error.INVALID_REQUEST)
+
+    def testNestedBatch(self):
+        # A handler that sends its own batch while an incoming batch is
+        # dispatched, like batchLocate in the client module.
+
+        def locate(msg):
+            self.conn.startBatch()
+            self.conn.write(self.encoder.request('3', 'locate', 'a'))
+            self.conn.write(self.encoder.request('4', 'locate', 'b'))
+            self.conn.flushBatch()
+        self.conn.methodHandlers['locate'] = locate
+
+        self.receive({Key.JSONRPC: '2.0', Key.METHOD: 'locate'}, self.request('1', 'a'))
+
+        frames = readFrames(self.conn)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual([msg[Key.ID] for msg in frames[0]], ['3', '4', '1'])
+        self.assertEqual(self.conn.batch, None)
+        self.assertEqual(self.conn.batchDepth, 0)
+
+    def testSingleMessageBatchSentAsIs(self):
+        self.conn.startBatch()
+        self.conn.write(self.encoder.request('1', 'echo'))
+        self.conn.flushBatch()
+
+        frames = readFrames(self.conn)
+        self.assertEqual(frames[0][Key.ID], '1')
+
+    def testFlushWithoutBatch(self):
+        self.conn.flushBatch()
+
+        self.assertEqual(self.conn.stream.frames, [])
+        self.assertEqual(self.conn.batchDepth, 0)
+
+
+class NegotiateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = createConnection()
+
+    def request(self, id, *names):
+        return Encoder().request(id, codec.NEGOTIATE, *names) + '\0'
+
+    def testServerSwitchesAfterResponse(self):
+        self.conn.readHandler(self.request('1', 'unknown', MsgpackCodec.NAME))
+
+        frames = readFrames(self.conn)
+        self.assertEqual(frames[0][Key.RESULT], [MsgpackCodec.NAME])
+        self.assertEqual(self.conn.encoder.codec.NAME, MsgpackCodec.NAME)
+        self.assertTrue(self.conn.lengthPrefixed)
+
+    def testServerFallsBackToJson(self):
+        self.conn.readHandler(self.request('1', 'unknown'))
+
+        self.assertEqual(readFrames(self.conn)[0][Key.RESULT], [JsonCodec.NAME])
+        self.assertEqual(self.conn.encoder.codec.NAME, JsonCodec.NAME)
+        self.assertFalse(self.conn.lengthPrefixed)
+
+    def testRejectedInsideBatch(self):
+        batch = '[{}]\0'.format(self.request('1', MsgpackCodec.NAME).strip('\0'))
+        self.conn.readHandler(batch)
+
+        frames = readFrames(self.conn)
+        self.assertEqual(frames[0][0][Key.ERROR], Error.INVALID_REQUEST)
+        self.assertEqual(self.conn.encoder.codec.NAME, JsonCodec.NAME)
+
+    def testClientHoldsWritesUntilResponse(self):
+        encoder = Encoder()
+        self.conn.negotiate(MsgpackCodec.NAME)
+        self.conn.write(encoder.notification('publish', 'power', 'on'))
+        self.assertEqual(len(self.conn.stream.frames), 1)
+        self.assertEqual(readFrames(self.conn)[0][Key.METHOD], codec.NEGOTIATE)
+
+        self.conn.readHandler(encoder.response(self.conn.negotiateId, MsgpackCodec.NAME) + '\0')
+
+        frame = self.conn.stream.frames[1]
+        length = Connection.LENGTH_PREFIX.unpack(frame[:4])[0]
+        self.assertEqual(length, len(frame) - 4)
+        self.assertEqual(MsgpackCodec().loads(frame[4:])[Key.PARAMS], ['power', 'on'])
+        self.assertEqual(self.conn.responseHandlers, {})
+
+    def testClientSendsJsonAfterTimeout(self):
+        self.conn.negotiate(MsgpackCodec.NAME)
+        self.conn.write(Encoder().notification('publish', 'power', 'on'))
+        self.conn.onNegotiateTimeout()
+
+        self.assertEqual(readFrames(self.conn)[1][Key.PARAMS], ['power', 'on'])
+        self.assertEqual(self.conn.encoder.codec.NAME, JsonCodec.NAME)
+
+    def testClientSkipsJsonOnly(self):
+        self.conn.negotiate(JsonCodec.NAME)
+
+        self.assertEqual(self.conn.stream.frames, [])
+        self.assertEqual(self.conn.pendingWrites, None)
+
+
+class LengthPrefixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = createConnection()
+        self.conn.setCodec(MsgpackCodec.NAME)
+        self.received = []
+        self.conn.methodHandlers['publish'] = lambda msg: self.received.append(msg[Key.PARAMS])
+
+    def testReadsFrame(self):
+        data = self.conn.encoder.notification('publish', 'power', 'on')
+        self.conn.read()
+        self.conn.stream.receive()(Connection.LENGTH_PREFIX.pack(len(data)))
+        self.assertEqual(self.conn.stream.readRequest[0], len(data))
+        self.conn.stream.receive()(data)
+
+        self.assertEqual(self.received, [['power', 'on']])
+        self.assertEqual(self.conn.stream.readRequest[0], Connection.LENGTH_PREFIX.size)
+
+    def testWriteBetweenLengthAndMessage(self):
+        # A write that completes before the length callback runs must not
+        # start another read.
+
+        data = self.conn.encoder.notification('publish', 'power', 'on')
+        self.conn.read()
+        onReadLength = self.conn.stream.receive()
+        self.conn.onWrite()
+        self.assertFalse(self.conn.stream.reading())
+
+        onReadLength(Connection.LENGTH_PREFIX.pack(len(data)))
+        self.conn.stream.receive()(data)
+        self.assertEqual(self.received, [['power', 'on']])
+
+
+class CodecTest(unittest.TestCase):
+
+    def assertBatch(self, codec, count):
+        msgs = [{Key.ID: i} for i in xrange(count)]
+        data = codec.batch([codec.dumps(msg) for msg in msgs])
+        self.assertEqual(codec.loads(data), msgs)
+
+    def testJsonBatch(self):
+        for count in [1, 2, 20]:
+            self.assertBatch(JsonCodec(), count)
+
+    def testMsgpackBatch(self):
+        # Sizes around the fixarray, array 16 and array 32 headers.
+
+        for count in [1, 15, 16, 0xffff, 0x10000]:
+            self.assertBatch(MsgpackCodec(), count)
+
+    def testMsgpackNumpy(self):
+        msgpackCodec = MsgpackCodec()
+        data = msgpackCodec.dumps({Key.PARAMS: [np.arange(3), np.float64(0.5)]})
+        self.assertEqual(msgpackCodec.loads(data)[Key.PARAMS], [[0, 1, 2], 0.5])
+
+    def testChooseCodec(self):
+        self.assertEqual(codec.chooseCodec(['unknown', MsgpackCodec.NAME]), MsgpackCodec.NAME)
+        self.assertEqual(codec.chooseCodec(['unknown']), JsonCodec.NAME)
+        self.assertTrue(isinstance(codec.getCodec('unknown'), JsonCodec))
+
+
+if __name__ == '__main__':
+    unittest.main()
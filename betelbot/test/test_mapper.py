@@ -0,0 +1,96 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+import mapper
+
+
+OPEN = 255
+WALL = 0
+GRID_SIZES = [4, 8]
+
+
+def createMap(rows, cols, seed):
+    # Returns a map with a few rectangular walls.
+
+    rng = random.Random(seed)
+    map = np.empty((rows, cols), dtype=np.uint8)
+    map.fill(OPEN)
+    for i in xrange(10):
+        addWall(map, rng)
+    return map
+
+
+def addWall(map, rng):
+    rows, cols = map.shape
+    y = rng.randrange(rows)
+    x = rng.randrange(cols)
+    map[y:y + rng.randrange(1, 6), x:x + rng.randrange(1, 6)] = WALL
+
+
+class RebuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.map = createMap(40, 44, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def files(self, name):
+        # Returns the map file, grid files and distance map file of a build.
+
+        path = os.path.join(self.dir, name)
+        os.mkdir(path)
+        gridFiles = [(size, os.path.join(path, 'grid_{}.png'.format(size))) for size in GRID_SIZES]
+        return os.path.join(path, 'map.png'), gridFiles, os.path.join(path, 'dmap.npy')
+
+    def build(self, map, name):
+        files = self.files(name)
+        mapper.build(map, *(files + (OPEN, WALL)))
+        return files
+
+    def assertSameData(self, files, expectedFiles):
+        mapFile, gridFiles, dmapFile = files
+        expectedMapFile, expectedGridFiles, expectedDmapFile = expectedFiles
+
+        self.assertTrue(np.array_equal(cv2.imread(mapFile, cv2.CV_LOAD_IMAGE_GRAYSCALE),
+            cv2.imread(expectedMapFile, cv2.CV_LOAD_IMAGE_GRAYSCALE)))
+        for (size, gridFile), (size, expectedGridFile) in zip(gridFiles, expectedGridFiles):
+            self.assertTrue(np.array_equal(cv2.imread(gridFile, cv2.CV_LOAD_IMAGE_GRAYSCALE),
+                cv2.imread(expectedGridFile, cv2.CV_LOAD_IMAGE_GRAYSCALE)))
+        self.assertTrue(np.array_equal(np.load(dmapFile), np.load(expectedDmapFile)))
+
+    def testRebuildMatchesBuild(self):
+        files = self.build(self.map, 'incremental')
+
+        rng = random.Random(2)
+        for i in xrange(5):
+            map = self.map.copy()
+            addWall(map, rng)
+            map[rng.randrange(40), :] = OPEN
+            self.assertTrue(mapper.rebuild(map, *(files + (OPEN, WALL))))
+            self.assertSameData(files, self.build(map, 'full{}'.format(i)))
+
+    def testRebuildWithoutChanges(self):
+        files = self.build(self.map, 'incremental')
+        self.assertTrue(mapper.rebuild(self.map, *(files + (OPEN, WALL))))
+        self.assertSameData(files, self.build(self.map, 'full'))
+
+    def testRebuildNeedsPreviousData(self):
+        files = self.files('missing')
+        self.assertFalse(mapper.rebuild(self.map, *(files + (OPEN, WALL))))
+
+    def testRebuildNeedsSameSize(self):
+        files = self.build(self.map, 'incremental')
+        map = createMap(48, 44, 1)
+        self.assertFalse(mapper.rebuild(map, *(files + (OPEN, WALL))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import json
+import unittest
+
+from jsonrpc import Encoder, Key
+from master import BetelbotConnection, BetelbotMethod, BetelbotServer, SubscriberPolicy
+from topic import ValueTopic
+
+
+TOPICS = ['oldest', 'latest', 'disconnect']
+
+
+class FakeStream(object):
+    # Stands in for an IOStream. Keeps the frames written to it. While
+    # isWriting is set, notifications are queued by the connection.
+
+    def __init__(self):
+        self.frames = []
+        self.isWriting = False
+        self.isClosed = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write(self, data, callback=None):
+        self.frames.append(data)
+
+    def read_until(self, terminator, callback):
+        pass
+
+    def reading(self):
+        return True
+
+    def writing(self):
+        return self.isWriting
+
+    def closed(self):
+        return self.isClosed
+
+    def close(self):
+        self.isClosed = True
+
+
+def createServer(**kwargs):
+    topics = dict((topic, ValueTopic(topic, ['on', 'off'])) for topic in TOPICS)
+    kwargs.setdefault(BetelbotServer.PARAM_TOPIC_POLICIES, {
+        'oldest': SubscriberPolicy.DROP_OLDEST,
+        'latest': SubscriberPolicy.LATEST,
+        'disconnect': SubscriberPolicy.DISCONNECT
+    })
+    return BetelbotServer(topics=topics, **kwargs)
+
+
+class SubscriberQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = createServer(queueSize=3)
+        self.encoder = Encoder()
+        self.conn = BetelbotConnection(FakeStream(), ('test', 0), self.server.data)
+        self.conn.stream.isWriting = True
+
+    def notify(self, topic, value):
+        self.conn.notify(topic, self.encoder.notification(BetelbotMethod.NOTIFYSUB, topic, value))
+
+    def queued(self):
+        return [json.loads(msg)[Key.PARAMS] for topic, msg in self.conn.queue]
+
+    def stats(self, topic):
+        return self.server.data.topicStats[topic]
+
+    def flush(self):
+        # Finishes the pending write and returns the frame with the queue.
+
+        self.conn.stream.isWriting = False
+        self.conn.onWrite()
+        return json.loads(self.conn.stream.frames[-1].strip('\0'))
+
+    def testWritesDirectlyWhenIdle(self):
+        self.conn.stream.isWriting = False
+        self.notify('oldest', 'on')
+
+        self.assertEqual(len(self.conn.stream.frames), 1)
+        self.assertEqual(len(self.conn.queue), 0)
+
+    def testQueuesWhileWriting(self):
+        self.notify('oldest', 'on')
+        self.notify('oldest', 'off')
+
+        self.assertEqual(self.conn.stream.frames, [])
+        self.assertEqual(self.queued(), [['oldest', 'on'], ['oldest', 'off']])
+
+    def testDropOldest(self):
+        for value in ['on', 'off', 'on', 'off']:
+            self.notify('oldest', value)
+
+        self.assertEqual(self.queued(), [['oldest', 'off'], ['oldest', 'on'], ['oldest', 'off']])
+        self.assertEqual(self.stats('oldest').dropped, 1)
+
+    def testDropOldestOfOtherTopic(self):
+        # The oldest entry is dropped whatever its topic, and the drop is
+        # counted for the topic it belonged to.
+
+        self.notify('latest', 'on')
+        for value in ['on', 'off', 'on']:
+            self.notify('oldest', value)
+
+        self.assertEqual(self.queued(), [['oldest', 'on'], ['oldest', 'off'], ['oldest', 'on']])
+        self.assertEqual(self.stats('latest').dropped, 1)
+        self.assertEqual(self.stats('oldest').dropped, 0)
+        self.assertEqual(self.conn.latest, {})
+
+    def testLatestReplacesQueuedEntry(self):
+        self.notify('latest', 'on')
+        self.notify('oldest', 'on')
+        self.notify('latest', 'off')
+
+        self.assertEqual(self.queued(), [['latest', 'off'], ['oldest', 'on']])
+        self.assertEqual(self.stats('latest').dropped, 1)
+
+    def testDisconnect(self):
+        for value in ['on', 'off', 'on']:
+            self.notify('disconnect', value)
+        self.assertFalse(self.conn.stream.closed())
+
+        self.notify('disconnect', 'off')
+        self.assertTrue(self.conn.stream.closed())
+        self.assertEqual(self.stats('disconnect').disconnects, 1)
+        self.assertEqual(self.stats('disconnect').dropped, 0)
+
+        self.notify('disconnect', 'on')
+        self.assertEqual(self.stats('disconnect').disconnects, 1)
+
+    def testFlushSendsBatch(self):
+        self.notify('oldest', 'on')
+        self.notify('latest', 'off')
+
+        frame = self.flush()
+        self.assertEqual([msg[Key.PARAMS] for msg in frame], [['oldest', 'on'], ['latest', 'off']])
+        self.assertEqual(len(self.conn.queue), 0)
+        self.assertEqual(self.conn.latest, {})
+
+    def testFlushSendsSingleMessage(self):
+        self.notify('latest', 'on')
+
+        frame = self.flush()
+        self.assertEqual(frame[Key.PARAMS], ['latest', 'on'])
+
+    def testLatestAfterFlush(self):
+        self.notify('latest', 'on')
+        self.flush()
+        self.conn.stream.isWriting = True
+        self.notify('latest', 'off')
+
+        self.assertEqual(self.queued(), [['latest', 'off']])
+        self.assertEqual(self.stats('latest').dropped, 0)
+
+
+class ServerPolicyTest(unittest.TestCase):
+
+    def testUnknownTopicPolicy(self):
+        self.assertRaises(ValueError, BetelbotServer, topicPolicies={'oldest': 'unknown'})
+
+    def testUnknownDefaultPolicy(self):
+        self.assertRaises(ValueError, BetelbotServer, defaultPolicy='unknown')
+
+    def testDefaultPolicy(self):
+        server = createServer(queueSize=1, defaultPolicy=SubscriberPolicy.DISCONNECT,
+            topicPolicies={})
+        conn = BetelbotConnection(FakeStream(), ('test', 0), server.data)
+        conn.stream.isWriting = True
+        conn.notify('oldest', Encoder().notification(BetelbotMethod.NOTIFYSUB, 'oldest', 'on'))
+        conn.notify('oldest', Encoder().notification(BetelbotMethod.NOTIFYSUB, 'oldest', 'off'))
+
+        self.assertTrue(conn.stream.closed())
+
+
+if __name__ == '__main__':
+    unittest.main()
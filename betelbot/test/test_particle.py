@@ -0,0 +1,224 @@
+import logging
+import random
+import time
+import unittest
+
+import numpy as np
+
+from tornado.ioloop import IOLoop
+
+from mapper import calcDistanceMaps, mergeDistanceMaps
+from particle import LikelihoodField, ParticleFilter, ShardedParticleFilter, VectorParticleFilter
+from resample import KldSampler, Resampler
+
+
+OPEN = 255
+WALL = 0
+SENSE_NOISE = 5.0
+MOTIONS = [[0, 3], [np.pi / 2, 2], [np.pi, 4], [3 * np.pi / 2, 1]]
+MEASUREMENTS = [[4, 10, None, 7], [None, 3, 12, 5], [8, None, None, None]]
+
+
+def createMap(rows, cols, seed):
+    # Returns a map with walls around the border and a few blocks inside,
+    # along with its distance map lookup table.
+
+    rng = random.Random(seed)
+    map = np.empty((rows, cols), dtype=np.uint8)
+    map.fill(WALL)
+    map[1:-1, 1:-1] = OPEN
+    for i in xrange(8):
+        y = rng.randrange(rows)
+        x = rng.randrange(cols)
+        map[y:y + rng.randrange(1, 5), x:x + rng.randrange(1, 5)] = WALL
+    return map, mergeDistanceMaps(calcDistanceMaps(map, WALL))
+
+
+def noResampling():
+    # A threshold of 0 never resamples, so the weights of filters can be
+    # compared without random draws.
+
+    return Resampler(threshold=0.0)
+
+
+def copyParticles(source, target):
+    # Copies the particles of a ParticleFilter into a VectorParticleFilter.
+
+    target.N = source.N
+    target.y = np.array([p.y for p in source.particles])
+    target.x = np.array([p.x for p in source.particles])
+    target.orientation = np.array([p.orientation for p in source.particles])
+    target.weight = np.array(source.weight)
+
+
+class FilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        np.random.seed(1)
+        self.grid, self.lookupTable = createMap(30, 40, 2)
+
+    def createFilter(self, cls, likelihoodField=False, **kwargs):
+        field = LikelihoodField(self.grid, self.lookupTable, SENSE_NOISE) if likelihoodField else None
+        return cls(10, self.grid, self.lookupTable, 0.0, 0.0, SENSE_NOISE, 200,
+            resampler=noResampling(), likelihoodField=field, **kwargs)
+
+    def assertSameParticles(self, particleFilter, expected):
+        self.assertEqual(particleFilter.N, expected.N)
+        self.assertTrue(np.array_equal(particleFilter.y, expected.y))
+        self.assertTrue(np.array_equal(particleFilter.x, expected.x))
+        self.assertTrue(np.allclose(particleFilter.orientation, expected.orientation))
+        self.assertTrue(np.allclose(particleFilter.weight, expected.weight))
+
+
+class VectorParticleFilterTest(FilterTestCase):
+
+    def assertMatchesScalar(self, likelihoodField):
+        scalar = self.createFilter(ParticleFilter, likelihoodField)
+        scalar.makeParticles()
+        vector = self.createFilter(VectorParticleFilter, likelihoodField)
+        copyParticles(scalar, vector)
+
+        for motion, measurements in zip(MOTIONS, MEASUREMENTS):
+            scalar.update(motion, measurements)
+            vector.update(motion, measurements)
+            expected = self.createFilter(VectorParticleFilter)
+            copyParticles(scalar, expected)
+            self.assertSameParticles(vector, expected)
+
+    def testMatchesScalar(self):
+        self.assertMatchesScalar(False)
+
+    def testMatchesScalarWithLikelihoodField(self):
+        self.assertMatchesScalar(True)
+
+    def testSense(self):
+        scalar = self.createFilter(ParticleFilter)
+        scalar.makeParticles()
+        vector = self.createFilter(VectorParticleFilter)
+        copyParticles(scalar, vector)
+
+        expected = [p.sense() for p in scalar.particles]
+        self.assertTrue(np.array_equal(vector.sense(), np.array(expected, dtype=np.float64)))
+
+    def testParticlesStartOnOpenCells(self):
+        vector = self.createFilter(VectorParticleFilter)
+        vector.makeParticles(500)
+
+        self.assertEqual(len(vector.y), 500)
+        self.assertTrue(np.all(self.grid[vector.y.astype(np.intp), vector.x.astype(np.intp)] > 0))
+        self.assertAlmostEqual(vector.weight.sum(), 1.0)
+
+    def testResample(self):
+        vector = self.createFilter(VectorParticleFilter)
+        vector.resampler = Resampler(threshold=1.0)
+        vector.makeParticles()
+        heavy = (vector.y[0], vector.x[0])
+        weight = np.zeros(vector.N)
+        weight[0] = 1.0
+        vector.resample(weight)
+
+        self.assertTrue(np.all(vector.y == heavy[0]))
+        self.assertTrue(np.all(vector.x == heavy[1]))
+        self.assertTrue(np.allclose(vector.weight, 1.0 / vector.N))
+
+    def testAdaptiveSampleSize(self):
+        # Starts with the max number of particles, and drops to the min once
+        # all the weight is on one particle.
+
+        vector = self.createFilter(VectorParticleFilter)
+        vector.resampler = Resampler(threshold=0.5)
+        vector.kldSampler = KldSampler(50, 1000, 10)
+        vector.makeParticles()
+        self.assertEqual(vector.N, 1000)
+
+        weight = np.zeros(vector.N)
+        weight[0] = 1.0
+        vector.resample(weight)
+        self.assertEqual(vector.N, 50)
+        self.assertEqual(len(vector.y), 50)
+
+
+class ShardedParticleFilterTest(FilterTestCase):
+
+    def setUp(self):
+        super(ShardedParticleFilterTest, self).setUp()
+        self.ioloop = IOLoop()
+        self.sharded = self.createFilter(ShardedParticleFilter, True, shards=3, ioloop=self.ioloop)
+        self.sharded.makeParticles()
+
+    def tearDown(self):
+        self.sharded.close()
+        self.ioloop.close()
+
+    def runUntil(self, done, timeout=10.0):
+        # Runs the IOLoop until done returns True.
+
+        def check():
+            if done() or time.time() > deadline:
+                self.ioloop.stop()
+            else:
+                self.ioloop.add_timeout(time.time() + 0.01, check)
+
+        deadline = time.time() + timeout
+        self.ioloop.add_callback(check)
+        self.ioloop.start()
+        self.assertTrue(done())
+
+    def createVector(self):
+        vector = self.createFilter(VectorParticleFilter, True)
+        vector.N = self.sharded.N
+        vector.y = self.sharded.y.copy()
+        vector.x = self.sharded.x.copy()
+        vector.orientation = self.sharded.orientation.copy()
+        vector.weight = self.sharded.weight.copy()
+        return vector
+
+    def testMatchesVector(self):
+        vector = self.createVector()
+        for motion, measurements in zip(MOTIONS, MEASUREMENTS):
+            self.sharded.update(motion, measurements)
+            vector.update(motion, measurements)
+            self.assertSameParticles(self.sharded, vector)
+
+    def testUpdateAsync(self):
+        vector = self.createVector()
+        done = []
+        for motion, measurements in zip(MOTIONS, MEASUREMENTS):
+            self.sharded.updateAsync(motion, measurements, lambda: done.append(True))
+            vector.update(motion, measurements)
+        self.runUntil(lambda: len(done) == len(MEASUREMENTS))
+
+        self.assertSameParticles(self.sharded, vector)
+        self.assertFalse(self.sharded.busy)
+
+    def testCallbackErrorKeepsUpdating(self):
+        done = []
+        def fail():
+            done.append(True)
+            raise IOError
+        self.sharded.updateAsync(MOTIONS[0], MEASUREMENTS[0], fail)
+        self.sharded.updateAsync(MOTIONS[1], MEASUREMENTS[1], lambda: done.append(True))
+
+        # The IOLoop logs the error of the failed callback
+        logging.disable(logging.ERROR)
+        try:
+            self.runUntil(lambda: len(done) == 2)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertFalse(self.sharded.busy)
+
+    def testResetDropsQueuedUpdates(self):
+        done = []
+        for motion, measurements in zip(MOTIONS, MEASUREMENTS):
+            self.sharded.updateAsync(motion, measurements, lambda: done.append(True))
+        self.sharded.makeParticles()
+        vector = self.createVector()
+
+        self.assertEqual(self.sharded.pending, [])
+        self.runUntil(lambda: len(done) == len(MEASUREMENTS))
+        self.assertSameParticles(self.sharded, vector)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,468 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from pathfinder import DistanceFieldStore, DStarLite, GridWatcher, HierarchicalPathfinder
+from pathfinder import JumpPointPathfinder, PathCache, Pathfinder, PathfinderStrategy
+from pathfinder import PlannerStore, manhattanDistance
+
+
+OPEN = 255
+WALL = 0
+
+
+def createGrid(rows, cols, walls, seed):
+    # Returns a grid with walls on a random fraction of the cells.
+
+    rng = random.Random(seed)
+    grid = np.empty((rows, cols), dtype=np.uint8)
+    for y in xrange(rows):
+        for x in xrange(cols):
+            grid[y, x] = WALL if rng.random() < walls else OPEN
+    return grid
+
+
+def openCells(grid):
+    return [[y, x] for y, x in zip(*np.nonzero(grid == OPEN))]
+
+
+def bfsLength(grid, start, goal):
+    # Number of cells on the shortest path found by a breadth-first search,
+    # or False if the goal cannot be reached.
+
+    rows, cols = grid.shape
+    length = {tuple(start): 1}
+    queue = [tuple(start)]
+    for y, x in queue:
+        if (y, x) == tuple(goal):
+            return length[(y, x)]
+        for y2, x2 in [(y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)]:
+            if 0 <= y2 < rows and 0 <= x2 < cols and grid[y2, x2] == OPEN and (y2, x2) not in length:
+                length[(y2, x2)] = length[(y, x)] + 1
+                queue.append((y2, x2))
+    return False
+
+
+class PathTestCase(unittest.TestCase):
+
+    def assertValidPath(self, grid, path, start, goal):
+        # Checks that a path goes from start to goal over open neighboring cells.
+
+        self.assertEqual(path[0], start)
+        self.assertEqual(path[-1], goal)
+        for (y, x), (y2, x2) in zip(path, path[1:]):
+            self.assertEqual(abs(y - y2) + abs(x - x2), 1)
+        for y, x in path:
+            self.assertEqual(grid[y, x], OPEN)
+
+    def assertSameLength(self, grid, path, expected, start, goal):
+        # Shortest paths can differ, so only the lengths are compared.
+
+        if expected is False:
+            self.assertFalse(path)
+        else:
+            self.assertTrue(path)
+            self.assertValidPath(grid, path, start, goal)
+            self.assertEqual(len(path), len(expected))
+
+
+class PathfinderTest(PathTestCase):
+
+    def setUp(self):
+        self.rng = random.Random(14)
+
+    def testShortestPath(self):
+        for heuristic in [None, manhattanDistance]:
+            for walls in [0, 0.25, 0.4]:
+                grid = createGrid(20, 25, walls, 15)
+                pathfinder = Pathfinder(grid, OPEN, heuristic)
+                for i in xrange(20):
+                    start, goal = self.rng.sample(openCells(grid), 2)
+                    path = pathfinder.search(start, goal)
+                    expected = bfsLength(grid, start, goal)
+                    if expected is False:
+                        self.assertFalse(path)
+                    else:
+                        self.assertValidPath(grid, path, start, goal)
+                        self.assertEqual(len(path), expected)
+
+    def testHeuristicExpandsFewerCells(self):
+        grid = createGrid(30, 30, 0, 1)
+        dijkstra = Pathfinder(grid, OPEN)
+        astar = Pathfinder(grid, OPEN, manhattanDistance)
+        dijkstra.search([0, 0], [10, 10])
+        astar.search([0, 0], [10, 10])
+        self.assertTrue(astar.expanded < dijkstra.expanded)
+
+    def testStartIsGoal(self):
+        grid = createGrid(5, 5, 0, 1)
+        self.assertEqual(Pathfinder(grid, OPEN, manhattanDistance).search([2, 2], [2, 2]), [[2, 2]])
+
+
+class JumpPointPathfinderTest(PathTestCase):
+
+    def setUp(self):
+        self.rng = random.Random(5)
+
+    def assertMatchesAStar(self, grid, searches=30):
+        # Includes unreachable goals on grids with many walls.
+
+        pathfinder = JumpPointPathfinder(grid, OPEN, manhattanDistance)
+        astar = Pathfinder(grid, OPEN, manhattanDistance)
+        cells = openCells(grid)
+        for i in xrange(searches):
+            start, goal = self.rng.sample(cells, 2)
+            self.assertSameLength(grid, pathfinder.search(start, goal),
+                astar.search(start, goal), start, goal)
+
+    def testMatchesAStar(self):
+        for walls in [0, 0.1, 0.25, 0.4]:
+            self.assertMatchesAStar(createGrid(23, 31, walls, 6))
+
+    def testHallways(self):
+        grid = np.empty((21, 21), dtype=np.uint8)
+        grid.fill(WALL)
+        grid[1::4, 1:-1] = OPEN
+        grid[1:-1, 1::6] = OPEN
+        self.assertMatchesAStar(grid)
+
+    def testStartIsGoal(self):
+        grid = createGrid(5, 5, 0, 1)
+        path = JumpPointPathfinder(grid, OPEN, manhattanDistance).search([2, 2], [2, 2])
+        self.assertEqual(path, [[2, 2]])
+
+    def testGridChange(self):
+        grid = createGrid(20, 20, 0.25, 7)
+        pathfinder = JumpPointPathfinder(grid, OPEN, manhattanDistance)
+        grid = createGrid(20, 20, 0.25, 8)
+        pathfinder.setGrid(grid)
+
+        astar = Pathfinder(grid, OPEN, manhattanDistance)
+        for i in xrange(20):
+            start, goal = self.rng.sample(openCells(grid), 2)
+            self.assertSameLength(grid, pathfinder.search(start, goal),
+                astar.search(start, goal), start, goal)
+
+
+class HierarchicalPathfinderTest(PathTestCase):
+    # Paths of HPA* are not always the shortest, so they are only checked
+    # to be valid, found whenever A* finds one, and no shorter than A*.
+
+    def setUp(self):
+        self.rng = random.Random(9)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertMatchesAStar(self, pathfinder, searches=30):
+        grid = pathfinder.grid
+        astar = Pathfinder(grid, OPEN, manhattanDistance)
+        cells = openCells(grid)
+        for i in xrange(searches):
+            start, goal = self.rng.sample(cells, 2)
+            path = pathfinder.search(start, goal)
+            expected = astar.search(start, goal)
+            if expected is False:
+                self.assertFalse(path)
+            else:
+                self.assertTrue(path)
+                self.assertValidPath(grid, path, start, goal)
+                self.assertTrue(len(path) >= len(expected))
+
+    def testMatchesAStar(self):
+        # Grid sizes that are not a multiple of the cluster size leave
+        # smaller clusters on the edges.
+
+        for walls in [0, 0.1, 0.25, 0.4]:
+            grid = createGrid(33, 27, walls, 10)
+            self.assertMatchesAStar(HierarchicalPathfinder(grid, OPEN, manhattanDistance, clusterSize=8))
+
+    def testSameCluster(self):
+        grid = createGrid(20, 20, 0, 1)
+        pathfinder = HierarchicalPathfinder(grid, OPEN, manhattanDistance, clusterSize=10)
+        path = pathfinder.search([1, 1], [8, 3])
+        self.assertValidPath(grid, path, [1, 1], [8, 3])
+        self.assertEqual(len(path), 10)
+
+    def testDetourThroughOtherCluster(self):
+        # Start and goal share a cluster, but a wall inside it means the
+        # path has to leave the cluster.
+
+        grid = createGrid(20, 20, 0, 1)
+        grid[:9, 5] = WALL
+        pathfinder = HierarchicalPathfinder(grid, OPEN, manhattanDistance, clusterSize=10)
+        path = pathfinder.search([0, 0], [0, 9])
+        self.assertValidPath(grid, path, [0, 0], [0, 9])
+
+    def testWallStartOrGoal(self):
+        grid = createGrid(20, 20, 0, 1)
+        grid[0, 0] = WALL
+        pathfinder = HierarchicalPathfinder(grid, OPEN, manhattanDistance)
+        self.assertFalse(pathfinder.search([0, 0], [15, 15]))
+        self.assertFalse(pathfinder.search([15, 15], [0, 0]))
+
+    def testSaveAndLoadGraph(self):
+        filepath = os.path.join(self.dir, 'grid_hpa.pickle')
+        grid = createGrid(30, 30, 0.2, 11)
+        pathfinder = HierarchicalPathfinder(grid, OPEN, manhattanDistance, filepath=filepath)
+
+        loaded = HierarchicalPathfinder(grid, OPEN, manhattanDistance, filepath=filepath)
+        self.assertTrue(loaded.loadGraph())
+        self.assertEqual(loaded.graph, pathfinder.graph)
+        self.assertEqual(loaded.clusterNodes, pathfinder.clusterNodes)
+
+        resized = HierarchicalPathfinder(grid, OPEN, manhattanDistance, clusterSize=5, filepath=filepath)
+        self.assertNotEqual(resized.graph, pathfinder.graph)
+        self.assertMatchesAStar(resized)
+
+    def testGridChange(self):
+        filepath = os.path.join(self.dir, 'grid_hpa.pickle')
+        pathfinder = HierarchicalPathfinder(createGrid(30, 30, 0.2, 12), OPEN, manhattanDistance,
+            filepath=filepath)
+        pathfinder.setGrid(createGrid(30, 30, 0.2, 13))
+        self.assertMatchesAStar(pathfinder)
+
+
+class PathfinderStrategyTest(unittest.TestCase):
+
+    def testCreate(self):
+        grid = createGrid(10, 10, 0, 1)
+        for strategy, cls in PathfinderStrategy.PATHFINDERS.items():
+            self.assertTrue(isinstance(PathfinderStrategy.create(strategy, grid, OPEN), cls))
+
+    def testOptions(self):
+        grid = createGrid(10, 10, 0, 1)
+        pathfinder = PathfinderStrategy.create(PathfinderStrategy.HIERARCHICAL, grid, OPEN,
+            clusterSize=5)
+        self.assertEqual(pathfinder.clusterSize, 5)
+
+    def testUnknownStrategy(self):
+        self.assertRaises(ValueError, PathfinderStrategy.create, 'unknown', createGrid(5, 5, 0, 1), OPEN)
+
+
+class DStarLiteTest(PathTestCase):
+
+    def setUp(self):
+        self.grid = createGrid(20, 20, 0.25, 1)
+        self.pathfinder = Pathfinder(self.grid, OPEN, manhattanDistance)
+        self.cells = openCells(self.grid)
+        self.rng = random.Random(2)
+
+    def search(self, start, goal, blocked):
+        # A* on a copy of the grid with the blocked cells turned into walls.
+
+        grid = self.grid.copy()
+        for y, x in blocked:
+            grid[y, x] = WALL
+        return grid, Pathfinder(grid, OPEN, manhattanDistance).search(start, goal)
+
+    def testMatchesAStar(self):
+        for i in xrange(20):
+            start, goal = self.rng.sample(self.cells, 2)
+            planner = DStarLite(self.pathfinder, goal)
+            path = planner.plan(start)
+            self.assertSameLength(self.grid, path, self.pathfinder.search(start, goal), start, goal)
+
+    def testReplanWithBlockedCells(self):
+        # The robot moves along the path while obstacles appear and disappear.
+
+        start, goal = self.rng.sample(self.cells, 2)
+        planner = DStarLite(self.pathfinder, goal)
+        path = planner.plan(start)
+        while path and len(path) > 2:
+            start = path[1]
+            candidates = [cell for cell in self.cells if cell != start and cell != goal]
+            blocked = self.rng.sample(candidates, 5)
+            grid, expected = self.search(start, goal, blocked)
+            path = planner.plan(start, blocked)
+            self.assertSameLength(grid, path, expected, start, goal)
+
+    def testBlockedCellsAreOpenedAgain(self):
+        grid = np.empty((5, 5), dtype=np.uint8)
+        grid.fill(OPEN)
+        planner = DStarLite(Pathfinder(grid, OPEN, manhattanDistance), [0, 4])
+
+        self.assertEqual(len(planner.plan([0, 0], [[0, 2]])), 7)
+        self.assertEqual(len(planner.plan([0, 0], [])), 5)
+        self.assertEqual(len(planner.plan([0, 0], [[0, 2], [1, 2]])), 9)
+        self.assertEqual(len(planner.plan([0, 0], [[1, 2]])), 5)
+
+    def testWallsAreNotOpened(self):
+        walls = [[y, x] for y, x in zip(*np.nonzero(self.grid == WALL))]
+        start, goal = self.rng.sample(self.cells, 2)
+        planner = DStarLite(self.pathfinder, goal)
+        planner.plan(start, walls[:3])
+        path = planner.plan(start, [])
+        self.assertSameLength(self.grid, path, self.pathfinder.search(start, goal), start, goal)
+
+    def testUnreachableGoal(self):
+        grid = np.empty((5, 5), dtype=np.uint8)
+        grid.fill(OPEN)
+        grid[:, 2] = WALL
+        planner = DStarLite(Pathfinder(grid, OPEN, manhattanDistance), [0, 4])
+        self.assertFalse(planner.plan([0, 0]))
+
+
+class PlannerStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pathfinder = Pathfinder(createGrid(10, 10, 0, 1), OPEN, manhattanDistance)
+
+    def testReusesPlanner(self):
+        planners = PlannerStore(self.pathfinder)
+        self.assertTrue(planners.get([1, 1]) is planners.get((1, 1)))
+
+    def testEvictsLeastRecentlyUsed(self):
+        planners = PlannerStore(self.pathfinder, 2)
+        first = planners.get([0, 0])
+        planners.get([1, 1])
+        planners.get([0, 0])
+        planners.get([2, 2])
+        self.assertEqual(list(planners.planners.keys()), [(0, 0), (2, 2)])
+        self.assertTrue(planners.get([0, 0]) is first)
+
+    def testClearedOnGridChange(self):
+        planners = PlannerStore(self.pathfinder)
+        planner = planners.get([1, 1])
+        grid = self.pathfinder.grid.copy()
+        grid[5, 5] = WALL
+        self.pathfinder.setGrid(grid)
+        self.assertFalse(planners.get([1, 1]) is planner)
+
+
+class PathCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = PathCache(2)
+        self.path = [[0, 0], [0, 1], [1, 1], [2, 1]]
+        self.directions = ['r', 'd', 'd']
+
+    def testHitAndMiss(self):
+        self.assertEqual(self.cache.get([0, 0], [2, 1], 'v1'), None)
+        self.cache.put([0, 0], [2, 1], 'v1', self.path, self.directions)
+
+        self.assertEqual(self.cache.get([0, 0], [2, 1], 'v1'), (self.path, self.directions))
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def testSubpath(self):
+        self.cache.put([0, 0], [2, 1], 'v1', self.path, self.directions)
+
+        self.assertEqual(self.cache.get([0, 1], [2, 1], 'v1'), (self.path[1:], self.directions[1:]))
+        self.assertEqual(self.cache.get([2, 1], [2, 1], 'v1'), ([[2, 1]], []))
+        self.assertEqual(self.cache.get([0, 1], [1, 1], 'v1'), None)
+        self.assertEqual(self.cache.subpathHits, 2)
+
+    def testVersionChange(self):
+        self.cache.put([0, 0], [2, 1], 'v1', self.path, self.directions)
+
+        self.assertEqual(self.cache.get([0, 0], [2, 1], 'v2'), None)
+        self.assertEqual(len(self.cache.entries), 0)
+        self.assertEqual(self.cache.get([0, 1], [2, 1], 'v2'), None)
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.cache.put([0, 0], [2, 1], 'v1', self.path, self.directions)
+        self.cache.put([0, 1], [2, 1], 'v1', self.path[1:], self.directions[1:])
+        self.cache.get([0, 0], [2, 1], 'v1')
+        self.cache.put([1, 1], [2, 1], 'v1', self.path[2:], self.directions[2:])
+
+        self.assertEqual(list(self.cache.entries.keys()), [((0, 0), (2, 1), 'v1'), ((1, 1), (2, 1), 'v1')])
+        self.assertEqual(self.cache.routes[(2, 1)], set(self.cache.entries.keys()))
+
+
+class DistanceFieldStoreTest(PathTestCase):
+
+    def setUp(self):
+        self.grid = createGrid(20, 20, 0.25, 3)
+        self.pathfinder = Pathfinder(self.grid, OPEN, manhattanDistance)
+        self.cells = openCells(self.grid)
+        self.rng = random.Random(4)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertMatchesSearch(self, store, goal):
+        for start in self.rng.sample(self.cells, 20):
+            self.assertSameLength(self.pathfinder.grid, store.path(start, goal),
+                self.pathfinder.search(start, goal), start, goal)
+
+    def testMatchesAStar(self):
+        store = DistanceFieldStore(self.pathfinder)
+        goal = self.cells[0]
+        self.assertTrue(store.register(goal, False))
+        self.assertMatchesSearch(store, goal)
+
+    def testRegisterWall(self):
+        store = DistanceFieldStore(self.pathfinder)
+        wall = [[y, x] for y, x in zip(*np.nonzero(self.grid == WALL))][0]
+        self.assertFalse(store.register(wall, False))
+        self.assertFalse(store.hasGoal(wall))
+
+    def testGridChange(self):
+        store = DistanceFieldStore(self.pathfinder)
+        goal = self.cells[0]
+        store.register(goal, False)
+
+        grid = self.grid.copy()
+        for y, x in self.rng.sample(self.cells[1:], 40):
+            grid[y, x] = WALL
+        self.pathfinder.setGrid(grid)
+        self.cells = openCells(grid)
+        self.assertMatchesSearch(store, goal)
+
+    def testClosedGoalIsUnregistered(self):
+        store = DistanceFieldStore(self.pathfinder)
+        goal = self.cells[0]
+        store.register(goal, False)
+
+        grid = self.grid.copy()
+        grid[goal[0], goal[1]] = WALL
+        self.pathfinder.setGrid(grid)
+        self.assertFalse(store.hasGoal(goal))
+
+    def testSaveAndLoad(self):
+        filepath = os.path.join(self.dir, 'fields.npz')
+        store = DistanceFieldStore(self.pathfinder, filepath)
+        store.register(self.cells[0])
+
+        loaded = DistanceFieldStore(self.pathfinder, filepath)
+        loaded.load()
+        self.assertTrue(loaded.hasGoal(self.cells[0]))
+        self.assertEqual(loaded.fields, store.fields)
+
+        grid = self.grid.copy()
+        grid[self.cells[1][0], self.cells[1][1]] = WALL
+        loaded = DistanceFieldStore(Pathfinder(grid, OPEN, manhattanDistance), filepath)
+        loaded.load()
+        self.assertFalse(loaded.hasGoal(self.cells[0]))
+
+    def testRefreshedOnGridReload(self):
+        gridFile = os.path.join(self.dir, 'grid.png')
+        fieldsFile = os.path.join(self.dir, 'fields.npz')
+        cv2.imwrite(gridFile, self.grid)
+        pathfinder = Pathfinder(cv2.imread(gridFile, cv2.CV_LOAD_IMAGE_GRAYSCALE), OPEN, manhattanDistance)
+        store = DistanceFieldStore(pathfinder, fieldsFile)
+        store.register(self.cells[0])
+        watcher = GridWatcher(gridFile, pathfinder, onReload=store.refresh)
+
+        grid = self.grid.copy()
+        grid[self.cells[1][0], self.cells[1][1]] = WALL
+        cv2.imwrite(gridFile, grid)
+        os.utime(gridFile, (watcher.mtime + 10, watcher.mtime + 10))
+        watcher.check()
+
+        self.assertEqual(store.version, pathfinder.version)
+        loaded = DistanceFieldStore(pathfinder, fieldsFile)
+        loaded.load()
+        self.assertEqual(loaded.fields, store.fields)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import random
+import unittest
+
+import numpy as np
+
+from resample import KldSampler, Resampler, ResampleStrategy, effectiveSampleSize, expNormalize
+from resample import normalQuantile, residualResample, systematicResample
+
+
+STRATEGIES = [ResampleStrategy.WHEEL, ResampleStrategy.MULTINOMIAL, ResampleStrategy.SYSTEMATIC,
+    ResampleStrategy.STRATIFIED, ResampleStrategy.RESIDUAL]
+
+
+def createWeights(count, seed):
+    rng = np.random.RandomState(seed)
+    weight = rng.random_sample(count) ** 4
+    return weight / weight.sum()
+
+
+class StrategyTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        np.random.seed(1)
+
+    def testIndexesInRange(self):
+        weight = createWeights(50, 1)
+        for strategy in STRATEGIES:
+            index = Resampler.STRATEGIES[strategy](weight, 80)
+            self.assertEqual(len(index), 80)
+            self.assertTrue(np.all((index >= 0) & (index < 50)), strategy)
+
+    def testProportionalToWeight(self):
+        # Over many draws, every particle is picked about N * weight times,
+        # within 5 standard deviations of a multinomial draw.
+
+        weight = createWeights(20, 2)
+        N = 20000
+        tolerance = 5 * np.sqrt(N * weight * (1 - weight)) + 1
+        for strategy in STRATEGIES:
+            counts = np.bincount(Resampler.STRATEGIES[strategy](weight, N), minlength=20)
+            self.assertTrue(np.all(np.abs(counts - N * weight) <= tolerance), strategy)
+
+    def testZeroWeightNeverPicked(self):
+        weight = np.array([0.0, 0.5, 0.0, 0.5, 0.0])
+        for strategy in STRATEGIES:
+            index = Resampler.STRATEGIES[strategy](weight, 100)
+            self.assertTrue(np.all(weight[index] > 0), strategy)
+
+    def testSystematicCounts(self):
+        # Systematic resampling picks every particle floor or ceil of
+        # N * weight times.
+
+        weight = createWeights(30, 3)
+        for i in xrange(20):
+            counts = np.bincount(systematicResample(weight, 100), minlength=30)
+            self.assertTrue(np.all(counts >= np.floor(weight * 100) - 1e-9))
+            self.assertTrue(np.all(counts <= np.ceil(weight * 100) + 1e-9))
+
+    def testResidualKeepsCopies(self):
+        weight = createWeights(30, 4)
+        counts = np.bincount(residualResample(weight, 100), minlength=30)
+        self.assertEqual(counts.sum(), 100)
+        self.assertTrue(np.all(counts >= np.floor(weight * 100)))
+
+
+class ResamplerTest(unittest.TestCase):
+
+    def testUnknownStrategy(self):
+        self.assertRaises(ValueError, Resampler, 'unknown')
+
+    def testEffectiveSampleSize(self):
+        self.assertAlmostEqual(effectiveSampleSize(np.ones(10) / 10), 10.0)
+        self.assertAlmostEqual(effectiveSampleSize(np.array([0.0, 1.0, 0.0])), 1.0)
+
+    def testSkipsWhileEffectiveSampleSizeIsHigh(self):
+        weight = np.array([1.0, 1.0, 1.0, 2.0])
+        index, newWeight = Resampler(threshold=0.5).resample(weight)
+        self.assertEqual(index, None)
+        self.assertTrue(np.allclose(newWeight, weight / weight.sum()))
+
+    def testResamplesWhenEffectiveSampleSizeIsLow(self):
+        weight = np.array([0.0, 0.0, 1.0, 0.0])
+        index, newWeight = Resampler(threshold=0.5).resample(weight)
+        self.assertTrue(np.all(index == 2))
+        self.assertTrue(np.allclose(newWeight, 0.25))
+
+    def testThresholdOneAlwaysResamples(self):
+        index, newWeight = Resampler(threshold=1.0).resample(np.ones(4))
+        self.assertEqual(len(index), 4)
+
+    def testZeroWeights(self):
+        index, newWeight = Resampler().resample(np.zeros(4))
+        self.assertEqual(index, None)
+        self.assertTrue(np.allclose(newWeight, 0.25))
+
+    def testSampleSizeOnlyWhenResampling(self):
+        calls = []
+        def sampleSize(weight):
+            calls.append(weight)
+            return 2
+
+        resampler = Resampler(threshold=0.5)
+        index, newWeight = resampler.resample(np.ones(4), sampleSize)
+        self.assertEqual(index, None)
+        self.assertEqual(calls, [])
+
+        index, newWeight = resampler.resample(np.array([0.0, 0.0, 3.0, 1.0]), sampleSize)
+        self.assertEqual(len(index), 2)
+        self.assertTrue(np.allclose(newWeight, 0.5))
+        self.assertTrue(np.allclose(calls[0], [0.0, 0.0, 0.75, 0.25]))
+
+    def testExpNormalize(self):
+        weight = expNormalize([-1000.0, -1001.0, float('-inf')])
+        self.assertAlmostEqual(weight.sum(), 1.0)
+        self.assertAlmostEqual(weight[0] / weight[1], np.e)
+        self.assertEqual(weight[2], 0.0)
+        self.assertTrue(np.all(expNormalize([float('-inf')] * 3) == 0.0))
+
+
+class KldSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sampler = KldSampler(100, 5000, 10, angleBins=4, error=0.05, delta=0.01)
+        self.rng = np.random.RandomState(1)
+
+    def spread(self, count, size):
+        # Particles spread uniformly over a size x size area.
+
+        return (self.rng.random_sample(count) * size, self.rng.random_sample(count) * size,
+            self.rng.random_sample(count) * 2 * np.pi)
+
+    def testNormalQuantile(self):
+        self.assertAlmostEqual(normalQuantile(0.5), 0.0, 3)
+        self.assertAlmostEqual(normalQuantile(0.99), 2.326, 2)
+        self.assertAlmostEqual(normalQuantile(0.01), -2.326, 2)
+
+    def testOccupiedBins(self):
+        y = np.array([0.0, 5.0, 15.0, 15.0])
+        x = np.array([0.0, 5.0, 0.0, 0.0])
+        orientation = np.array([0.1, 0.2, 0.1, np.pi])
+        self.assertEqual(self.sampler.occupiedBins(y, x, orientation), 3)
+
+    def testLightBinsAreNotCounted(self):
+        y = np.array([0.0, 15.0])
+        x = np.array([0.0, 0.0])
+        orientation = np.array([0.1, 0.1])
+        self.assertEqual(self.sampler.occupiedBins(y, x, orientation, np.array([1.0, 1e-6])), 1)
+
+    def testConvergedUsesMinimum(self):
+        y, x, orientation = self.spread(1000, 1)
+        self.assertEqual(self.sampler.sampleSize(y, x, orientation * 0), 100)
+
+    def testGrowsWithSpread(self):
+        sizes = [self.sampler.sampleSize(*self.spread(5000, size)) for size in [20, 60, 200]]
+        self.assertTrue(sizes[0] < sizes[1] < sizes[2])
+        self.assertTrue(100 <= sizes[0] and sizes[2] <= 5000)
+
+    def testClampedToMaximum(self):
+        self.assertEqual(self.sampler.sampleSize(*self.spread(20000, 2000)), 5000)
+
+    def testKnownSize(self):
+        # Fox 2003, eq. 7 with k = 50 bins.
+
+        y = np.arange(50) * 10.0
+        x = np.zeros(50)
+        orientation = np.zeros(50)
+        z = normalQuantile(0.99)
+        a = 2.0 / (9.0 * 49)
+        expected = int(49 / 0.1 * (1.0 - a + np.sqrt(a) * z) ** 3)
+        self.assertEqual(self.sampler.sampleSize(y, x, orientation), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ import pkgutil
 import select
 import signal
 import socket
+import struct
 import sys
 import termios
 import time
@@ -128,6 +129,9 @@ class Connection(object):
     # Message format for writing messages. Basically string followed by nullbyte.
     MSG_FORMAT = "{}{}"
 
+    # Length prefix of binary frames. 4 byte unsigned int, big-endian.
+    LENGTH_PREFIX = struct.Struct('>I')
+
     def __init__(self, stream, address, data, terminator='\0'):
         # Inits a connection object with a connected stream
 
@@ -135,6 +139,8 @@ class Connection(object):
         self.stream = stream
         self.address = address
         self.terminator = terminator
+        self.lengthPrefixed = False
+        self.readingFrame = False
         self.stream.set_close_callback(self.onClose)
 
         self.onInit()
@@ -176,15 +182,33 @@ class Connection(object):
         # Sends msg to the server.
 
         self.logInfo(Connection.LOG_MSG_SEND)
-        self.stream.write(Connection.MSG_FORMAT.format(msg, self.terminator), self.onWrite)
+        if self.lengthPrefixed:
+            self.stream.write(Connection.LENGTH_PREFIX.pack(len(msg)) + msg, self.onWrite)
+        else:
+            self.stream.write(Connection.MSG_FORMAT.format(msg, self.terminator), self.onWrite)
 
     def read(self):
         # Reads data from the stream until encounters the specified
         # terminator character.
+        #
+        # Length prefixed frames are read in two steps, the length and then
+        # the message. The stream is not reading in between the two steps,
+        # so readingFrame keeps a write from starting another read.
 
-        if not self.stream.reading():
+        if not self.stream.reading() and not self.readingFrame:
             self.logInfo(Connection.LOG_MSG_LISTEN)
-            self.stream.read_until(self.terminator, self.onRead)
+            if self.lengthPrefixed:
+                self.readingFrame = True
+                self.stream.read_bytes(Connection.LENGTH_PREFIX.size, self.onReadLength)
+            else:
+                self.stream.read_until(self.terminator, self.onRead)
+
+    def onReadLength(self, data):
+        self.stream.read_bytes(Connection.LENGTH_PREFIX.unpack(data)[0], self.onReadFrame)
+
+    def onReadFrame(self, data):
+        self.readingFrame = False
+        self.onRead(data)
 
     def close(self):
         # Disconnects client from server.
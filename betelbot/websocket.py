@@ -25,6 +25,9 @@ class VisualizerWebSocket(websocket.WebSocketHandler):
     LOG_CONNECTED = 'WebSocket connected. Subscribing to topics'
     LOG_CLOSED = 'WebSocket closed'
 
+    # Last data of each topic. Websockets share one client, which subscribes
+    # to the master only once, so the master sends its retained messages
+    # to the first websocket only. Later websockets get them from here.
     state = {}
 
     def initialize(self, conn):
@@ -35,16 +38,17 @@ class VisualizerWebSocket(websocket.WebSocketHandler):
     def open(self):
         logging.info(VisualizerWebSocket.LOG_CONNECTED)
 
-        self.conn.subscribe(self.topics.particle.id, self.onNotifySub)
-        self.conn.subscribe(self.topics.path.id, self.onNotifySub)
-        self.conn.subscribe(self.topics.power.id, self.onNotifySub)
-        self.conn.subscribe(self.topics.mode.id, self.onNotifySub)
-        self.conn.subscribe(self.topics.location.id, self.onNotifySub)
-        self.conn.subscribe(self.topics.waypoint.id, self.onNotifySub)
+        self.conn.subscribe([
+            self.topics.particle.id,
+            self.topics.path.id,
+            self.topics.power.id,
+            self.topics.mode.id,
+            self.topics.location.id,
+            self.topics.waypoint.id
+        ], self.onNotifySub)
 
-        for key in VisualizerWebSocket.state:
-            msg = self.encoder.notification(key, state[key])
-            self.write(msg)
+        for topic, data in VisualizerWebSocket.state.items():
+            self.write_message(self.encoder.notification(topic, data[0]))
 
     def on_message(self, message):
         data = json.loads(message)
@@ -62,8 +66,7 @@ class VisualizerWebSocket(websocket.WebSocketHandler):
         logging.info(VisualizerWebSocket.LOG_CLOSED)
 
     def onNotifySub(self, topic, data=None):
-        if topic == self.topics.particle:
-            VisualizerWebSocket.state[topic] = data
+        VisualizerWebSocket.state[topic] = data
 
         msg = self.encoder.notification(topic, data[0])
         self.write_message(msg)
@@ -84,7 +87,7 @@ def main():
     logger = logging.getLogger('')
     logger.setLevel(cfg.general.logLevel)
 
-    client = Client('', cfg.server.port, BetelbotClientConnection)
+    client = Client('', cfg.server.port, BetelbotClientConnection, **cfg.rpc.dict())
     conn = client.connect()
     conn.batchLocate(onBatchLocateResponse,
             [RobotMethod.POWER, RobotMethod.MODE, RobotMethod.STATUS])